@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Compares the node-pruning envelop()/chop() of CustomIntervalTree with the
+previous boundary-table search followed by filtering.
+
+    PYTHONPATH=. python benchmarks/bench_envelop.py --size 1000000
+"""
+
+import argparse
+import random
+import time
+
+from intervaltree import Interval
+
+from tcp_server.tcp_server import CustomIntervalTree, MAX_INT
+
+
+def legacy_envelop(tree, begin, end):
+    root = tree.top_node
+    if not root or begin >= end:
+        return set()
+    result = root.search_point(begin, set())
+    boundary_table = tree.boundary_table
+    bound_begin = boundary_table.bisect_left(begin)
+    bound_end = boundary_table.bisect_left(end)
+    result.update(
+        root.search_overlap(boundary_table.keys()[index] for index in range(bound_begin, bound_end))
+    )
+    return set(iv for iv in result if iv.begin >= begin and iv.end <= end)
+
+
+def legacy_chop(tree, begin, end):
+    for iv in legacy_envelop(tree, begin, end):
+        tree.remove(iv)
+
+
+def build_tree(size, names, max_width, rng):
+    intervals = set()
+    while len(intervals) < size:
+        begin = rng.randrange(0, MAX_INT - max_width)
+        width = rng.randrange(1, max_width)
+        intervals.add(Interval(begin, begin + width, f"n{rng.randrange(names)}"))
+    return CustomIntervalTree(intervals)
+
+
+def timed(func, ranges):
+    start = time.perf_counter()
+    for begin, end in ranges:
+        func(begin, end)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=1000000, help="intervals in the tree")
+    parser.add_argument("--names", type=int, default=100, help="distinct interval names")
+    parser.add_argument("--max-width", type=int, default=100000, help="widest interval")
+    parser.add_argument("--query-width", type=int, default=10000000, help="width of each range")
+    parser.add_argument("--queries", type=int, default=200, help="ranges per measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    def new_tree():
+        return build_tree(args.size, args.names, args.max_width, random.Random(args.seed))
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    legacy_tree = new_tree()
+    print(f"built {len(legacy_tree)} intervals in {time.perf_counter() - start:.1f}s")
+    # chop() mutates, so each implementation gets its own copy of the tree
+    pruned_tree = new_tree()
+
+    def ranges():
+        return [
+            (b, b + args.query_width)
+            for b in (rng.randrange(0, MAX_INT - args.query_width) for _ in range(args.queries))
+        ]
+
+    queries = ranges()
+    for begin, end in queries[:10]:
+        assert pruned_tree.envelop(begin, end) == legacy_envelop(legacy_tree, begin, end)
+    chops = ranges()
+    results = [
+        ("envelop", timed(lambda b, e: legacy_envelop(legacy_tree, b, e), queries),
+         timed(pruned_tree.envelop, queries)),
+        ("chop", timed(lambda b, e: legacy_chop(legacy_tree, b, e), chops),
+         timed(pruned_tree.chop, chops)),
+    ]
+    assert pruned_tree == legacy_tree
+    for name, legacy, pruned in results:
+        print(
+            f"{name:8} legacy {legacy / args.queries * 1e3:8.3f} ms/op"
+            f"  pruned {pruned / args.queries * 1e3:8.3f} ms/op  speedup {legacy / pruned:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
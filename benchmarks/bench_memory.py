@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Measures the resident memory each stored interval costs with the default
+and the compact (STORAGE=compact) tree, each built in its own process.
+
+    PYTHONPATH=. python benchmarks/bench_memory.py --size 1000000
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from intervaltree import Interval
+
+from tcp_server.compact import CompactIntervalTree
+from tcp_server.tcp_server import MAX_INT, CustomIntervalTree
+
+STORAGES = {"tree": CustomIntervalTree, "compact": CompactIntervalTree}
+
+
+def rss():
+    """
+    :rtype: int resident set size of this process in bytes
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(storage, size, names, max_width, seed):
+    rng = random.Random(seed)
+    gc.collect()
+    before = rss()
+    start = time.perf_counter()
+    tree = STORAGES[storage]()
+    while len(tree) < size:
+        # Batches a fraction of the tree's size keep the compact tree's merges cheap
+        count = min(size - len(tree), max(100000, len(tree) // 4))
+        batch = []
+        for _ in range(count):
+            begin = rng.randrange(0, MAX_INT - max_width)
+            # A fresh string per interval, as when parsed from each command
+            name = f"n{rng.randrange(names)}"
+            batch.append(Interval(begin, begin + rng.randrange(1, max_width), name))
+        tree.bulk_update(batch)
+        del batch
+    build = time.perf_counter() - start
+    gc.collect()
+    used = rss() - before
+    points = [rng.randrange(0, MAX_INT) for _ in range(10000)]
+    start = time.perf_counter()
+    for point in points:
+        tree.at(point)
+    at = (time.perf_counter() - start) / len(points)
+    return {
+        "storage": storage,
+        "intervals": len(tree),
+        "rss_bytes": used,
+        "bytes_per_interval": used / len(tree),
+        "nbytes_per_interval": tree.nbytes() / len(tree) if storage == "compact" else None,
+        "build_seconds": build,
+        "at_us": at * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=1000000, help="intervals in the tree")
+    parser.add_argument("--names", type=int, default=100, help="distinct interval names")
+    parser.add_argument("--max-width", type=int, default=1000, help="widest interval")
+    parser.add_argument("--storage", choices=sorted(STORAGES), help="measure one storage only")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.storage:
+        result = measure(args.storage, args.size, args.names, args.max_width, args.seed)
+        print(json.dumps(result))
+        return
+    results = []
+    for storage in ("tree", "compact"):
+        command = [sys.executable, __file__, "--storage", storage]
+        command += ["--size", str(args.size), "--names", str(args.names)]
+        command += ["--max-width", str(args.max_width), "--seed", str(args.seed)]
+        results.append(json.loads(subprocess.check_output(command)))
+    for result in results:
+        print(
+            f"{result['storage']:8} {result['intervals']} intervals"
+            f"  {result['rss_bytes'] / 2 ** 20:8.1f} MiB"
+            f"  {result['bytes_per_interval']:7.1f} bytes/interval"
+            f"  at {result['at_us']:6.1f} us  built in {result['build_seconds']:.1f}s"
+        )
+    tree, compact = results
+    ratio = tree["bytes_per_interval"] / compact["bytes_per_interval"]
+    print(f"compact uses {ratio:.1f}x less memory per interval")
+    print(f"compact arrays and counts hold {compact['nbytes_per_interval']:.1f} bytes/interval")
+
+
+if __name__ == "__main__":
+    main()
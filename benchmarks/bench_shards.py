@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Measures how throughput scales with SHARDS, driving a fresh server for
+each shard count from several `nks_bench load` processes at once.
+
+    PYTHONPATH=. python benchmarks/bench_shards.py --shards 0,1,2,4 --processes 4
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+from tcp_server.net import wait_for_port
+
+# Spread the load over the whole coordinate space, which SHARDS splits evenly
+SPAN = 2 ** 32 - 2 ** 20
+
+
+def spawn_server(shards, port, mode):
+    env = dict(os.environ, PORT=str(port), SHARDS=str(shards), SERVER_MODE=mode)
+    env.update(SHARD_BASE_PORT=str(port + 1), IDLE_TIMEOUT="0", MAX_CONNECTIONS="0")
+    env.pop("WAL_DIR", None)
+    command = [sys.executable, "-m", "tcp_server.tcp_server"]
+    # Slow-log warnings from the preload would drown out the results
+    server = subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL)
+    # The router only listens once its workers do
+    wait_for_port("127.0.0.1", port, timeout=60)
+    return server
+
+
+def load_command(port, args, seed, **options):
+    command = [sys.executable, "-m", "tcp_server.bench", "load", "--port", str(port)]
+    command += ["--span", str(SPAN), "--mix", args.mix, "--seed", str(seed)]
+    for option, value in options.items():
+        command += [f"--{option}", str(value)]
+    return command
+
+
+def measure(shards, args):
+    server = spawn_server(shards, args.port, args.mode)
+    try:
+        if args.preload:
+            command = load_command(args.port, args, 0, preload=args.preload, duration=0)
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with tempfile.TemporaryDirectory() as directory:
+            outputs = [os.path.join(directory, f"{i}.json") for i in range(args.processes)]
+            loaders = [
+                subprocess.Popen(
+                    load_command(
+                        args.port,
+                        args,
+                        # Clients of different processes must not send the same commands
+                        1000 * (i + 1),
+                        connections=args.connections,
+                        duration=args.duration,
+                        output=output,
+                    ),
+                    stdout=subprocess.DEVNULL,
+                )
+                for i, output in enumerate(outputs)
+            ]
+            for loader in loaders:
+                if loader.wait():
+                    raise RuntimeError(f"load process exited with {loader.returncode}")
+            runs = []
+            for output in outputs:
+                with open(output) as f:
+                    runs.append(json.load(f)["results"])
+    finally:
+        # SIGINT lets the router stop its workers
+        server.send_signal(signal.SIGINT)
+        server.wait()
+    return {
+        "shards": shards,
+        "ops": sum(run["ops"] for run in runs),
+        "throughput": sum(run["throughput"] for run in runs),
+        "p99_ms": max(run["latency"]["p99_ms"] for run in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shards", default="0,1,2,4", help="comma-separated SHARDS to try")
+    parser.add_argument("--processes", type=int, default=4, help="load processes at once")
+    parser.add_argument("--connections", type=int, default=16, help="per load process")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--preload", type=int, default=100000, help="intervals to MADD first")
+    parser.add_argument("--mix", default="add=10,del=5,find=80,range=5")
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--port", type=int, default=2104)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.processes} load processes")
+    baseline = None
+    for shards in map(int, args.shards.split(",")):
+        result = measure(shards, args)
+        baseline = baseline or result["throughput"]
+        print(
+            f"SHARDS={shards:<3} {result['throughput']:8.0f} ops/s"
+            f"  {result['throughput'] / baseline:5.2f}x  p99 {result['p99_ms']:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -19,7 +19,12 @@ setup(
     author="Nick Groszewski",
     author_email="groszewn@gmail.com",
     python_requires=">=3.5",
-    entry_points={"console_scripts": ["nks_server=tcp_server.tcp_server:run"]},
+    entry_points={
+        "console_scripts": [
+            "nks_server=tcp_server.tcp_server:run",
+            "nks_bench=tcp_server.bench:main",
+        ]
+    },
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
         "Intended Audience :: Developers",
@@ -33,6 +38,7 @@ setup(
     ],
     description="TCP Server to handle interval searches",
     install_requires=requirements,
+    extras_require={"numpy": ["numpy"]},
     license="MIT license",
     include_package_data=True,
     keywords="tcp_server",
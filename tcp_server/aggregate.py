@@ -0,0 +1,239 @@
+"""
+Counts kept next to a tree so COUNT, DISTINCT and COVERAGE are answered
+without building the matching Intervals or their names.
+
+An interval [b, e) overlaps [begin, end) exactly when b < end and
+e > begin. Every interval ending at or before begin also begins before
+end, so the overlapping ones number
+
+    #(b < end) - #(e <= begin)
+
+which two sorted multisets, of all begins and of all ends, answer with a
+bisect each. The same pair per name answers whether a name overlaps a
+range at all.
+"""
+
+import sys
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate
+
+LOAD = 512  # Values per chunk; chunks are split at twice this
+
+
+class SortedCounts:
+    """
+    Sorted multiset of 32-bit ints, kept in array chunks of at most
+    2 * LOAD so an insert only shifts one chunk.
+    """
+
+    def __init__(self, values=()):
+        values = sorted(values)
+        self.chunks = [array("I", values[i : i + LOAD]) for i in range(0, len(values), LOAD)]
+        self.lasts = [chunk[-1] for chunk in self.chunks]
+        self.offsets = None  # Values before each chunk, rebuilt on the first count after a change
+        self.size = len(values)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def add(self, value):
+        self.size += 1
+        self.offsets = None
+        if not self.chunks:
+            self.chunks.append(array("I", [value]))
+            self.lasts.append(value)
+            return
+        index = min(bisect_left(self.lasts, value), len(self.chunks) - 1)
+        chunk = self.chunks[index]
+        insort(chunk, value)
+        self.lasts[index] = chunk[-1]
+        if len(chunk) > 2 * LOAD:
+            self.chunks[index : index + 1] = [chunk[:LOAD], chunk[LOAD:]]
+            self.lasts.insert(index, chunk[LOAD - 1])
+
+    def remove(self, value):
+        """Removes one copy of value, which must be present."""
+        self.size -= 1
+        self.offsets = None
+        index = bisect_left(self.lasts, value)
+        chunk = self.chunks[index]
+        del chunk[bisect_left(chunk, value)]
+        if chunk:
+            self.lasts[index] = chunk[-1]
+        else:
+            del self.chunks[index]
+            del self.lasts[index]
+
+    def count_below(self, value):
+        """
+        :rtype: int number of values less than value
+        """
+        index = bisect_left(self.lasts, value)
+        if index == len(self.chunks):
+            return self.size
+        offsets = self.offsets
+        if offsets is None:
+            offsets = self.offsets = [0, *accumulate(map(len, self.chunks))]
+        return offsets[index] + bisect_left(self.chunks[index], value)
+
+    def nbytes(self):
+        """
+        :rtype: int bytes held by the chunks and the lists indexing them
+        """
+        lists = (self.chunks, self.lasts, self.offsets or [])
+        return sum(map(sys.getsizeof, self.chunks)) + sum(map(sys.getsizeof, lists))
+
+
+class IntervalCounts:
+    """
+    Sorted begins and ends of a tree's intervals, overall and per name,
+    updated with every interval the tree stores or drops.
+    """
+
+    def __init__(self, intervals=()):
+        """
+        :param intervals: iterable of (begin, end, name) tuples
+        """
+        by_name = {}
+        for begin, end, name in intervals:
+            begins, ends = by_name.setdefault(name, ([], []))
+            begins.append(begin)
+            ends.append(end)
+        self.names = {
+            name: (SortedCounts(begins), SortedCounts(ends))
+            for name, (begins, ends) in by_name.items()
+        }
+        self.begins = SortedCounts(b for begins, _ in by_name.values() for b in begins)
+        self.ends = SortedCounts(e for _, ends in by_name.values() for e in ends)
+        self.unions = {}  # Name to its merged runs, built by coverage() until the name changes
+        self.ordered = None  # Sorted names, rebuilt by names_from() after a name comes or goes
+
+    def add(self, begin, end, name):
+        self.begins.add(begin)
+        self.ends.add(end)
+        counts = self.names.get(name)
+        if counts is None:
+            counts = self.names[name] = (SortedCounts(), SortedCounts())
+            self.ordered = None
+        counts[0].add(begin)
+        counts[1].add(end)
+        self.unions.pop(name, None)
+
+    def remove(self, begin, end, name):
+        self.begins.remove(begin)
+        self.ends.remove(end)
+        begins, ends = self.names[name]
+        begins.remove(begin)
+        ends.remove(end)
+        if not begins:
+            del self.names[name]
+            self.ordered = None
+        self.unions.pop(name, None)
+
+    def nbytes(self):
+        """
+        :rtype: int bytes held by the sorted begins and ends, overall and
+                per name, and by the cached runs, not counting the names
+        """
+        total = self.begins.nbytes() + self.ends.nbytes() + sys.getsizeof(self.names)
+        for counts in self.names.values():
+            total += sys.getsizeof(counts) + counts[0].nbytes() + counts[1].nbytes()
+        total += sys.getsizeof(self.unions) + sys.getsizeof(self.ordered or [])
+        for union in self.unions.values():
+            total += sum(map(sys.getsizeof, union))
+        return total
+
+    def count(self, begin, end):
+        """
+        :rtype: int number of intervals overlapping [begin, end)
+        """
+        if begin >= end:
+            return 0
+        return self.begins.count_below(end) - self.ends.count_below(begin + 1)
+
+    def count_name(self, name, begin, end):
+        """
+        :rtype: int number of intervals named name overlapping [begin, end)
+        """
+        counts = self.names.get(name)
+        if begin >= end or counts is None:
+            return 0
+        begins, ends = counts
+        return begins.count_below(end) - ends.count_below(begin + 1)
+
+    def names_from(self, first):
+        """
+        The first call after a name is added or dropped sorts the names;
+        later ones take a bisect.
+        :rtype: iterator of the stored names from first on, in sorted order
+        """
+        ordered = self.ordered
+        if ordered is None:
+            ordered = self.ordered = sorted(self.names)
+        return (ordered[index] for index in range(bisect_left(ordered, first), len(ordered)))
+
+    def distinct(self, begin, end):
+        """
+        Takes two bisects per name stored, O(names * log n) whatever the
+        range's width.
+        :rtype: int number of names with an interval overlapping [begin, end)
+        """
+        if begin >= end:
+            return 0
+        return sum(
+            begins.count_below(end) > ends.count_below(begin + 1)
+            for begins, ends in self.names.values()
+        )
+
+    def coverage(self, name, begin, end):
+        """
+        The first query after the name changes merges its intervals into
+        runs; later ones take two bisects.
+        :rtype: int length of [begin, end) covered by intervals named name
+        """
+        if begin >= end or name not in self.names:
+            return 0
+        union = self.unions.get(name)
+        if union is None:
+            union = self.unions[name] = merge_runs(*self.names[name])
+        starts, stops, lengths = union
+        first = bisect_right(stops, begin)  # Runs before it end at or before begin
+        last = bisect_left(starts, end)  # Runs from it on begin at or after end
+        if first >= last:
+            return 0
+        covered = lengths[last] - lengths[first]
+        covered -= max(0, begin - starts[first])
+        covered -= max(0, stops[last - 1] - end)
+        return covered
+
+
+def merge_runs(begins, ends):
+    """
+    Merges intervals, given as their sorted begins and sorted ends, into
+    disjoint runs; touching intervals join one run.
+    :rtype: tuple of (run starts, run stops, covered length before each run)
+    """
+    starts, stops = [], []
+    ends = iter(ends)
+    depth = 0
+    stop = next(ends, None)
+    for begin in begins:
+        while stop < begin:
+            depth -= 1
+            if not depth:
+                stops.append(stop)
+            stop = next(ends)
+        if not depth:
+            starts.append(begin)
+        depth += 1
+    for stop in ends:
+        pass  # The last end closes the last run
+    if starts:
+        stops.append(stop)
+    lengths = [0, *accumulate(stop - start for start, stop in zip(starts, stops))]
+    return starts, stops, lengths
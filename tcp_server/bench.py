@@ -0,0 +1,440 @@
+"""
+Load generator and microbenchmarks for nks_server.
+
+    nks_bench load --connections 100 --duration 30 --mix add=10,del=5,find=85
+    nks_bench micro --size 100000
+    nks_bench client --spawn thread --requests 20000
+    nks_bench compare before.json after.json
+
+Every subcommand prints a summary and can save its results as JSON with
+--output, so runs can be compared later.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from threading import Thread
+
+from intervaltree import Interval
+
+from tcp_server.client import Client
+from tcp_server.compact import CompactIntervalTree
+from tcp_server.net import wait_for_port
+from tcp_server.tcp_server import MAX_INT, CustomIntervalTree
+
+COMMANDS = ("add", "del", "find", "range")
+
+
+def percentile(ordered, fraction):
+    """
+    :rtype: float value at fraction (0-1) of an already sorted list
+    """
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+def summarize(latencies):
+    """
+    :rtype: dict of latency statistics in milliseconds
+    """
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1e3 if ordered else 0.0,
+        "p50_ms": percentile(ordered, 0.5) * 1e3,
+        "p99_ms": percentile(ordered, 0.99) * 1e3,
+        "p999_ms": percentile(ordered, 0.999) * 1e3,
+        "max_ms": ordered[-1] * 1e3 if ordered else 0.0,
+    }
+
+
+def parse_mix(text):
+    """
+    Parses "add=10,del=5,find=85" into normalized weights.
+    :rtype: dict of command to weight
+    """
+    mix = {}
+    for part in text.split(","):
+        command, _, weight = part.partition("=")
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {command!r} in mix")
+        mix[command] = float(weight)
+    total = sum(mix.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("mix weights must add up to more than 0")
+    return {command: weight / total for command, weight in mix.items()}
+
+
+class Workload:
+    """
+    Generates random intervals and commands. Interval widths follow the
+    chosen distribution ("fixed", "uniform" up to width or "exponential"
+    with mean width), names are drawn from `names` distinct values.
+    """
+
+    def __init__(self, span, width, distribution, names, mix, seed):
+        self.span = span
+        self.width = width
+        self.distribution = distribution
+        self.names = names
+        self.mix = mix
+        self.rng = random.Random(seed)
+
+    def interval(self):
+        if self.distribution == "fixed":
+            width = self.width
+        elif self.distribution == "uniform":
+            width = self.rng.randint(1, self.width)
+        else:
+            width = max(1, int(self.rng.expovariate(1 / self.width)))
+        begin = self.rng.randrange(0, max(1, self.span - width))
+        return begin, min(begin + width, MAX_INT), f"n{self.rng.randrange(self.names)}"
+
+    def command(self):
+        """
+        :rtype: tuple of (command kind, command line)
+        """
+        kind = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        begin, end, name = self.interval()
+        if kind == "add":
+            return kind, f"ADD {begin} {end} {name}\n"
+        if kind == "del":
+            return kind, f"DEL {begin} {end} {name}\n"
+        if kind == "find":
+            return kind, f"FIND {begin}\n"
+        return kind, f"FIND {begin} {end}\n"
+
+
+async def preload(host, port, workload, size, batch=1000):
+    reader, writer = await asyncio.open_connection(host, port, limit=1 << 24)
+    remaining = size
+    while remaining > 0:
+        count = min(batch, remaining)
+        args = " ".join("%d %d %s" % workload.interval() for _ in range(count))
+        writer.write(str.encode(f"MADD {args}\n"))
+        await writer.drain()
+        await reader.readline()
+        remaining -= count
+    writer.close()
+
+
+async def client(host, port, workload, deadline, latencies):
+    reader, writer = await asyncio.open_connection(host, port, limit=1 << 24)
+    try:
+        while time.perf_counter() < deadline:
+            kind, line = workload.command()
+            start = time.perf_counter()
+            writer.write(str.encode(line))
+            await writer.drain()
+            if not await reader.readline():
+                break
+            latencies[kind].append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run_load(args):
+    mix = parse_mix(args.mix)
+    loader = Workload(args.span, args.width, args.distribution, args.names, mix, args.seed)
+    if args.preload:
+        start = time.perf_counter()
+        await preload(args.host, args.port, loader, args.preload)
+        print(f"preloaded {args.preload} intervals in {time.perf_counter() - start:.1f}s")
+    latencies = {kind: [] for kind in COMMANDS}
+    deadline = time.perf_counter() + args.duration
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            client(
+                args.host,
+                args.port,
+                Workload(args.span, args.width, args.distribution, args.names, mix, args.seed + i),
+                deadline,
+                latencies,
+            )
+            for i in range(args.connections)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    everything = [latency for values in latencies.values() for latency in values]
+    return {
+        "ops": len(everything),
+        "seconds": elapsed,
+        "throughput": len(everything) / elapsed,
+        "latency": summarize(everything),
+        "commands": {kind: summarize(values) for kind, values in latencies.items() if values},
+    }
+
+
+def spawn_server(args):
+    """
+    :rtype: subprocess.Popen of a local server in --spawn mode, or None
+    """
+    if not args.spawn:
+        return None
+    env = dict(os.environ, PORT=str(args.port), SERVER_MODE=args.spawn)
+    server = subprocess.Popen([sys.executable, "-m", "tcp_server.tcp_server"], env=env)
+    wait_for_port(args.host, args.port)
+    return server
+
+
+def load(args):
+    server = spawn_server(args)
+    try:
+        results = asyncio.run(run_load(args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    latency = results["latency"]
+    print(
+        f"{results['ops']} ops in {results['seconds']:.1f}s = {results['throughput']:.0f} ops/s"
+        f"  p50 {latency['p50_ms']:.3f}ms  p99 {latency['p99_ms']:.3f}ms"
+        f"  p999 {latency['p999_ms']:.3f}ms"
+    )
+    for kind, stats in results["commands"].items():
+        print(
+            f"  {kind:6} {stats['count']:8} ops"
+            f"  p50 {stats['p50_ms']:.3f}ms  p99 {stats['p99_ms']:.3f}ms"
+        )
+    return results
+
+
+def naive_requests(host, port, lines):
+    """Sends each line and waits for its reply before sending the next."""
+    with socket.create_connection((host, port)) as sock, sock.makefile("rb") as replies:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for line in lines:
+            sock.sendall(line)
+            replies.readline()
+
+
+def client_call(line):
+    """
+    :param line: a command line made by Workload.command()
+    :rtype: tuple of (name of the Client method sending it, its arguments)
+    """
+    command, *args = line.split()
+    if command == "FIND":
+        return "find", tuple(map(int, args))
+    begin, end, name = args
+    return ("add" if command == "ADD" else "delete"), (int(begin), int(end), name)
+
+
+def pipelined_requests(nks, calls, window):
+    """Sends calls through one pipeline, awaiting them `window` at a time."""
+    pipeline = nks.pipeline()
+    for start in range(0, len(calls), window):
+        for method, call_args in calls[start : start + window]:
+            getattr(pipeline, method)(*call_args)
+        pipeline.execute()
+
+
+def threaded_requests(nks, calls, threads):
+    """Sends blocking calls from `threads` threads sharing the client's pool."""
+
+    def run(part):
+        for method, call_args in part:
+            getattr(nks, method)(*call_args)
+
+    workers = [Thread(target=run, args=(calls[i::threads],)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def client_benchmark(args):
+    """
+    Times the same --mix commands and ADDs sent one request per round
+    trip on a bare socket and through Client, pipelined and from several
+    threads.
+    """
+    mix = parse_mix(args.mix)
+    workload = Workload(args.span, args.width, args.distribution, args.names, mix, args.seed)
+    lines = [workload.command()[1] for _ in range(args.requests)]
+    mix_lines = [str.encode(line) for line in lines]
+    calls = [client_call(line) for line in lines]
+    intervals = [workload.interval() for _ in range(args.requests)]
+    add_lines = [str.encode("ADD %d %d %s\n" % interval) for interval in intervals]
+    server = spawn_server(args)
+    results = {}
+    try:
+        with Client(args.host, args.port, connections=args.connections) as nks:
+            if args.preload:
+                nks.add_many(workload.interval() for _ in range(args.preload))
+            runs = [
+                ("mix_naive", lambda: naive_requests(args.host, args.port, mix_lines)),
+                ("mix_pipelined", lambda: pipelined_requests(nks, calls, args.window)),
+                ("mix_threads", lambda: threaded_requests(nks, calls, args.threads)),
+                ("add_naive", lambda: naive_requests(args.host, args.port, add_lines)),
+                ("add_many", lambda: nks.add_many(intervals)),
+            ]
+            for name, run in runs:
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                results[name] = {"seconds": elapsed, "throughput": args.requests / elapsed}
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    naive = {"mix": results["mix_naive"]["throughput"], "add": results["add_naive"]["throughput"]}
+    for name, stats in results.items():
+        speedup = stats["throughput"] / naive[name.partition("_")[0]]
+        print(f"  {name:15} {stats['throughput']:10.0f} requests/s  {speedup:6.1f}x")
+    return results
+
+
+def time_calls(func, calls):
+    latencies = []
+    for call_args in calls:
+        start = time.perf_counter()
+        func(*call_args)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def micro(args):
+    workload = Workload(args.span, args.width, args.distribution, args.names, {"add": 1}, args.seed)
+    intervals = set()
+    while len(intervals) < args.size:
+        intervals.add(Interval(*workload.interval()))
+    start = time.perf_counter()
+    storage = CompactIntervalTree if args.storage == "compact" else CustomIntervalTree
+    tree = storage(intervals)
+    build = time.perf_counter() - start
+    print(f"built {len(tree)} intervals in {build:.1f}s")
+
+    def ranges(width):
+        return [(b, b + width) for b, _, _ in (workload.interval() for _ in range(args.iterations))]
+
+    def named_ranges(width):
+        samples = (workload.interval() for _ in range(args.iterations))
+        return [(b, b + width, name) for b, _, name in samples]
+
+    points = [(b,) for b, _, _ in (workload.interval() for _ in range(args.iterations))]
+    results = {"build_seconds": build}
+    results["at"] = time_calls(tree.at, points)
+    results["overlap"] = time_calls(tree.overlap, ranges(args.query_width))
+    results["envelop"] = time_calls(tree.envelop, ranges(args.query_width))
+    results["chop"] = time_calls(tree.chop, ranges(args.width))
+    results["chop_named"] = time_calls(tree.chop, named_ranges(args.width))
+    for name, stats in results.items():
+        if name != "build_seconds":
+            print(
+                f"  {name:10} mean {stats['mean_ms']:.3f}ms"
+                f"  p50 {stats['p50_ms']:.3f}ms  p99 {stats['p99_ms']:.3f}ms"
+            )
+    return results
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = flatten(json.load(f)["results"])
+    with open(args.after) as f:
+        after = flatten(json.load(f)["results"])
+    for key in sorted(set(before) & set(after)):
+        ratio = after[key] / before[key] if before[key] else float("inf")
+        print(f"{key:40} {before[key]:14.4f} {after[key]:14.4f} {ratio:8.2f}x")
+
+
+def add_workload_args(parser):
+    parser.add_argument("--span", type=int, default=10000000, help="coordinate space to use")
+    parser.add_argument(
+        "--width", type=int, default=1000, help="interval width (see --distribution)"
+    )
+    parser.add_argument(
+        "--distribution", choices=("fixed", "uniform", "exponential"), default="uniform"
+    )
+    parser.add_argument("--names", type=int, default=100, help="distinct interval names")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save results to this JSON file")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    load_parser = subparsers.add_parser("load", help="drive a running server over TCP")
+    load_parser.add_argument("--host", default="127.0.0.1")
+    load_parser.add_argument("--port", type=int, default=2004)
+    load_parser.add_argument("--connections", type=int, default=50)
+    load_parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    load_parser.add_argument("--preload", type=int, default=0, help="intervals to MADD first")
+    load_parser.add_argument("--mix", default="add=10,del=5,find=80,range=5")
+    load_parser.add_argument(
+        "--spawn", choices=("thread", "async"), help="start a local server in this mode"
+    )
+    add_workload_args(load_parser)
+
+    micro_parser = subparsers.add_parser("micro", help="time the interval tree in-process")
+    micro_parser.add_argument("--storage", choices=("tree", "compact"), default="tree")
+    micro_parser.add_argument("--size", type=int, default=100000, help="intervals in the tree")
+    micro_parser.add_argument("--iterations", type=int, default=1000)
+    micro_parser.add_argument("--query-width", type=int, default=100000)
+    add_workload_args(micro_parser)
+
+    client_parser = subparsers.add_parser(
+        "client", help="compare Client with one request per round trip"
+    )
+    client_parser.add_argument("--host", default="127.0.0.1")
+    client_parser.add_argument("--port", type=int, default=2004)
+    client_parser.add_argument("--requests", type=int, default=20000, help="commands of each kind")
+    client_parser.add_argument("--preload", type=int, default=100000, help="intervals to add first")
+    client_parser.add_argument("--connections", type=int, default=4, help="Client pool size")
+    client_parser.add_argument("--threads", type=int, default=8, help="threads sharing the pool")
+    client_parser.add_argument("--mix", default="find=80,range=20")
+    client_parser.add_argument("--window", type=int, default=1000, help="calls per pipeline wait")
+    client_parser.add_argument(
+        "--spawn", choices=("thread", "async"), help="start a local server in this mode"
+    )
+    add_workload_args(client_parser)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two saved runs")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args(argv)
+    if args.benchmark == "compare":
+        return compare(args)
+    results = {"load": load, "micro": micro, "client": client_benchmark}[args.benchmark](args)
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k != "output"}
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "benchmark": args.benchmark,
+                    "timestamp": time.time(),
+                    "python": platform.python_version(),
+                    "params": params,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Length-prefixed binary protocol, negotiated by sending ``BINARY\\n`` on a
+text connection. Every frame is a big-endian uint32 payload length
+followed by the payload.
+
+Request payloads start with a one-byte opcode:
+  * ADD    begin:u32 end:u32 name_id:u32
+  * DEL    begin:u32 end:u32 name_id:u32 (ANY_NAME deletes every name)
+  * FIND   point:u32
+  * RANGE  begin:u32 end:u32
+  * INTERN name:utf-8 bytes
+  * NAME   name_id:u32
+
+Response payloads start with a one-byte status. OK responses carry
+nothing for ADD/DEL, count:u32 followed by count name_id:u32 (sorted by
+name) for FIND/RANGE, name_id:u32 for INTERN and the utf-8 name for NAME.
+ERROR responses carry a utf-8 message.
+"""
+
+import struct
+
+LENGTH = struct.Struct("!I")
+OPCODE = struct.Struct("!B")
+UINT32 = struct.Struct("!I")
+PAIR = struct.Struct("!II")
+TRIPLE = struct.Struct("!III")
+
+OP_ADD = 1
+OP_DEL = 2
+OP_FIND = 3
+OP_RANGE = 4
+OP_INTERN = 5
+OP_NAME = 6
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+ANY_NAME = 0xFFFFFFFF
+
+
+class NameTable:
+    """
+    Interns names as small integer ids for one connection. Ids are handed
+    out in order and never reused, so a client may cache them until it
+    disconnects; the table goes with the connection, so names that are no
+    longer stored do not pile up across clients.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        """
+        :rtype: int id of name, allocating one if needed
+        """
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def name(self, name_id):
+        """
+        :rtype: str name for name_id, or None if it was never allocated
+        """
+        if 0 <= name_id < len(self.names):
+            return self.names[name_id]
+        return None
+
+    def __len__(self):
+        return len(self.names)
+
+
+def split_frames(buffer, max_size):
+    """
+    Splits complete frames off the front of buffer.
+    :rtype: tuple of (list of payload bytes, remaining bytes), or
+            (payloads, None) once a frame longer than max_size is seen
+    """
+    payloads = []
+    offset = 0
+    while len(buffer) - offset >= LENGTH.size:
+        (length,) = LENGTH.unpack_from(buffer, offset)
+        if length > max_size:
+            return payloads, None
+        start = offset + LENGTH.size
+        if len(buffer) - start < length:
+            break
+        payloads.append(buffer[start : start + length])
+        offset = start + length
+    return payloads, buffer[offset:]
+
+
+def frame(payload):
+    return LENGTH.pack(len(payload)) + payload
+
+
+def ok(body=b""):
+    return frame(OPCODE.pack(STATUS_OK) + body)
+
+
+def error(message):
+    return frame(OPCODE.pack(STATUS_ERROR) + str.encode(message))
+
+
+def encode_ids(ids):
+    return ok(UINT32.pack(len(ids)) + struct.pack(f"!{len(ids)}I", *ids))
+
+
+def request(opcode, *args):
+    """
+    Encodes a request frame; a str argument is sent as utf-8 bytes and
+    every other argument as a uint32.
+    """
+    body = b"".join(str.encode(arg) if isinstance(arg, str) else UINT32.pack(arg) for arg in args)
+    return frame(OPCODE.pack(opcode) + body)
+
+
+def decode_response(payload):
+    """
+    :rtype: tuple of (status, body bytes)
+    """
+    return payload[0], payload[1:]
+
+
+def decode_ids(body):
+    (count,) = UINT32.unpack_from(body)
+    return list(struct.unpack_from(f"!{count}I", body, UINT32.size))
@@ -0,0 +1,94 @@
+"""LRU cache of encoded FIND responses."""
+
+from collections import OrderedDict
+from threading import Lock
+
+from intervaltree import Interval, IntervalTree
+
+
+class FindCache:
+    """
+    Bounded LRU cache of encoded FIND responses keyed by query. Every entry
+    records the coordinate range its response depends on, so a write only
+    evicts the entries whose range overlaps the range it changed.
+
+    Responses computed before a write must not be stored after it, so a
+    reader takes ``generation`` while it still holds the tree's read lock
+    and hands it back to put(); any invalidation in between bumps the
+    generation and the stale response is dropped.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key -> (response, Interval of the range it depends on)
+        self.ranges = IntervalTree()
+        self.lock = Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        :rtype: bytes cached response, or None
+        """
+        if not self.capacity:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, response, begin, end, generation):
+        """Caches response, which depends on [begin, end) of the tree."""
+        if not self.capacity or begin >= end:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old:
+                self.ranges.remove(old[1])
+            span = Interval(begin, end, key)
+            self.entries[key] = (response, span)
+            self.ranges.add(span)
+            while len(self.entries) > self.capacity:
+                _, (_, span) = self.entries.popitem(last=False)
+                self.ranges.remove(span)
+                self.evictions += 1
+
+    def invalidate(self, begin, end):
+        """Evicts every entry depending on part of [begin, end)."""
+        if not self.capacity:
+            return
+        with self.lock:
+            self.generation += 1
+            for span in self.ranges.overlap(begin, end):
+                del self.entries[span.data]
+                self.ranges.remove(span)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.ranges.clear()
+
+    def stats(self):
+        """
+        :rtype: dict of counter name to value
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
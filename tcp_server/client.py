@@ -0,0 +1,574 @@
+"""
+Client library for nks_server.
+
+    with Client("127.0.0.1", 2004) as client:
+        client.add(1, 5, "x")
+        client.find(3)  # ["x"]
+
+Client keeps a thread-safe pool of connections and AsyncClient the same
+for asyncio. Neither waits for a reply before sending the next request:
+each connection keeps a queue of the requests awaiting a reply and a
+reader that matches the server's in-order replies to them, so every
+thread or task sharing a connection has its requests pipelined with the
+others'. Requests queued while one is being sent go out together in the
+next write.
+
+Replies are parsed into Python values. "ERROR no results" becomes an
+empty result and any other error raises ServerError. Arguments the
+server would split differently, such as names holding spaces or
+newlines, raise ValueError before anything is sent.
+"""
+
+import asyncio
+import re
+import socket
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+from intervaltree import Interval
+
+DEFAULT_PORT = 2004
+LINE_LIMIT = 1 << 24  # Longest reply line the asyncio client reads
+BULK_BATCH = 1000  # Intervals per MADD line sent by add_many()
+BULK_WINDOW = 64  # MADD lines add_many() keeps awaiting a reply
+
+NAME = re.compile(r"[a-zA-Z0-9_-]+")  # The characters the server accepts in names
+ARGUMENTS = re.compile(r"[!-~]+(?: [!-~]+)*")  # Printable ASCII, one space between arguments
+
+Page = namedtuple("Page", ["names", "cursor"])  # cursor is None on the last page
+
+
+class ServerError(Exception):
+    """The server answered a request with an error other than "no results"."""
+
+
+def reply_text(line):
+    """
+    :rtype: str reply without its newline, or None for "no results"
+    """
+    text = line.decode("utf-8", errors="replace").rstrip("\n")
+    if text == "ERROR no results":
+        return None
+    if text.startswith("ERROR"):
+        raise ServerError(text[6:])
+    return text
+
+
+def parse_ok(line):
+    reply_text(line)
+
+
+def parse_int(line):
+    return int(reply_text(line))
+
+
+def parse_names(line):
+    """
+    :rtype: list of the names in a FIND reply, duplicates included
+    """
+    text = reply_text(line)
+    return text.split() if text else []
+
+
+def parse_intervals(name):
+    """
+    :rtype: function parsing the begin-end pairs of a named FIND reply
+            into Intervals of name
+    """
+
+    def parse(line):
+        text = reply_text(line)
+        if not text:
+            return []
+        pairs = (pair.split("-") for pair in text.split())
+        return [Interval(int(begin), int(end), name) for begin, end in pairs]
+
+    return parse
+
+
+def parse_page(line):
+    """
+    :rtype: Page of names and the cursor to pass as `after` for the next one
+    """
+    text = reply_text(line)
+    if text is None:
+        return Page([], None)
+    names, _, cursor = text.rpartition(";")
+    return Page(names.split(), cursor or None)
+
+
+def parse_multi(line):
+    """
+    :rtype: list of the names found at each point of an MFIND
+    """
+    return [field.split() for field in reply_text(line).split(";")]
+
+
+def parse_stats(line):
+    """
+    :rtype: dict of STATS field to its int or float value
+    """
+    stats = {}
+    for field in reply_text(line).split():
+        key, _, value = field.partition("=")
+        try:
+            stats[key] = int(value)
+        except ValueError:
+            stats[key] = float(value)
+    return stats
+
+
+def resolve(future, parse, line):
+    try:
+        future.set_result(parse(line))
+    except Exception as error:
+        future.set_exception(error)
+
+
+def batches(intervals, size):
+    """
+    :param intervals: iterable of (begin, end, name) tuples or Intervals
+    :rtype: iterator of MADD lines of up to size intervals each
+    """
+    batch = []
+    for begin, end, name in intervals:
+        batch.append(f"{begin} {end} {name_arg(name)}")
+        if len(batch) == size:
+            yield len(batch), "MADD " + " ".join(batch)
+            batch = []
+    if batch:
+        yield len(batch), "MADD " + " ".join(batch)
+
+
+class Commands:
+    """
+    The server's commands as methods. Each one hands its request line and
+    reply parser to self.call(), which decides whether the caller gets the
+    result, a Future of it or a coroutine.
+    """
+
+    keyspace = None  # Sends every request as "@<keyspace> <request>" when set
+
+    def request(self, parse, *tokens):
+        line = " ".join(map(str, tokens))
+        if ARGUMENTS.fullmatch(line) is None:
+            # A stray space or newline would shift arguments or inject a command
+            raise ValueError(f"invalid arguments {tokens!r}"[:200])
+        if self.keyspace is not None:
+            line = f"@{name_arg(self.keyspace)} {line}"
+        return self.call(parse, str.encode(line + "\n"))
+
+    def add(self, begin, end, name, ttl=None):
+        """Adds [begin, end) named name, removed after ttl seconds if given."""
+        return self.request(parse_ok, "ADD", begin, end, name_arg(name), *ttl_option(ttl))
+
+    def delete(self, begin, end, name=None):
+        names = [name_arg(name)] if name is not None else []
+        return self.request(parse_ok, "DEL", begin, end, *names)
+
+    def madd(self, intervals, ttl=None):
+        """:param intervals: non-empty iterable of (begin, end, name) tuples or Intervals"""
+        args = (f"{b} {e} {name_arg(name)}" for b, e, name in intervals)
+        return self.request(parse_ok, "MADD", *args, *ttl_option(ttl))
+
+    def mdel(self, intervals):
+        """:param intervals: non-empty iterable of (begin, end, name) tuples or Intervals"""
+        args = (f"{b} {e} {name_arg(name)}" for b, e, name in intervals)
+        return self.request(parse_ok, "MDEL", *args)
+
+    def find(self, begin, end=None):
+        """Names of the intervals containing begin, or overlapping [begin, end)."""
+        return self.request(parse_names, "FIND", *point_or_range(begin, end))
+
+    def find_name(self, name, begin, end):
+        """Intervals of name overlapping [begin, end), sorted."""
+        return self.request(parse_intervals(name), "FIND", name_arg(name), begin, end)
+
+    def find_page(self, begin, end=None, limit=1000, after=None):
+        """The first `limit` names of find(begin, end) following the cursor after."""
+        after = ["AFTER", after] if after else []
+        return self.request(parse_page, "FIND", *point_or_range(begin, end), "LIMIT", limit, *after)
+
+    def mfind(self, points):
+        return self.request(parse_multi, "MFIND", *points)
+
+    def count(self, begin, end=None):
+        return self.request(parse_int, "COUNT", *point_or_range(begin, end))
+
+    def distinct(self, begin, end=None):
+        return self.request(parse_int, "DISTINCT", *point_or_range(begin, end))
+
+    def coverage(self, name, begin=None, end=None):
+        return self.request(parse_int, "COVERAGE", name_arg(name), *point_or_range(begin, end))
+
+    def compact(self):
+        return self.request(parse_ok, "COMPACT")
+
+    def flush(self):
+        return self.request(parse_ok, "FLUSH")
+
+    def drop(self):
+        return self.request(parse_ok, "DROP")
+
+    def stats(self):
+        return self.request(parse_stats, "STATS")
+
+
+def name_arg(name):
+    """
+    :rtype: str name, checked to hold only characters the server accepts
+    :raises ValueError: if it holds anything else, such as a space or newline
+    """
+    if NAME.fullmatch(name) is None:
+        raise ValueError(f"invalid name {name!r}: use letters, digits, '-' and '_'")
+    return name
+
+
+def point_or_range(begin, end):
+    return [arg for arg in (begin, end) if arg is not None]
+
+
+def ttl_option(ttl):
+    return [] if ttl is None else ["TTL", ttl]
+
+
+class Connection:
+    """
+    One pipelined connection. Any thread may send requests; a reader
+    thread resolves their Futures as the replies arrive.
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = Lock()
+        self.pending = deque()  # (Future, parser) of each request sent, in order
+        self.outgoing = []  # Request lines queued while another thread is sending
+        self.sending = False
+        self.error = None
+        Thread(target=self.read_replies, daemon=True).start()
+
+    def send(self, line, parse):
+        """
+        Queues a request; the calling thread sends it, along with any
+        queued behind it, unless another thread is already sending.
+        :rtype: Future of the parsed reply
+        """
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                raise ConnectionError(self.error)
+            self.pending.append((future, parse))
+            self.outgoing.append(line)
+            if self.sending:
+                return future
+            self.sending = True
+        while True:
+            with self.lock:
+                if not self.outgoing or self.error is not None:
+                    self.sending = False
+                    return future
+                data = b"".join(self.outgoing)
+                self.outgoing.clear()
+            try:
+                self.sock.sendall(data)
+            except OSError as error:
+                self.fail(str(error))
+
+    def read_replies(self):
+        reason = "server closed the connection"
+        try:
+            with self.sock.makefile("rb") as replies:
+                for line in replies:
+                    future, parse = self.pending.popleft()
+                    resolve(future, parse, line)
+        except (OSError, IndexError) as error:  # IndexError once fail() dropped the requests
+            reason = str(error)
+        self.fail(reason)
+
+    def fail(self, reason):
+        """Closes the connection and fails every request awaiting a reply."""
+        with self.lock:
+            if self.error is None:
+                self.error = reason
+            pending, self.pending = self.pending, deque()
+            self.outgoing.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for future, _ in pending:
+            future.set_exception(ConnectionError(reason))
+
+    def close(self):
+        self.fail("connection closed")
+
+
+class Pipeline(Commands):
+    """
+    Sends each request as soon as it is made, all on one connection, and
+    returns a Future of its result instead of waiting for it.
+    """
+
+    def __init__(self, connection, keyspace=None, timeout=None):
+        self.connection = connection
+        self.keyspace = keyspace
+        self.timeout = timeout
+        self.futures = []
+
+    def call(self, parse, line):
+        future = self.connection.send(line, parse)
+        self.futures.append(future)
+        return future
+
+    def execute(self):
+        """
+        Waits for every request made so far.
+        :rtype: list of their results, in order
+        """
+        futures, self.futures = self.futures, []
+        return [future.result(self.timeout) for future in futures]
+
+
+class Client(Commands):
+    """
+    Thread-safe client keeping up to `connections` connections. Each
+    request goes to the connection with the fewest awaiting a reply; a
+    new connection is only opened while every open one is busy. Methods
+    block until their reply arrives, up to timeout seconds.
+    """
+
+    def __init__(
+        self, host="127.0.0.1", port=DEFAULT_PORT, connections=4, keyspace=None, timeout=None
+    ):
+        self.host = host
+        self.port = port
+        self.size = connections
+        self.keyspace = keyspace
+        self.timeout = timeout
+        self.connections = []
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """
+        Opens connections until the pool is full.
+        :rtype: list of the pool's connections
+        """
+        with self.lock:
+            self.connections = [conn for conn in self.connections if conn.error is None]
+            while len(self.connections) < self.size:
+                self.connections.append(Connection(self.host, self.port, self.timeout))
+            return list(self.connections)
+
+    def connection(self):
+        with self.lock:
+            self.connections = [conn for conn in self.connections if conn.error is None]
+            conn = min(self.connections, key=lambda conn: len(conn.pending), default=None)
+            if conn is None or (conn.pending and len(self.connections) < self.size):
+                conn = Connection(self.host, self.port, self.timeout)
+                self.connections.append(conn)
+            return conn
+
+    def call(self, parse, line):
+        return self.connection().send(line, parse).result(self.timeout)
+
+    def pipeline(self):
+        """:rtype: Pipeline sending requests on one of the pool's connections"""
+        return Pipeline(self.connection(), self.keyspace, self.timeout)
+
+    def add_many(self, intervals, batch=BULK_BATCH, window=BULK_WINDOW, ttl=None):
+        """
+        Adds intervals as MADD lines of `batch` intervals, spread over the
+        pool, keeping up to `window` lines awaiting a reply at a time, each
+        removed after ttl seconds if given.
+        :param intervals: iterable of (begin, end, name) tuples or Intervals
+        :rtype: int intervals added
+        """
+        pipelines = [Pipeline(conn, self.keyspace) for conn in self.connect()]
+        awaiting = deque()
+        added = 0
+        for index, (count, line) in enumerate(batches(intervals, batch)):
+            if len(awaiting) == window:
+                awaiting.popleft().result(self.timeout)
+            pipeline = pipelines[index % len(pipelines)]
+            awaiting.append(pipeline.request(parse_ok, line, *ttl_option(ttl)))
+            added += count
+        for future in awaiting:
+            future.result(self.timeout)
+        return added
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+
+
+class AsyncConnection:
+    """One pipelined asyncio connection; a reader task resolves the replies."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()
+        self.drain_lock = asyncio.Lock()
+        self.error = None
+        self.task = asyncio.ensure_future(self.read_replies())
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+        return cls(reader, writer)
+
+    async def send(self, line, parse):
+        """:rtype: asyncio.Future of the parsed reply"""
+        if self.error is not None:
+            raise ConnectionError(self.error)
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((future, parse))
+        self.writer.write(line)
+        async with self.drain_lock:
+            await self.writer.drain()
+        return future
+
+    async def read_replies(self):
+        reason = "server closed the connection"
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                future, parse = self.pending.popleft()
+                if not future.cancelled():
+                    resolve(future, parse, line)
+        except (OSError, ValueError) as error:
+            reason = str(error)
+        self.fail(reason)
+
+    def fail(self, reason):
+        if self.error is None:
+            self.error = reason
+        pending, self.pending = self.pending, deque()
+        self.writer.close()
+        for future, _ in pending:
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+
+    async def close(self):
+        self.task.cancel()
+        self.fail("connection closed")
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class AsyncPipeline(Commands):
+    """Like Pipeline, but each request returns a coroutine of its asyncio.Future."""
+
+    def __init__(self, connection, keyspace=None):
+        self.connection = connection
+        self.keyspace = keyspace
+        self.futures = []
+
+    async def call(self, parse, line):
+        future = await self.connection.send(line, parse)
+        self.futures.append(future)
+        return future
+
+    async def execute(self):
+        futures, self.futures = self.futures, []
+        return list(await asyncio.gather(*futures))
+
+
+class AsyncClient(Commands):
+    """
+    Client for asyncio code, sharing `connections` connections between
+    the tasks using it. Every method is a coroutine:
+
+        async with AsyncClient("127.0.0.1", 2004) as client:
+            names = await client.find(3)
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, connections=4, keyspace=None):
+        self.host = host
+        self.port = port
+        self.size = connections
+        self.keyspace = keyspace
+        self.connections = []
+        self.opening = None  # Task opening the connections, shared by every caller
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        """Opens the pool's connections, unless they are open already."""
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(self.open_connections())
+        try:
+            await asyncio.shield(self.opening)
+        except Exception:
+            self.opening = None
+            raise
+
+    async def open_connections(self):
+        opens = [AsyncConnection.open(self.host, self.port) for _ in range(self.size)]
+        self.connections = list(await asyncio.gather(*opens))
+
+    async def connection(self):
+        """
+        :rtype: AsyncConnection with the fewest requests awaiting a reply,
+                reopened first if it has failed
+        """
+        await self.connect()
+        index = min(range(self.size), key=lambda i: len(self.connections[i].pending))
+        conn = self.connections[index]
+        if conn.error is not None:
+            conn = await AsyncConnection.open(self.host, self.port)
+            if self.connections[index].error is None:  # Another task reopened it first
+                await conn.close()
+                return self.connections[index]
+            self.connections[index] = conn
+        return conn
+
+    async def call(self, parse, line):
+        conn = await self.connection()
+        return await (await conn.send(line, parse))
+
+    async def pipeline(self):
+        """:rtype: AsyncPipeline sending requests on one of the pool's connections"""
+        return AsyncPipeline(await self.connection(), self.keyspace)
+
+    async def add_many(self, intervals, batch=BULK_BATCH, window=BULK_WINDOW, ttl=None):
+        """Like Client.add_many()."""
+        await self.connect()
+        pipelines = [AsyncPipeline(conn, self.keyspace) for conn in self.connections]
+        awaiting = deque()
+        added = 0
+        for index, (count, line) in enumerate(batches(intervals, batch)):
+            if len(awaiting) == window:
+                await awaiting.popleft()
+            pipeline = pipelines[index % len(pipelines)]
+            awaiting.append(await pipeline.request(parse_ok, line, *ttl_option(ttl)))
+            added += count
+        await asyncio.gather(*awaiting)
+        return added
+
+    async def close(self):
+        connections, self.connections = self.connections, []
+        self.opening = None
+        for conn in connections:
+            await conn.close()
@@ -0,0 +1,451 @@
+"""
+Array-backed interval storage for very large trees.
+
+CustomIntervalTree keeps an Interval, a tree node entry, boundary table
+entries and a per-name index entry for every interval, over a kilobyte
+each. CompactIntervalTree keeps the same intervals as 12-byte records:
+sorted chunks of ``begin << 32 | end`` keys in an array('Q') next to an
+array('I') of interned name ids. Interval objects, and with them the name
+strings, are only built for the intervals a query returns. The
+IntervalCounts behind COUNT, DISTINCT and COVERAGE add 16 bytes per
+interval.
+"""
+
+import heapq
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from intervaltree import Interval, IntervalTree
+
+from tcp_server.aggregate import IntervalCounts
+from tcp_server.binary import NameTable
+from tcp_server.expiry import Expiry, carried_deadlines
+
+CHUNK_SIZE = 128  # Records per chunk; chunks are split at twice this
+MASK = 0xFFFFFFFF
+
+
+def max_end(keys):
+    return max(key & MASK for key in keys)
+
+
+class CompactIntervalTree:
+    """
+    Set of Intervals with 32-bit bounds stored as records sorted by
+    (begin, end, name id) in chunks of at most 2 * CHUNK_SIZE. Alongside
+    the chunks, `firsts` holds each chunk's first packed record and `spans` is a
+    segment tree over each chunk's largest end, so a query only scans the
+    chunks that hold an interval beginning before the query's end and
+    ending after its begin.
+    """
+
+    def __init__(self, intervals=None):
+        self.names = NameTable()
+        self.name_counts = {}  # Name id to number of intervals with that name
+        self.expiry = Expiry()
+        self._build(sorted(self._pack(iv) for iv in intervals or ()))
+
+    def _pack(self, interval):
+        """
+        :rtype: int record as begin << 64 | end << 32 | name id, which
+                sorts in the same order as the chunks
+        """
+        return (interval.begin << 64) | (interval.end << 32) | self.names.intern(interval.data)
+
+    def _records(self):
+        """
+        :rtype: iterator of the packed records in order, unaffected by a
+                later _build()
+        """
+        chunks = zip(self.keys, self.ids)
+        return ((key << 32) | name_id for keys, ids in chunks for key, name_id in zip(keys, ids))
+
+    def _build(self, records):
+        """Rebuilds the chunks from packed records in sorted order, skipping repeats."""
+        self.keys = []
+        self.ids = []
+        self.name_counts.clear()
+        batch = []
+        previous = None
+        for record in records:
+            if record == previous:
+                continue
+            previous = record
+            batch.append(record)
+            if len(batch) == CHUNK_SIZE:
+                self._append_chunk(batch)
+                batch = []
+        if batch:
+            self._append_chunk(batch)
+        self.firsts = [(keys[0] << 32) | ids[0] for keys, ids in zip(self.keys, self.ids)]
+        self.max_ends = [max_end(keys) for keys in self.keys]
+        self.size = sum(map(len, self.keys))
+        self._rebuild_spans()
+        names = self.names.names
+        self.counts = IntervalCounts(
+            (record >> 64, (record >> 32) & MASK, names[record & MASK])
+            for record in self._records()
+        )
+
+    def _append_chunk(self, records):
+        self.keys.append(array("Q", [record >> 32 for record in records]))
+        ids = array("I", [record & MASK for record in records])
+        self.ids.append(ids)
+        counts = self.name_counts
+        for name_id in ids:
+            counts[name_id] = counts.get(name_id, 0) + 1
+
+    def _rebuild_spans(self):
+        capacity = 1
+        while capacity < len(self.keys):
+            capacity *= 2
+        spans = [0] * (2 * capacity)
+        spans[capacity : capacity + len(self.max_ends)] = self.max_ends
+        for node in range(capacity - 1, 0, -1):
+            spans[node] = max(spans[2 * node], spans[2 * node + 1])
+        self.capacity = capacity
+        self.spans = spans
+
+    def _update_span(self, chunk):
+        spans = self.spans
+        node = self.capacity + chunk
+        spans[node] = self.max_ends[chunk]
+        node //= 2
+        while node:
+            spans[node] = max(spans[2 * node], spans[2 * node + 1])
+            node //= 2
+
+    def _reaching(self, begin, stop):
+        """
+        :rtype: list of the chunks before stop holding an interval that
+                ends after begin, in order
+        """
+        spans = self.spans
+        capacity = self.capacity
+        chunks = []
+        pending = [(1, 0, capacity)]
+        while pending:
+            node, low, width = pending.pop()
+            if low >= stop or spans[node] <= begin:
+                continue
+            if node >= capacity:
+                chunks.append(node - capacity)
+                continue
+            width //= 2
+            pending.append((2 * node + 1, low + width, width))
+            pending.append((2 * node, low, width))
+        return chunks
+
+    def _scan(self, begin, end):
+        """
+        Yields the (key, name id) records overlapping [begin, end).
+        :rtype: iterator of tuple
+        """
+        if begin >= end or not self.keys:
+            return
+        limit = end << 32  # Keys below it begin before end
+        stop = bisect_left(self.firsts, limit << 32)
+        for chunk in self._reaching(begin, stop):
+            keys, ids = self.keys[chunk], self.ids[chunk]
+            if chunk == stop - 1:
+                cut = bisect_left(keys, limit)
+                keys, ids = keys[:cut], ids[:cut]
+            for key, name_id in zip(keys, ids):
+                if key & MASK > begin:
+                    yield key, name_id
+
+    def _find(self, key, name_id):
+        """
+        :rtype: tuple of (chunk, position) of the record, or None
+        """
+        if not self.keys:
+            return None
+        chunk, position = self._position(key, name_id)
+        keys, ids = self.keys[chunk], self.ids[chunk]
+        if position < len(keys) and keys[position] == key and ids[position] == name_id:
+            return chunk, position
+        return None
+
+    def _position(self, key, name_id):
+        """
+        :rtype: tuple of (chunk, position) where the record belongs
+        """
+        chunk = max(bisect_right(self.firsts, (key << 32) | name_id) - 1, 0)
+        keys, ids = self.keys[chunk], self.ids[chunk]
+        position = bisect_left(keys, key)
+        while position < len(keys) and keys[position] == key and ids[position] < name_id:
+            position += 1
+        return chunk, position
+
+    def _insert(self, key, name_id):
+        if not self.keys:
+            self._build([(key << 32) | name_id])
+            return
+        chunk, position = self._position(key, name_id)
+        keys, ids = self.keys[chunk], self.ids[chunk]
+        if position < len(keys) and keys[position] == key and ids[position] == name_id:
+            return
+        keys.insert(position, key)
+        ids.insert(position, name_id)
+        if position == 0:
+            self.firsts[chunk] = (key << 32) | name_id
+        if key & MASK > self.max_ends[chunk]:
+            self.max_ends[chunk] = key & MASK
+            self._update_span(chunk)
+        self.size += 1
+        self.name_counts[name_id] = self.name_counts.get(name_id, 0) + 1
+        self.counts.add(key >> 32, key & MASK, self.names.names[name_id])
+        if len(keys) > 2 * CHUNK_SIZE:
+            self._split(chunk)
+
+    def _split(self, chunk):
+        keys, ids = self.keys[chunk], self.ids[chunk]
+        half = len(keys) // 2
+        self.keys[chunk : chunk + 1] = [keys[:half], keys[half:]]
+        self.ids[chunk : chunk + 1] = [ids[:half], ids[half:]]
+        self.firsts.insert(chunk + 1, (keys[half] << 32) | ids[half])
+        self.max_ends[chunk : chunk + 1] = [max_end(keys[:half]), max_end(keys[half:])]
+        self._rebuild_spans()
+
+    def _remove(self, chunk, position):
+        keys, ids = self.keys[chunk], self.ids[chunk]
+        key = keys.pop(position)
+        name_id = ids.pop(position)
+        self.counts.remove(key >> 32, key & MASK, self.names.names[name_id])
+        if self.expiry.deadlines:
+            self.expiry.discard(self._interval(key, name_id))
+        self.size -= 1
+        self.name_counts[name_id] -= 1
+        if not self.name_counts[name_id]:
+            del self.name_counts[name_id]
+        if not self.size:
+            self._build([])
+            return
+        if len(keys) < CHUNK_SIZE // 4 and len(self.keys) > 1:
+            # Join sparse chunks so deletes cannot leave thousands of tiny ones behind
+            if chunk == len(self.keys) - 1:
+                chunk -= 1
+            self._merge(chunk)
+            return
+        if position == 0:
+            self.firsts[chunk] = (keys[0] << 32) | ids[0]
+        if key & MASK == self.max_ends[chunk]:
+            self.max_ends[chunk] = max_end(keys)
+            self._update_span(chunk)
+
+    def _merge(self, chunk):
+        """Joins chunk with the one after it, splitting again if too large."""
+        self.keys[chunk].extend(self.keys.pop(chunk + 1))
+        self.ids[chunk].extend(self.ids.pop(chunk + 1))
+        del self.firsts[chunk + 1]
+        del self.max_ends[chunk + 1]
+        self.firsts[chunk] = (self.keys[chunk][0] << 32) | self.ids[chunk][0]
+        self.max_ends[chunk] = max_end(self.keys[chunk])
+        if len(self.keys[chunk]) > 2 * CHUNK_SIZE:
+            self._split(chunk)
+        else:
+            self._rebuild_spans()
+
+    def _interval(self, key, name_id):
+        return Interval(key >> 32, key & MASK, self.names.names[name_id])
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for keys, ids in zip(self.keys, self.ids):
+            for key, name_id in zip(keys, ids):
+                yield self._interval(key, name_id)
+
+    def __eq__(self, other):
+        if not isinstance(other, (CompactIntervalTree, IntervalTree)):
+            return NotImplemented
+        return len(self) == len(other) and set(self) == set(other)
+
+    def __contains__(self, interval):
+        name_id = self.names.ids.get(interval.data)
+        if name_id is None:
+            return False
+        return self._find((interval.begin << 32) | interval.end, name_id) is not None
+
+    def __setitem__(self, index, value):
+        self.add(Interval(index.start, index.stop, value))
+
+    def add(self, interval):
+        if interval.begin >= interval.end:
+            raise ValueError(f"null interval {interval} not allowed")
+        self._insert((interval.begin << 32) | interval.end, self.names.intern(interval.data))
+
+    append = add
+
+    def discard(self, interval):
+        name_id = self.names.ids.get(interval.data)
+        if name_id is None:
+            return
+        found = self._find((interval.begin << 32) | interval.end, name_id)
+        if found:
+            self._remove(*found)
+
+    def remove(self, interval):
+        if interval not in self:
+            raise ValueError
+        self.discard(interval)
+
+    def bulk_update(self, intervals):
+        """
+        Adds many intervals at once. A batch of at least an eighth of the
+        tree is sorted and merged with the existing records in one pass,
+        which only needs memory for the batch and the new chunks.
+        """
+        records = sorted(self._pack(iv) for iv in intervals)
+        if len(records) * 8 < len(self):
+            for record in records:
+                self._insert(record >> 32, record & MASK)
+            return
+        self._build(heapq.merge(self._records(), records))
+
+    def iter_overlap(self, begin, end):
+        """
+        Yields the intervals overlapping [begin, end) one at a time.
+        :rtype: iterator of Interval
+        """
+        for key, name_id in self._scan(begin, end):
+            yield self._interval(key, name_id)
+
+    def at(self, point):
+        return set(self.iter_overlap(point, point + 1))
+
+    def overlap(self, begin, end=None):
+        if end is None:
+            begin, end = begin.begin, begin.end
+        return set(self.iter_overlap(begin, end))
+
+    def overlap_name(self, data, begin, end):
+        """
+        Returns the set of intervals named data overlapping [begin, end).
+        Unlike CustomIntervalTree there is no per-name index, so the other
+        names' records in range are scanned too.
+        :rtype: set of Interval
+        """
+        wanted = self.names.ids.get(data)
+        if wanted is None:
+            return set()
+        return {
+            self._interval(key, name_id)
+            for key, name_id in self._scan(begin, end)
+            if name_id == wanted
+        }
+
+    def envelop(self, begin, end=None, data=None):
+        """
+        Returns the set of all intervals fully contained in [begin, end),
+        only those named data if it is given.
+        :rtype: set of Interval
+        """
+        if end is None:
+            begin, end = begin.begin, begin.end
+        return {
+            iv
+            for iv in self.iter_overlap(begin, end)
+            if iv.begin >= begin and iv.end <= end and (data is None or iv.data == data)
+        }
+
+    def chop(self, begin, end, data=None):
+        """
+        With data, removes the parts of intervals named data lying in
+        [begin, end), trimming back those hanging into it. Without, removes
+        the intervals lying entirely in [begin, end).
+        """
+        begin = int(begin)
+        end = int(end)
+        wanted = self.names.ids.get(data) if data else None
+        if data and wanted is None:
+            return
+        if wanted is None:
+            hits = [
+                (key, name_id)
+                for key, name_id in self._scan(begin, end)
+                if key >> 32 >= begin and key & MASK <= end
+            ]
+        else:
+            hits = [(key, name_id) for key, name_id in self._scan(begin, end) if name_id == wanted]
+        deadlines = {}
+        if self.expiry.deadlines:
+            deadlines = {hit: self.expiry.get(self._interval(*hit)) for hit in hits}
+        pieces = {}  # Trimmed piece to the deadlines of the records it was cut from
+        for key, name_id in hits:
+            deadline = deadlines.get((key, name_id))
+            if key >> 32 < begin:
+                pieces.setdefault(((key >> 32 << 32) | begin, name_id), []).append(deadline)
+            if key & MASK > end:
+                pieces.setdefault(((end << 32) | (key & MASK), name_id), []).append(deadline)
+        for key, name_id in hits:
+            self._remove(*self._find(key, name_id))
+        expiring = {}
+        if deadlines:
+            trimmed = {self._interval(*piece): ds for piece, ds in pieces.items()}
+            expiring = carried_deadlines(self, trimmed)
+        for key, name_id in pieces:
+            self._insert(key, name_id)
+        for iv, deadline in expiring.items():
+            self.expiry.set(iv, deadline)
+
+    def copy_intervals(self):
+        """
+        Copies the records, which is much cheaper than building Interval
+        objects for them.
+        :rtype: CompactIntervals unaffected by later changes to the tree
+        """
+        return CompactIntervals(
+            [keys[:] for keys in self.keys], [ids[:] for ids in self.ids], self.names.names
+        )
+
+    def nbytes(self):
+        """
+        :rtype: int bytes held by the chunks, the indexes over them and
+                the counts, not counting the name strings
+        """
+        chunks = sum(map(sys.getsizeof, self.keys)) + sum(map(sys.getsizeof, self.ids))
+        lists = (self.keys, self.ids, self.firsts, self.max_ends, self.spans)
+        return chunks + sum(map(sys.getsizeof, lists)) + self.counts.nbytes()
+
+    def verify(self):
+        """
+        ## FOR DEBUGGING ONLY ##
+        Checks the chunks are sorted, distinct and indexed correctly.
+        """
+        records = list(self._records())
+        assert records == sorted(set(records)) and len(records) == self.size
+        assert all(0 < len(keys) <= 2 * CHUNK_SIZE for keys in self.keys)
+        assert self.firsts == [(keys[0] << 32) | ids[0] for keys, ids in zip(self.keys, self.ids)]
+        assert self.max_ends == [max_end(keys) for keys in self.keys]
+        spans = self.spans
+        self._rebuild_spans()
+        assert spans == self.spans
+        counts = {}
+        for name_id in (record & MASK for record in records):
+            counts[name_id] = counts.get(name_id, 0) + 1
+        assert counts == self.name_counts
+        assert list(self.counts.begins) == sorted(record >> 64 for record in records)
+        assert list(self.counts.ends) == sorted((record >> 32) & MASK for record in records)
+        assert len(self.counts.names) == len(self.name_counts)
+        assert all(iv in self for iv in self.expiry.deadlines)
+
+
+class CompactIntervals:
+    """Intervals copied out of a CompactIntervalTree, built as they are iterated."""
+
+    def __init__(self, keys, ids, names):
+        self.keys = keys
+        self.ids = ids
+        self.names = names  # Append-only, so ids stay valid as the tree interns new names
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys)
+
+    def __iter__(self):
+        names = self.names
+        for keys, ids in zip(self.keys, self.ids):
+            for key, name_id in zip(keys, ids):
+                yield Interval(key >> 32, key & MASK, names[name_id])
@@ -0,0 +1,117 @@
+"""
+Deadlines of the intervals added with a TTL.
+
+Every tree holds an Expiry mapping each of its expiring intervals to its
+deadline, in milliseconds since the epoch, next to a heap of
+(deadline, begin, end, name) entries ordered soonest first. Removing an
+interval only drops its mapping; its heap entry goes stale and is skipped
+when it reaches the top, and the heap is rebuilt once stale entries
+outnumber live ones. Ties are broken by the interval itself, so the same
+sequence of writes always expires the same intervals, whichever server
+applies it.
+"""
+
+import heapq
+
+from intervaltree import Interval
+
+
+def combined(deadlines):
+    """
+    :param deadlines: deadlines of intervals merged into one, None for an
+                      interval that never expires
+    :rtype: int latest of the deadlines, or None if any interval never expires
+    """
+    deadlines = list(deadlines)
+    if None in deadlines:
+        return None
+    return max(deadlines)
+
+
+def carried_deadlines(tree, pieces):
+    """
+    Pieces trimmed off intervals keep their deadlines; a piece already in
+    tree also keeps its own.
+    :param pieces: dict of each piece to the deadlines of the intervals it
+                   was cut from
+    :rtype: dict of piece to its deadline, empty if none of them expire
+    """
+    if not any(d is not None for deadlines in pieces.values() for d in deadlines):
+        return {}
+    return {
+        iv: combined(deadlines + [tree.expiry.get(iv)] if iv in tree else deadlines)
+        for iv, deadlines in pieces.items()
+    }
+
+
+class Expiry:
+    """Deadline of every expiring interval of a tree, soonest first."""
+
+    def __init__(self):
+        self.deadlines = {}
+        self.heap = []
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def get(self, interval):
+        """:rtype: int deadline of interval, or None if it never expires"""
+        return self.deadlines.get(interval)
+
+    def set(self, interval, deadline):
+        """Makes interval expire at deadline, or never if deadline is None."""
+        if deadline is None:
+            self.deadlines.pop(interval, None)
+            return
+        if self.deadlines.get(interval) == deadline:
+            return
+        self.deadlines[interval] = deadline
+        heapq.heappush(self.heap, (deadline, interval.begin, interval.end, interval.data))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, iv.begin, iv.end, iv.data) for iv, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def discard(self, interval):
+        self.deadlines.pop(interval, None)
+
+    def update(self, deadlines):
+        """:param deadlines: dict of Interval to deadline"""
+        for interval, deadline in deadlines.items():
+            self.set(interval, deadline)
+
+    def next_deadline(self):
+        """
+        Safe to call without the tree's lock; the answer may be stale.
+        :rtype: int deadline at the top of the heap, or None if it is empty
+        """
+        top = self.heap[:1]
+        return top[0][0] if top else None
+
+    def pop_due(self, now, limit):
+        """
+        Forgets up to limit intervals whose deadline is at or before now.
+        :rtype: list of Interval, soonest first
+        """
+        return self._pop(limit, now)
+
+    def pop_soonest(self, count):
+        """
+        Forgets the count intervals expiring soonest, or every one if
+        there are fewer.
+        :rtype: list of Interval, soonest first
+        """
+        return self._pop(count, None)
+
+    def _pop(self, limit, now):
+        popped = []
+        heap = self.heap
+        while heap and len(popped) < limit:
+            deadline, begin, end, name = heap[0]
+            if now is not None and deadline > now:
+                break
+            heapq.heappop(heap)
+            interval = Interval(begin, end, name)
+            if self.deadlines.get(interval) == deadline:
+                del self.deadlines[interval]
+                popped.append(interval)
+        return popped
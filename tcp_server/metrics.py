@@ -0,0 +1,220 @@
+"""Low-overhead counters, latency histograms and gauges for nks_server."""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+
+BUCKETS = 32  # Bucket i counts latencies of [2**(i-1), 2**i) microseconds
+
+
+class Histogram:
+    """
+    Latency histogram with power-of-two microsecond buckets. Recording is
+    a multiply, a bit_length() and two additions under a lock, which keeps
+    it cheap enough to leave on for every command.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0.0
+        self.lock = Lock()
+
+    def record(self, seconds):
+        index = min(int(seconds * 1e6).bit_length(), BUCKETS - 1)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+        """
+        :rtype: float upper bound, in seconds, of the bucket holding the
+                given quantile
+        """
+        counts = list(self.counts)
+        target = fraction * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return bucket_bound(index)
+        return 0.0
+
+
+class CommandStats(Histogram):
+    """Call and error counts plus a latency histogram for one command."""
+
+    def __init__(self):
+        Histogram.__init__(self)
+        self.calls = 0
+        self.errors = 0
+
+    def record_call(self, seconds, error):
+        with self.lock:
+            self.calls += 1
+            if error:
+                self.errors += 1
+            if seconds is not None:
+                self.counts[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+                self.total += seconds
+
+
+def bucket_bound(index):
+    return (1 << index) / 1e6
+
+
+class Metrics:
+    """
+    Per-command counts, error counts and latency histograms, plus gauges
+    read from registered callables when a report is built.
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.families = {}  # Gauge name to its Prometheus metric and labels, if it has labels
+        self.lock = Lock()
+        self.connections = 0
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def record(self, command, seconds=None, error=False):
+        """Counts one command and, if it ran, records how long it took."""
+        stats = self.commands.get(command)
+        if stats is None:
+            with self.lock:
+                stats = self.commands.setdefault(command, CommandStats())
+        stats.record_call(seconds, error)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def register_gauge(self, name, func, family=None, labels=None):
+        """
+        :param family: metric the gauge belongs to in the Prometheus format,
+                       told apart from the others in it by labels, a dict;
+                       a metric of its own named after name if not given
+        """
+        if family is not None:
+            self.families[name] = (family, labels)
+        self.gauges[name] = func
+
+    def unregister_gauge(self, name):
+        self.gauges.pop(name, None)
+        self.families.pop(name, None)
+
+    def read_gauges(self):
+        values = {"connections": self.connections}
+        for name, func in list(self.gauges.items()):
+            values[name] = func()
+        return values
+
+    def format_stats(self):
+        """
+        :rtype: str single line of space-separated key=value pairs
+        """
+        fields = [f"{name}={value}" for name, value in self.read_gauges().items()]
+        for command, stats in sorted(self.commands.items()):
+            fields.append(f"commands.{command}={stats.calls}")
+            if stats.errors:
+                fields.append(f"errors.{command}={stats.errors}")
+        for name, count in sorted(self.counters.items()):
+            fields.append(f"{name}={count}")
+        for name, histogram in self.latencies():
+            if not histogram.count():
+                continue
+            for label, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+                fields.append(f"{name}.{label}_us={histogram.quantile(fraction) * 1e6:.0f}")
+        return " ".join(fields)
+
+    def latencies(self):
+        """
+        :rtype: list of (name, Histogram), per-command ones named perform.<command>
+        """
+        named = [(f"perform.{command}", stats) for command, stats in self.commands.items()]
+        return sorted(named + list(self.histograms.items()))
+
+    def format_prometheus(self):
+        """
+        :rtype: str report in the Prometheus text exposition format
+        """
+        lines = ["# TYPE nks_commands_total counter"]
+        for command, stats in sorted(self.commands.items()):
+            lines.append(f'nks_commands_total{{command="{command}"}} {stats.calls}')
+        lines.append("# TYPE nks_command_errors_total counter")
+        for command, stats in sorted(self.commands.items()):
+            lines.append(f'nks_command_errors_total{{command="{command}"}} {stats.errors}')
+        for name, count in sorted(self.counters.items()):
+            metric = "nks_" + name.replace(".", "_") + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {count}")
+        lines.append("# TYPE nks_latency_seconds histogram")
+        for name, histogram in self.latencies():
+            counts = list(histogram.counts)
+            cumulative = 0
+            for index, count in enumerate(counts):
+                cumulative += count
+                bound = f"{bucket_bound(index):g}"
+                lines.append(f'nks_latency_seconds_bucket{{op="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'nks_latency_seconds_bucket{{op="{name}",le="+Inf"}} {cumulative}')
+            lines.append(f'nks_latency_seconds_sum{{op="{name}"}} {histogram.total}')
+            lines.append(f'nks_latency_seconds_count{{op="{name}"}} {cumulative}')
+        families = {}
+        for name, value in self.read_gauges().items():
+            family, labels = self.families.get(name, (name, None))
+            families.setdefault(family, []).append((labels, value))
+        for family, samples in families.items():
+            metric = "nks_" + family.replace(".", "_")
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, value in samples:
+                if labels:
+                    pairs = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                    lines.append(f"{metric}{{{pairs}}} {value}")
+                else:
+                    lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_prometheus(metrics, host, port):
+    """
+    Serves metrics.format_prometheus() over HTTP from a daemon thread.
+    :rtype: HTTPServer
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = str.encode(metrics.format_prometheus())
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,16 @@
+"""Socket helpers shared by the server's process managers and tools."""
+
+import socket
+import time
+
+
+def wait_for_port(host, port, timeout=10.0):
+    """Waits until something accepts connections on host:port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server on {host}:{port} did not start")
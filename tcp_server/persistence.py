@@ -0,0 +1,242 @@
+"""Write-ahead log and snapshot files for the interval tree."""
+
+import os
+import re
+import struct
+import time
+from threading import Lock
+
+from intervaltree import Interval
+from loguru import logger
+
+SNAPSHOT_MAGIC = b"NKSNAP1\0"
+SNAPSHOT_HEADER = struct.Struct("<8sQI")  # magic, first WAL segment to replay, name count
+NAME_LENGTH = struct.Struct("<H")
+INTERVAL_COUNT = struct.Struct("<Q")
+INTERVAL_RECORD = struct.Struct("<III")  # begin, end, name id
+DEADLINE_RECORD = struct.Struct("<QQ")  # index of an expiring interval, deadline in ms
+SEGMENT_PATTERN = re.compile(r"^wal-(\d{20})\.log$")
+SNAPSHOT_PATTERN = re.compile(r"^snapshot-(\d{20})\.bin$")
+KEYSPACES_DIR = "keyspaces"  # Holds a directory of snapshots per named keyspace
+
+
+def segment_path(directory, seq):
+    return os.path.join(directory, f"wal-{seq:020d}.log")
+
+
+def snapshot_path(directory, seq):
+    return os.path.join(directory, f"snapshot-{seq:020d}.bin")
+
+
+def keyspace_directory(directory, name):
+    return os.path.join(directory, KEYSPACES_DIR, name)
+
+
+def list_keyspaces(directory):
+    """
+    :rtype: list of the names of the keyspaces snapshotted in directory
+    """
+    root = os.path.join(directory, KEYSPACES_DIR)
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.listdir(root))
+
+
+def list_files(directory, pattern):
+    """
+    Returns the sequence numbers of the files in directory matching
+    pattern, in ascending order.
+    """
+    if not os.path.isdir(directory):
+        return []
+    matches = (pattern.match(name) for name in os.listdir(directory))
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of applied write commands, one command per line.
+    The log is split into numbered segments; a snapshot tagged with
+    segment N covers every command logged before segment N, so recovery
+    only needs to replay segments N and later. Lines are flushed and
+    fsynced once fsync_batch commands have been appended or fsync_interval
+    seconds have passed since the last sync, whichever happens first.
+    """
+
+    def __init__(self, directory, fsync_batch=64, fsync_interval=1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.lock = Lock()
+        segments = list_files(directory, SEGMENT_PATTERN)
+        self.seq = segments[-1] + 1 if segments else 1
+        self.file = open(segment_path(directory, self.seq), "ab")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.appended = 0  # Commands appended since the log was opened
+
+    def append(self, command):
+        with self.lock:
+            self.file.write(str.encode(command + "\n"))
+            self.unsynced += 1
+            self.appended += 1
+            if (
+                self.unsynced >= self.fsync_batch
+                or time.monotonic() - self.last_sync >= self.fsync_interval
+            ):
+                self._sync()
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def rotate(self):
+        """
+        Closes the current segment and starts the next one.
+        :rtype: int sequence number of the new segment
+        """
+        with self.lock:
+            self._sync()
+            self.file.close()
+            self.seq += 1
+            self.file = open(segment_path(self.directory, self.seq), "ab")
+            return self.seq
+
+    def prune(self, seq):
+        """
+        Deletes segments and snapshots, including keyspace snapshots,
+        superseded by the snapshot tagged seq. The directory of a keyspace
+        left without snapshots, because it was dropped, goes too.
+        """
+        for old in list_files(self.directory, SEGMENT_PATTERN):
+            if old < seq:
+                os.remove(segment_path(self.directory, old))
+        names = list_keyspaces(self.directory)
+        directories = [keyspace_directory(self.directory, name) for name in names]
+        for directory in [self.directory, *directories]:
+            for old in list_files(directory, SNAPSHOT_PATTERN):
+                if old < seq:
+                    os.remove(snapshot_path(directory, old))
+        for directory in directories:
+            if not os.listdir(directory):
+                os.rmdir(directory)
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+
+def write_snapshot(directory, seq, intervals, deadlines=None):
+    """
+    Writes intervals to a snapshot tagged with WAL segment seq, followed
+    by the deadlines of those that expire. The file is written to a
+    temporary name and renamed into place, so a crash never leaves a
+    partial snapshot behind.
+    :param deadlines: dict of each expiring Interval to its deadline
+    :rtype: str path of the snapshot
+    """
+    name_ids = {}
+    records = []
+    expiring = []
+    for index, iv in enumerate(intervals):
+        name_id = name_ids.setdefault(iv.data, len(name_ids))
+        records.append(INTERVAL_RECORD.pack(iv.begin, iv.end, name_id))
+        if deadlines and iv in deadlines:
+            expiring.append(DEADLINE_RECORD.pack(index, deadlines[iv]))
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory, seq)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, seq, len(name_ids)))
+        for name in name_ids:
+            encoded = str.encode(name)
+            f.write(NAME_LENGTH.pack(len(encoded)))
+            f.write(encoded)
+        f.write(INTERVAL_COUNT.pack(len(records)))
+        f.write(b"".join(records))
+        f.write(INTERVAL_COUNT.pack(len(expiring)))
+        f.write(b"".join(expiring))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_snapshot(path):
+    """
+    Reads a snapshot written by write_snapshot().
+    :rtype: tuple of (list of Interval, int first WAL segment to replay,
+            dict of expiring Interval to its deadline)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, seq, name_count = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a snapshot file")
+    offset = SNAPSHOT_HEADER.size
+    names = []
+    for _ in range(name_count):
+        (length,) = NAME_LENGTH.unpack_from(data, offset)
+        offset += NAME_LENGTH.size
+        names.append(data[offset : offset + length].decode("utf-8"))
+        offset += length
+    (count,) = INTERVAL_COUNT.unpack_from(data, offset)
+    offset += INTERVAL_COUNT.size
+    end = offset + count * INTERVAL_RECORD.size
+    intervals = [
+        Interval(begin, stop, names[name_id])
+        for begin, stop, name_id in INTERVAL_RECORD.iter_unpack(data[offset:end])
+    ]
+    deadlines = {}
+    if end < len(data):  # Snapshots written before TTLs end here
+        (count,) = INTERVAL_COUNT.unpack_from(data, end)
+        offset = end + INTERVAL_COUNT.size
+        records = data[offset : offset + count * DEADLINE_RECORD.size]
+        deadlines = {intervals[i]: deadline for i, deadline in DEADLINE_RECORD.iter_unpack(records)}
+    return intervals, seq, deadlines
+
+
+def load_latest_snapshot(directory):
+    """
+    :rtype: tuple of (list of Interval, int first WAL segment to replay,
+            dict of expiring Interval to its deadline)
+    """
+    snapshots = list_files(directory, SNAPSHOT_PATTERN)
+    if not snapshots:
+        return [], 0, {}
+    path = snapshot_path(directory, snapshots[-1])
+    intervals, seq, deadlines = read_snapshot(path)
+    logger.info(f"Loaded {len(intervals)} intervals from {path}")
+    return intervals, seq, deadlines
+
+
+def replay_wal(directory, seq, apply):
+    """
+    Calls apply with the split tokens of every command logged in segment
+    seq and later, in order. A trailing line without its newline was
+    never fully written and is skipped.
+    :rtype: int number of commands replayed
+    """
+    replayed = 0
+    for segment in list_files(directory, SEGMENT_PATTERN):
+        if segment < seq:
+            continue
+        with open(segment_path(directory, segment), "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logger.warning(f"Skipping torn WAL record in segment {segment}")
+                    break
+                apply(line.decode("utf-8").split())
+                replayed += 1
+    if replayed:
+        logger.info(f"Replayed {replayed} commands from the write-ahead log")
+    return replayed
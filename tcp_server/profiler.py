@@ -0,0 +1,110 @@
+"""
+Sampling profiler that can be started and stopped on a running server.
+
+A daemon thread wakes every interval, reads the stack of every other
+thread with sys._current_frames() and counts the stacks running one of
+a set of root functions, cut so they start at the outermost root. Nothing
+is traced between samples, so the server runs at full speed while it
+profiles. Stacks are written in the folded format ("outer;inner count"
+per line) read by flamegraph.pl and speedscope.
+"""
+
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from threading import Event, Lock, Thread, get_ident
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    def __init__(self, roots, interval):
+        """
+        :param roots: code objects of the functions whose stacks are counted
+        :param interval: seconds between samples
+        """
+        self.roots = frozenset(roots)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = Event()
+        self.lock = Lock()  # Guards starting and stopping
+
+    def running(self):
+        return self.thread is not None
+
+    def start(self, path, seconds=None):
+        """
+        Samples until stop() is called or, if given, seconds have passed,
+        then writes the stacks to path.
+        :rtype: bool False if the profiler was already running
+        """
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.stopping.clear()
+            deadline = None if seconds is None else time.monotonic() + seconds
+            self.thread = Thread(target=self.run, args=(path, deadline), daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """
+        Stops sampling and waits for the stacks to be written.
+        :rtype: int samples taken, or None if the profiler was not running
+        """
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return None
+            self.stopping.set()
+            thread.join()
+            return self.samples
+
+    def run(self, path, deadline):
+        try:
+            while not self.stopping.wait(self.interval):
+                self.sample()
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+            write_folded(path, self.stacks)
+        except OSError as e:
+            logger.error(f"Unable to write profile to {path}: {e}")
+        finally:
+            self.thread = None
+
+    def sample(self):
+        own = get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            # Outermost first, starting at the outermost root
+            for index in range(len(stack) - 1, -1, -1):
+                if stack[index] in self.roots:
+                    self.stacks[tuple(reversed(stack[: index + 1]))] += 1
+                    break
+        self.samples += 1
+
+
+def label(code):
+    name = getattr(code, "co_qualname", code.co_name)  # Python 3.11+
+    return f"{os.path.basename(code.co_filename)}:{name}"
+
+
+def write_folded(path, stacks):
+    """Writes stacks, most sampled first, as "outer;inner count" lines."""
+    folded = Counter()
+    for stack, count in stacks.items():
+        folded[";".join(label(code) for code in stack)] += count
+    with open(path, "w") as f:
+        for line, count in folded.most_common():
+            f.write(f"{line} {count}\n")
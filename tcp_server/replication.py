@@ -0,0 +1,302 @@
+"""
+Leader/follower replication for nks_server.
+
+A leader numbers every write command it applies with an offset and keeps
+the most recent ones in a ReplicationLog. Followers connect to the
+leader's replication port and send
+
+    SYNC <replid> <offset>
+
+naming the history they hold and how far into it they are. If the leader
+still has every command after offset it replies ``CONTINUE <replid>``;
+otherwise it replies ``FULLSYNC <replid> <offset> <count>`` followed by
+MADD lines holding its `count` intervals as of offset, those of a named
+keyspace prefixed with ``@<keyspace>`` and those expiring followed by
+``EXPIRES <deadline>``. Either way it then
+streams ``<offset> <command>`` lines as writes are applied, and a
+``PING <offset> <time>`` line every heartbeat, which followers answer with
+``ACK <offset>``.
+
+Followers apply commands in leader order, so a follower's tree is always
+one the leader had at some point; it just trails the leader by the
+replication lag.
+"""
+
+import os
+import select
+import socket
+import time
+from collections import deque
+from itertools import islice
+from socketserver import StreamRequestHandler, ThreadingMixIn, TCPServer
+from threading import Condition, Thread
+
+from intervaltree import Interval
+from loguru import logger
+
+SNAPSHOT_BATCH = 1000  # Intervals per MADD line of a full-state transfer
+DEFAULT_KEYSPACE = "default"
+
+
+class ReplicationLog:
+    """
+    The last `size` write commands applied to the tree, numbered by
+    offset. `replid` names this history; offsets only mean the same thing
+    on servers sharing it. `followers` maps each connected follower to the
+    offset it last acknowledged.
+    """
+
+    def __init__(self, size):
+        self.replid = os.urandom(8).hex()
+        self.offset = 0
+        self.records = deque(maxlen=size)
+        self.followers = {}
+        self.cond = Condition()
+
+    def append(self, command):
+        with self.cond:
+            self.offset += 1
+            self.records.append(command)
+            self.cond.notify_all()
+
+    def reset(self, replid, offset):
+        """Continues the history replid from offset, as after a full sync."""
+        with self.cond:
+            self.replid = replid
+            self.offset = offset
+            self.records.clear()
+            self.cond.notify_all()
+
+    def since(self, offset, timeout=None):
+        """
+        Waits up to timeout seconds for commands after offset.
+        :rtype: list of the commands after offset, or None if some of them
+                are no longer kept
+        """
+        with self.cond:
+            if offset == self.offset and timeout != 0:
+                self.cond.wait(timeout)
+            missing = self.offset - offset
+            if missing < 0 or missing > len(self.records):
+                return None
+            return [self.records[-i] for i in range(missing, 0, -1)]
+
+    def follower_lag(self):
+        """
+        :rtype: int commands the furthest behind follower has yet to acknowledge
+        """
+        with self.cond:
+            return max((self.offset - acked for acked in self.followers.values()), default=0)
+
+
+class ReplicationServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    stopping = False
+
+    def shutdown(self):
+        """Stops accepting followers and disconnects the connected ones."""
+        self.stopping = True
+        super().shutdown()
+
+
+def serve_replication(log, snapshot, host, port, heartbeat=1.0):
+    """
+    Serves followers from daemon threads. snapshot() must return a dict
+    mapping each keyspace's name to its intervals, as a sized iterable,
+    and a dict of the deadlines of those that expire, together with
+    log.offset at the moment they were copied.
+    :rtype: ReplicationServer
+    """
+
+    class LeaderHandler(StreamRequestHandler):
+        def handle(self):
+            request = self.rfile.readline().decode("utf-8", errors="replace").split()
+            if len(request) != 3 or request[0] != "SYNC" or not request[2].isdigit():
+                self.wfile.write(str.encode("ERROR invalid SYNC command\n"))
+                return
+            replid, offset = request[1], int(request[2])
+            peer = "%s:%d" % self.client_address
+            try:
+                if replid != log.replid or log.since(offset, timeout=0) is None:
+                    offset = self.send_snapshot()
+                else:
+                    self.wfile.write(str.encode(f"CONTINUE {replid}\n"))
+                logger.info(f"Follower {peer} streaming from offset {offset}")
+                with log.cond:
+                    log.followers[peer] = offset
+                self.stream(peer, offset)
+            except OSError:
+                pass
+            finally:
+                with log.cond:
+                    log.followers.pop(peer, None)
+                logger.info(f"Follower {peer} disconnected")
+
+        def send_snapshot(self):
+            keyspaces, offset = snapshot()
+            count = sum(len(intervals) for intervals, _ in keyspaces.values())
+            self.wfile.write(str.encode(f"FULLSYNC {log.replid} {offset} {count}\n"))
+            for name, (intervals, deadlines) in keyspaces.items():
+                prefix = "" if name == DEFAULT_KEYSPACE else f"@{name} "
+                if deadlines:
+                    intervals = (iv for iv in intervals if iv not in deadlines)
+                self.send_batches(prefix, intervals, "")
+                by_deadline = {}
+                for iv, deadline in deadlines.items():
+                    by_deadline.setdefault(deadline, []).append(iv)
+                for deadline, expiring in by_deadline.items():
+                    self.send_batches(prefix, expiring, f" EXPIRES {deadline}")
+            return offset
+
+        def send_batches(self, prefix, intervals, suffix):
+            intervals = iter(intervals)
+            while True:
+                batch = list(islice(intervals, SNAPSHOT_BATCH))
+                if not batch:
+                    break
+                args = " ".join(f"{iv.begin} {iv.end} {iv.data}" for iv in batch)
+                self.wfile.write(str.encode(f"{prefix}MADD {args}{suffix}\n"))
+
+        def stream(self, peer, offset):
+            last_ping = 0.0
+            while not self.server.stopping:
+                records = log.since(offset, heartbeat)
+                if records is None:
+                    logger.warning(
+                        f"Follower {peer} fell more than {log.records.maxlen} commands behind"
+                    )
+                    return
+                if records:
+                    lines = (f"{offset + i} {command}\n" for i, command in enumerate(records, 1))
+                    self.wfile.write(str.encode("".join(lines)))
+                    offset += len(records)
+                if time.monotonic() - last_ping >= heartbeat:
+                    self.wfile.write(str.encode(f"PING {offset} {time.time():.6f}\n"))
+                    last_ping = time.monotonic()
+                    if not self.read_acks(peer):
+                        return
+
+        def read_acks(self, peer):
+            """
+            Records the follower's latest ACK without waiting for one.
+            :rtype: bool False once the follower has closed the connection
+            """
+            received = b""
+            while select.select([self.connection], [], [], 0)[0]:
+                chunk = self.connection.recv(4096)
+                if not chunk:
+                    return False
+                received += chunk
+            acks = [line.split() for line in received.splitlines() if line.startswith(b"ACK ")]
+            if acks:
+                with log.cond:
+                    log.followers[peer] = int(acks[-1][1])
+            return True
+
+    server = ReplicationServer((host, port), LeaderHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Follower:
+    """
+    Keeps a local tree in step with the leader at host:port from a daemon
+    thread, reconnecting whenever the connection drops. load(keyspaces,
+    replid, offset) replaces every keyspace's tree with the intervals, and
+    the dict of their deadlines, keyspaces maps its name to and resets log
+    to that point; apply(data)
+    applies one write command and appends it to log.
+    """
+
+    def __init__(self, host, port, log, load, apply, heartbeat=1.0):
+        self.host = host
+        self.port = port
+        self.log = log
+        self.load = load
+        self.apply = apply
+        self.heartbeat = heartbeat
+        self.connected = False
+        self.lag = 0.0  # Seconds between the leader sending the last PING and it being read
+        self.last_contact = None  # time.monotonic() of the last line from the leader
+        self.full_syncs = 0
+        self.stopped = False
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        """Stops following once the current line from the leader is read."""
+        self.stopped = True
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.follow()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Replication from {self.host}:{self.port} failed: {e}")
+            self.connected = False
+            time.sleep(self.heartbeat)
+
+    def follow(self):
+        # Several missed heartbeats mean the leader is gone
+        with socket.create_connection((self.host, self.port), timeout=10 * self.heartbeat) as conn:
+            conn.sendall(str.encode(f"SYNC {self.log.replid} {self.log.offset}\n"))
+            rfile = conn.makefile("rb")
+            header = rfile.readline().decode().split()
+            if header[:1] == ["FULLSYNC"] and len(header) == 4:
+                self.full_sync(rfile, header[1], int(header[2]), int(header[3]))
+            elif header != ["CONTINUE", self.log.replid]:
+                raise ValueError(f"unexpected reply {' '.join(header)!r}")
+            self.connected = True
+            logger.info(f"Replicating {self.host}:{self.port} from offset {self.log.offset}")
+            for line in rfile:
+                if self.stopped:
+                    return
+                if not line.endswith(b"\n"):
+                    break
+                self.last_contact = time.monotonic()
+                data = line.decode().split()
+                if data[0] == "PING":
+                    self.lag = max(time.time() - float(data[2]), 0.0)
+                    conn.sendall(str.encode(f"ACK {self.log.offset}\n"))
+                elif int(data[0]) == self.log.offset + 1:
+                    self.apply(data[1:])
+                else:
+                    raise ValueError(f"expected offset {self.log.offset + 1}, got {data[0]}")
+            raise ConnectionResetError("leader closed the connection")
+
+    def full_sync(self, rfile, replid, offset, count):
+        started = time.monotonic()
+        keyspaces = {}
+        received = 0
+        while received < count:
+            data = rfile.readline().decode().split()
+            name = DEFAULT_KEYSPACE
+            if data[:1] and data[0].startswith("@"):
+                name, data = data[0][1:], data[1:]
+            if data[:1] != ["MADD"]:
+                raise ConnectionResetError("full sync interrupted")
+            deadline = None
+            if len(data) % 3 == 0 and data[-2] == "EXPIRES":
+                data, deadline = data[:-2], int(data[-1])
+            batch = [Interval(int(b), int(e), label) for b, e, label in zip(*[iter(data[1:])] * 3)]
+            intervals, deadlines = keyspaces.setdefault(name, ([], {}))
+            intervals.extend(batch)
+            if deadline is not None:
+                deadlines.update(dict.fromkeys(batch, deadline))
+            received += len(batch)
+        self.load(keyspaces, replid, offset)
+        self.full_syncs += 1
+        logger.info(
+            f"Loaded {count} intervals from {self.host}:{self.port} "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+
+    def contact_age(self):
+        """
+        :rtype: float seconds since the leader was last heard from
+        """
+        if self.last_contact is None:
+            return 0.0
+        return time.monotonic() - self.last_contact
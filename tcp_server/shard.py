@@ -0,0 +1,671 @@
+"""
+Sharded mode for nks_server.
+
+With SHARDS=N the coordinate space [0, MAX_INT] is split into N equal
+ranges, each served by its own worker process with its own
+CustomIntervalTree, so tree work is spread over N cores instead of being
+serialised by one interpreter's GIL. The process clients connect to routes
+their commands:
+
+* an interval lying inside one range is stored by that range's worker;
+* an interval crossing a range boundary is stored whole in the router's
+  own TREE, so every interval is stored exactly once and FIND reports the
+  same names, duplicates included, as a single process would;
+* FIND, DEL and MFIND run against the router's TREE and go to every worker
+  whose range they touch, and the replies are merged.
+
+When a DEL trims a boundary-crossing interval until it fits in one range,
+the router hands the remainder to that range's worker and logs a REMOVE
+record for it, so the same interval never ends up stored twice.
+
+Workers listen on 127.0.0.1, shard i on SHARD_BASE_PORT + i. Each client
+connection gets its own connection to each worker, and pipelined commands
+stay pipelined: every command in a read is forwarded before any reply is
+awaited.
+"""
+
+import asyncio
+import bisect
+import heapq
+import os
+import signal
+import subprocess
+import sys
+from collections import deque
+
+from loguru import logger
+
+from tcp_server import tcp_server
+from tcp_server.net import wait_for_port
+from tcp_server.tcp_server import (
+    MAX_INT,
+    CommandHandler,
+    StreamConnection,
+    commit_write,
+    find_range,
+    log_write,
+    next_cursor,
+    parse_cursor,
+    split_find_options,
+    split_option,
+    triples,
+)
+
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", tcp_server.TCP_PORT + 1))
+WORKER_HOST = "127.0.0.1"
+PARTIAL_REPLY_SIZE = 4096  # Smallest part of a streamed reply that is merged before its end
+HANDOVER_BATCH = 1000  # Intervals per MADD when handing intervals over at startup
+
+
+class ShardMap:
+    """Splits [0, MAX_INT] into `count` equal ranges."""
+
+    def __init__(self, count):
+        self.count = count
+        self.bounds = [i * (MAX_INT + 1) // count for i in range(count + 1)]
+
+    def shard(self, point):
+        return bisect.bisect_right(self.bounds, point) - 1
+
+    def shards(self, begin, end):
+        """
+        :rtype: range of the shards overlapping [begin, end)
+        """
+        if begin >= end:
+            return range(0)
+        return range(self.shard(begin), self.shard(end - 1) + 1)
+
+    def owner(self, begin, end):
+        """
+        :rtype: int shard storing the interval [begin, end), or None if it
+                crosses a boundary and is kept by the router
+        """
+        first = self.shard(begin)
+        return first if first == self.shard(end - 1) else None
+
+
+class Fanout:
+    """
+    A routed command. `parts` pairs each worker with the line sent to it
+    and `local` holds the replies already computed against the router's
+    TREE; merge() turns the workers' replies, in order and followed by the
+    local ones, into the client's reply.
+    """
+
+    def __init__(self, parts, merge, local=(), handovers=None):
+        """
+        :param handovers: dict of the index of each part storing intervals
+                          handed over to its worker to those intervals,
+                          already removed from TREE but only logged as
+                          removed once the worker replies OK
+        """
+        self.parts = parts
+        self.merge = merge
+        self.local = list(local)
+        self.handovers = handovers or {}
+
+    def acknowledge(self, replies):
+        """
+        Logs the removal of handed over intervals their worker now holds,
+        and puts back the ones it refused.
+        """
+        for index, intervals in self.handovers.items():
+            held = replies[index] == b"OK\n"
+            if not held:
+                shard = self.parts[index][0]
+                logger.warning(f"Shard {shard} refused handed over intervals: {replies[index]!r}")
+            for iv in intervals:
+                args = [str(iv.begin), str(iv.end), iv.data]
+                if held:
+                    log_write(["REMOVE", *args])
+                else:
+                    commit_write(["ADD", *args], log=False)  # Its removal was never logged
+
+
+class StreamFanout(Fanout):
+    """A FIND ... STREAM, whose replies are merged as they arrive."""
+
+    def __init__(self, parts, local):
+        Fanout.__init__(self, parts, None, [local])
+
+
+def command(*tokens):
+    return str.encode(" ".join(str(token) for token in tokens) + "\n")
+
+
+def reply_error(replies):
+    """
+    :rtype: bytes first reply that is an error other than "no results", or None
+    """
+    for reply in replies:
+        if reply.startswith(b"ERROR") and reply != b"ERROR no results\n":
+            return reply
+    return None
+
+
+def reply_tokens(reply):
+    if reply.startswith(b"ERROR no results"):
+        return []
+    return reply.split()
+
+
+def merge_ok(replies):
+    return reply_error(replies) or b"OK\n"
+
+
+def merge_sum(replies):
+    error = reply_error(replies)
+    if error:
+        return error
+    return str.encode(f"{sum(int(reply) for reply in replies)}\n")
+
+
+def merge_names(replies):
+    merged = list(heapq.merge(*(reply_tokens(reply) for reply in replies)))
+    if not merged:
+        return b"ERROR no results\n"
+    return b" ".join(merged) + b"\n"
+
+
+def interval_key(token):
+    begin, _, end = token.partition(b"-")
+    return int(begin), int(end)
+
+
+def merge_intervals(replies):
+    lists = (reply_tokens(reply) for reply in replies)
+    merged = list(heapq.merge(*lists, key=interval_key))
+    if not merged:
+        return b"ERROR no results\n"
+    return b" ".join(merged) + b"\n"
+
+
+async def merge_tokens(sources):
+    """
+    Merges async iterators of sorted token batches into one sorted
+    iterator of tokens, holding at most one batch per source.
+    :rtype: async iterator of bytes
+    """
+    queues = [deque() for _ in sources]
+
+    async def refill(index):
+        while not queues[index]:
+            try:
+                batch = await sources[index].__anext__()  # anext() is Python 3.10+
+            except StopAsyncIteration:
+                return False
+            queues[index].extend(batch)
+        return True
+
+    heap = []
+    for index in range(len(sources)):
+        if await refill(index):
+            heap.append((queues[index].popleft(), index))
+    heapq.heapify(heap)
+    while heap:
+        token, index = heap[0]
+        yield token
+        if queues[index] or await refill(index):
+            heapq.heapreplace(heap, (queues[index].popleft(), index))
+        else:
+            heapq.heappop(heap)
+
+
+async def local_tokens(response):
+    """
+    Yields the tokens of a locally computed FIND ... STREAM response,
+    either "no results" or an iterator of chunks split between names.
+    :rtype: async iterator of list of bytes
+    """
+    if isinstance(response, bytes):
+        return
+    for piece in response:
+        yield piece.split()
+
+
+class WorkerConnection:
+    """
+    One connection to a worker. Replies are read from its own buffer, so a
+    long reply can be consumed a piece at a time without reading into the
+    reply after it.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = b""
+
+    async def fill(self):
+        chunk = await self.reader.read(tcp_server.RECV_SIZE)
+        if not chunk:
+            raise ConnectionError("worker closed the connection")
+        self.buffer += chunk
+
+    async def readline(self):
+        while True:
+            end = self.buffer.find(b"\n")
+            if end >= 0:
+                line, self.buffer = self.buffer[: end + 1], self.buffer[end + 1 :]
+                return line
+            await self.fill()
+
+    async def tokens(self):
+        """
+        Yields the tokens of the next reply in batches as it arrives. A
+        "no results" reply yields nothing.
+        :rtype: async iterator of list of bytes
+        """
+        while True:
+            end = self.buffer.find(b"\n")
+            if end >= 0:
+                line, self.buffer = self.buffer[:end], self.buffer[end + 1 :]
+                if line != b"ERROR no results":
+                    yield line.split()
+                return
+            # Short replies, such as "ERROR no results", always arrive whole
+            cut = self.buffer.rfind(b" ")
+            if len(self.buffer) >= PARTIAL_REPLY_SIZE and cut >= 0:
+                line, self.buffer = self.buffer[:cut], self.buffer[cut + 1 :]
+                yield line.split()
+            await self.fill()
+
+    def close(self):
+        self.writer.close()
+
+
+class RouterHandler(CommandHandler):
+    """
+    Validates commands exactly like a single server, but queues a Fanout
+    for each valid command instead of replying to it. The part of the
+    command concerning boundary-crossing intervals is executed right away
+    against the router's TREE.
+    """
+
+    def __init__(self, router, conn):
+        CommandHandler.__init__(self, conn)
+        self.shard_map = router.shard_map
+
+    def validate_binary(self, data):
+        self.reply(str.encode("ERROR BINARY is not supported by the shard router\n"))
+        return False
+
+    def validate_unsupported(self, data):
+        # A name's intervals can be split between workers, so their answers cannot be added up
+        self.reply(str.encode(f"ERROR {data[0]} is not supported by the shard router\n"))
+        return False
+
+    validate_coverage = validate_unsupported
+    validate_use = validate_unsupported
+    validate_drop = validate_unsupported
+    validate_slowlog = validate_unsupported  # Workers run the commands, not the router
+    validate_profile = validate_unsupported
+
+    def validate_data(self, data):
+        if self.keyspace is not tcp_server.DEFAULT:
+            self.reply(str.encode("ERROR keyspaces are not supported by the shard router\n"))
+            return False
+        if data[:1] in (["ADD"], ["MADD"]) and split_option(data, "TTL")[1] is not None:
+            self.reply(str.encode("ERROR TTL is not supported by the shard router\n"))
+            return False
+        return CommandHandler.validate_data(self, data)
+
+    def validate_count(self, data):
+        if data[0] == "DISTINCT":
+            return self.validate_unsupported(data)
+        return CommandHandler.validate_count(self, data)
+
+    def perform_action(self, data):
+        actions = {
+            "ADD": self.route_add,
+            "DEL": self.route_delete,
+            "FIND": self.route_find,
+            "MADD": self.route_add,
+            "MDEL": self.route_delete,
+            "MFIND": self.route_multi_find,
+            "STATS": self.route_stats,
+            "COMPACT": self.route_all,
+            "FLUSH": self.route_all,
+            "COUNT": self.route_count,
+        }
+        self.reply(actions[data[0]](data))
+
+    def local(self, data):
+        """
+        Executes data against the router's TREE.
+        :rtype: the response, bytes or an iterator of bytes
+        """
+        pending, self.pending = self.pending, []
+        try:
+            CommandHandler.perform_action(self, data)
+            (response,) = self.pending
+        finally:
+            self.pending = pending
+        return response
+
+    def route_add(self, data):
+        by_shard = {}
+        crossing = []
+        for begin, end, name in triples(data[1:]):
+            owner = self.shard_map.owner(int(begin), int(end))
+            args = crossing if owner is None else by_shard.setdefault(owner, [])
+            args.extend((begin, end, name))
+        local = [self.local([data[0], *crossing])] if crossing else []
+        parts = [(shard, command(data[0], *args)) for shard, args in by_shard.items()]
+        return Fanout(parts, merge_ok, local)
+
+    def route_delete(self, data):
+        local = self.local(data)
+        # DEL's end is inclusive
+        if data[0] == "DEL":
+            ranges = [(int(data[1]), int(data[2]) + 1)]
+            shards = self.shard_map.shards(*ranges[0])
+            parts = [(shard, command(*data)) for shard in shards]
+        else:
+            ranges = [(int(begin), int(end) + 1) for begin, end, _ in triples(data[1:])]
+            by_shard = {}
+            for (begin, end), args in zip(ranges, triples(data[1:])):
+                for shard in self.shard_map.shards(begin, end):
+                    by_shard.setdefault(shard, []).extend(args)
+            parts = [(shard, command("MDEL", *args)) for shard, args in by_shard.items()]
+        handed = self.hand_over(ranges)
+        handovers = {len(parts) + index: ivs for index, (_, _, ivs) in enumerate(handed)}
+        parts += [(shard, line) for shard, line, _ in handed]
+        return Fanout(parts, merge_ok, [local], handovers)
+
+    def hand_over(self, ranges):
+        """
+        Finds the boundary-crossing intervals that deleting ranges trimmed
+        until they fit in one shard, and returns the MADD parts that store
+        them in that shard instead. They leave TREE straight away, so later
+        commands never see them twice, but their removal is only logged
+        once the shard has them: after a crash in between, the WAL still
+        holds them and they are handed over again on restart.
+        :rtype: list of (shard, line, list of the Intervals it stores)
+        """
+        edges = set()
+        with tcp_server.TREE_LOCK.read_lock():
+            for begin, end in ranges:
+                edges.update(tcp_server.TREE.overlap(max(begin - 1, 0), begin))
+                edges.update(tcp_server.TREE.at(end))
+        by_shard = {}
+        for iv in sorted(edges):
+            shard = self.shard_map.owner(iv.begin, iv.end)
+            if shard is not None:
+                commit_write(["REMOVE", str(iv.begin), str(iv.end), iv.data], log=False)
+                by_shard.setdefault(shard, []).append(iv)
+        return [
+            (shard, command("MADD", *(x for iv in ivs for x in iv)), ivs)
+            for shard, ivs in by_shard.items()
+        ]
+
+    def route_find(self, data):
+        query, options = split_find_options(data)
+        if len(query) == 4:
+            begin, end = int(query[2]), int(query[3])
+        else:
+            begin, end = find_range(query)
+        shards = self.shard_map.shards(begin, end)
+        if "STREAM" in options:
+            return StreamFanout([(shard, command(*data)) for shard in shards], self.local(data))
+        if "LIMIT" in options:
+            limit = int(options["LIMIT"])
+            return self.route_paged_find(query, limit, options.get("AFTER"), shards)
+        merge = merge_intervals if len(query) == 4 else merge_names
+        return Fanout([(shard, command(*data)) for shard in shards], merge, [self.local(data)])
+
+    def route_paged_find(self, query, limit, after, shards):
+        # Every source's first limit + skip + 1 names from `name` on hold the
+        # merged page once the `skip` copies of `name` already sent are dropped
+        cursor = after and parse_cursor(after)
+        if cursor:
+            name, skip = cursor
+            tokens = [*query, "LIMIT", str(limit + skip + 1), "AFTER", f"{name}:0"]
+        else:
+            name, skip = "", 0
+            tokens = [*query, "LIMIT", str(limit + 1)]
+
+        def merge(replies):
+            error = reply_error(replies)
+            if error:
+                return error
+            pages = [reply_tokens(reply.partition(b";")[0]) for reply in replies]
+            merged = [token.decode() for token in heapq.merge(*pages)]
+            dropped = 0
+            while dropped < min(skip, len(merged)) and merged[dropped] == name:
+                dropped += 1
+            merged = merged[dropped:]
+            page = merged[:limit]
+            if not page and cursor is None:
+                return b"ERROR no results\n"
+            following = ""
+            if len(merged) > limit:
+                following = "%s:%d" % next_cursor(page, cursor)
+            return str.encode(" ".join(page) + ";" + following + "\n")
+
+        parts = [(shard, command(*tokens)) for shard in shards]
+        return Fanout(parts, merge, [self.local(tokens)])
+
+    def route_multi_find(self, data):
+        points = [int(point) for point in data[1:]]
+        by_shard = {}
+        for index, point in enumerate(points):
+            by_shard.setdefault(self.shard_map.shard(point), []).append(index)
+        # The router's own reply covers every point and comes last
+        sources = [*by_shard.values(), range(len(points))]
+
+        def merge(replies):
+            error = reply_error(replies)
+            if error:
+                return error
+            fields = [[] for _ in points]
+            for indexes, reply in zip(sources, replies):
+                for index, field in zip(indexes, reply.rstrip(b"\n").split(b";")):
+                    fields[index].append(field.split())
+            return b";".join(b" ".join(heapq.merge(*names)) for names in fields) + b"\n"
+
+        parts = [
+            (shard, command("MFIND", *(points[index] for index in indexes)))
+            for shard, indexes in by_shard.items()
+        ]
+        return Fanout(parts, merge, [self.local(data)])
+
+    def route_count(self, data):
+        # Every interval is stored once, by one worker or by the router
+        shards = self.shard_map.shards(*find_range(data))
+        return Fanout([(shard, command(*data)) for shard in shards], merge_sum, [self.local(data)])
+
+    def route_all(self, data):
+        parts = [(shard, command(*data)) for shard in range(self.shard_map.count)]
+        return Fanout(parts, merge_ok, [self.local(data)])
+
+    def route_stats(self, data):
+        shards = range(self.shard_map.count)
+
+        def merge(replies):
+            fields = []
+            total = 0
+            for shard, reply in zip([*shards, None], replies):
+                for field in reply.decode().split():
+                    key, _, value = field.partition("=")
+                    if key == "tree.intervals":
+                        total += int(value)
+                    if shard is not None:
+                        fields.append(f"shard{shard}.{field}")
+                    elif key.startswith(("tree.", "cache.", "wal.")):
+                        fields.append(f"spanning.{field}")
+                    else:
+                        fields.append(field)
+            return str.encode(" ".join([f"tree.intervals={total}", *fields]) + "\n")
+
+        return Fanout([(shard, b"STATS\n") for shard in shards], merge, [self.local(data)])
+
+
+class ShardRouter:
+    """Accepts clients and routes their commands to the shard workers."""
+
+    def __init__(self, count, base_port):
+        self.shard_map = ShardMap(count)
+        self.base_port = base_port
+
+    async def connect(self, shard):
+        reader, writer = await asyncio.open_connection(WORKER_HOST, self.base_port + shard)
+        return WorkerConnection(reader, writer)
+
+    async def hand_over_all(self):
+        """
+        Hands every interval in TREE that fits in one shard over to it,
+        such as the whole tree restored from an unsharded server's WAL_DIR.
+        """
+        by_shard = {}
+        for iv in sorted(tcp_server.TREE):
+            shard = self.shard_map.owner(iv.begin, iv.end)
+            if shard is not None:
+                by_shard.setdefault(shard, []).append(iv)
+        for shard, intervals in by_shard.items():
+            worker = await self.connect(shard)
+            try:
+                for start in range(0, len(intervals), HANDOVER_BATCH):
+                    batch = intervals[start : start + HANDOVER_BATCH]
+                    worker.writer.write(command("MADD", *(x for iv in batch for x in iv)))
+                    reply = await worker.readline()
+                    if reply != b"OK\n":
+                        raise RuntimeError(f"shard {shard} refused intervals: {reply!r}")
+                    for iv in batch:
+                        commit_write(["REMOVE", str(iv.begin), str(iv.end), iv.data])
+            finally:
+                worker.close()
+            logger.info(f"Handed {len(intervals)} intervals over to shard {shard}")
+
+    async def handle_client(self, reader, writer):
+        if not tcp_server.CONNECTION_SLOTS.acquire(blocking=False):
+            tcp_server.METRICS.increment("connections.refused")
+            writer.write(str.encode("ERROR server busy\n"))
+            writer.close()
+            return
+        handler = RouterHandler(self, StreamConnection(writer))
+        workers = {}
+        timeout = tcp_server.IDLE_TIMEOUT or None
+        tcp_server.METRICS.connection_opened()
+        try:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(tcp_server.RECV_SIZE), timeout)
+                if not chunk:
+                    break
+                await self.forward(handler.collect(chunk), workers, writer)
+        except asyncio.TimeoutError:
+            tcp_server.METRICS.increment("connections.timed_out")
+        except OSError as e:
+            tcp_server.METRICS.increment("connections.errors")
+            logger.debug(f"[-] Routed connection failed: {e}")
+        finally:
+            tcp_server.METRICS.connection_closed()
+            for worker in workers.values():
+                worker.close()
+            writer.close()
+            tcp_server.CONNECTION_SLOTS.release()
+
+    async def forward(self, items, workers, writer):
+        """Sends every queued command to its workers, then replies to each in order."""
+        for item in items:
+            if isinstance(item, Fanout):
+                for shard, line in item.parts:
+                    if shard not in workers:
+                        workers[shard] = await self.connect(shard)
+                    workers[shard].writer.write(line)
+        output = []
+        for item in items:
+            if isinstance(item, StreamFanout):
+                writer.write(b"".join(output))
+                output = []
+                await self.stream(item, workers, writer)
+            elif isinstance(item, Fanout):
+                replies = [await workers[shard].readline() for shard, _ in item.parts]
+                item.acknowledge(replies)
+                output.append(item.merge(replies + item.local))
+            else:
+                output.append(item)
+        writer.write(b"".join(output))
+        await writer.drain()
+
+    async def stream(self, item, workers, writer):
+        sources = [workers[shard].tokens() for shard, _ in item.parts]
+        sources.append(local_tokens(item.local[0]))
+        chunk = []
+        separator = b""
+        async for token in merge_tokens(sources):
+            chunk.append(token)
+            if len(chunk) == tcp_server.STREAM_CHUNK:
+                writer.write(separator + b" ".join(chunk))
+                await writer.drain()
+                chunk = []
+                separator = b" "
+        if chunk:
+            writer.write(separator + b" ".join(chunk) + b"\n")
+        elif separator:
+            writer.write(b"\n")
+        else:
+            writer.write(b"ERROR no results\n")
+
+    async def serve(self, host, port):
+        await self.hand_over_all()
+        server = await asyncio.start_server(
+            self.handle_client, host, port, reuse_address=True, backlog=tcp_server.LISTEN_BACKLOG
+        )
+        async with server:
+            await server.serve_forever()
+
+
+def start_workers(count, base_port):
+    """
+    Starts the shard workers as child processes, each persisting into its
+    own subdirectory of WAL_DIR if that is set.
+    :rtype: list of subprocess.Popen
+    """
+    processes = []
+    for shard in range(count):
+        env = dict(
+            os.environ,
+            HOSTNAME=WORKER_HOST,
+            PORT=str(base_port + shard),
+            SERVER_MODE="async",
+            SHARDS="0",
+            IDLE_TIMEOUT="0",  # The router closes worker connections with their client
+        )
+        env.pop("METRICS_PORT", None)
+        if tcp_server.WAL_DIR:
+            env["WAL_DIR"] = os.path.join(tcp_server.WAL_DIR, f"shard-{shard}")
+        command = [sys.executable, "-m", "tcp_server.tcp_server"]
+        processes.append(subprocess.Popen(command, env=env))
+    try:
+        for shard in range(count):
+            wait_for_port(WORKER_HOST, base_port + shard)
+    except RuntimeError:
+        stop_workers(processes)
+        raise
+    return processes
+
+
+def stop_workers(processes):
+    # SIGINT lets each worker write its shutdown snapshot
+    for process in processes:
+        process.send_signal(signal.SIGINT)
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_router():
+    count, port = tcp_server.SHARDS, tcp_server.TCP_PORT
+    logger.info(f"TCP Server (sharded over {count} workers) started on port {port}...")
+    # The router's own TREE, holding the boundary-crossing intervals, persists into WAL_DIR
+    tcp_server.start_persistence()
+    processes = start_workers(count, SHARD_BASE_PORT)
+    try:
+        asyncio.run(ShardRouter(count, SHARD_BASE_PORT).serve(tcp_server.TCP_IP, port))
+    except KeyboardInterrupt:
+        pass  # Handle SIGINT from terminal
+    finally:
+        stop_workers(processes)
+        tcp_server.stop_persistence()
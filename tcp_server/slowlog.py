@@ -0,0 +1,73 @@
+"""
+Slow-query log: the most recent commands that took at least a threshold
+to run, with what they returned and how large their keyspace was.
+"""
+
+import time
+from collections import deque
+from threading import Lock
+
+MAX_ARGS = 16  # Arguments kept per command; the rest are summarised as "...(+N)"
+
+
+class SlowLog:
+    """
+    Bounded log of slow commands, newest last. Checking a command against
+    the threshold is a single comparison, so the log can stay on for every
+    command; only the slow ones pay for building an entry.
+    """
+
+    def __init__(self, threshold, size):
+        """
+        :param threshold: seconds a command must take to be logged, 0 disables
+        :param size: entries kept, older ones are dropped
+        """
+        self.threshold = threshold
+        self.entries = deque(maxlen=size)
+        self.logged = 0  # Entries ever recorded, used as ids
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_slow(self, seconds):
+        return 0 < self.threshold <= seconds
+
+    def record(self, data, seconds, keyspace, results, intervals):
+        """
+        :param data: the command's tokens
+        :param results: names, intervals or points it returned, None if it
+                        returns no results
+        :param intervals: size of the keyspace's tree after it ran
+        :rtype: str the entry, as format_entry() renders it
+        """
+        if len(data) > MAX_ARGS + 1:
+            data = [*data[: MAX_ARGS + 1], f"...(+{len(data) - MAX_ARGS - 1})"]
+        with self.lock:
+            self.logged += 1
+            entry = (self.logged, time.time(), seconds, keyspace, results, intervals, data)
+            self.entries.append(entry)
+        return format_entry(entry)
+
+    def latest(self, count=None):
+        """:rtype: list of entries, newest first"""
+        with self.lock:
+            entries = list(self.entries)
+        entries.reverse()
+        return entries[:count]
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def format_entry(entry):
+    """
+    :rtype: str key=value fields followed by the command itself, for
+            example "id=3 time=1700000000.123 us=15210 keyspace=default
+            results=5000 intervals=100000 FIND 0 1000000"
+    """
+    id, at, seconds, keyspace, results, intervals, data = entry
+    results = "-" if results is None else results
+    fields = f"id={id} time={at:.3f} us={seconds * 1e6:.0f} keyspace={keyspace}"
+    return f"{fields} results={results} intervals={intervals} {' '.join(data)}"
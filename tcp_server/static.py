@@ -0,0 +1,93 @@
+"""
+Read-optimized, immutable index for point FIND queries.
+
+The begins and ends of every interval split the coordinate space into
+elementary segments, inside each of which the same intervals match. The
+index keeps the sorted segment boundaries and, for each segment, the
+encoded FIND response, so answering ``FIND x`` is a single bisect and a
+list lookup. Identical responses are shared between segments.
+
+numpy is optional: with it, batches of points are looked up with one
+vectorized ``searchsorted`` call instead of one bisect per point.
+"""
+
+from array import array
+from bisect import bisect_right, insort
+
+try:
+    import numpy
+except ImportError:  # Batches fall back to bisect
+    numpy = None
+
+NO_RESULTS = b"ERROR no results\n"
+
+
+class StaticIndex:
+    """
+    Point-query index over a fixed set of intervals. `version` tags the
+    state of the tree it was built from.
+    """
+
+    def __init__(self, intervals, version, limit):
+        """
+        Builds the index with a sweep over the sorted boundaries. Raises
+        ValueError if the segments would hold more than `limit` names in
+        total, which happens when many intervals overlap each other.
+        """
+        intervals = list(intervals)
+        begins = sorted((iv.begin, iv.data) for iv in intervals)
+        ends = sorted((iv.end, iv.data) for iv in intervals)
+        bounds = sorted({begin for begin, _ in begins} | {end for end, _ in ends})
+        shared = {NO_RESULTS: NO_RESULTS}
+        responses = [NO_RESULTS]  # Points before the first boundary
+        active = []  # Sorted names of the intervals covering the current segment
+        total = 0
+        b = e = 0
+        for bound in bounds:
+            while b < len(begins) and begins[b][0] == bound:
+                insort(active, begins[b][1])
+                b += 1
+            while e < len(ends) and ends[e][0] == bound:
+                del active[bisect_right(active, ends[e][1]) - 1]
+                e += 1
+            total += len(active)
+            if total > limit:
+                raise ValueError(f"segments would hold more than {limit} names")
+            response = str.encode(" ".join(active) + "\n") if active else NO_RESULTS
+            responses.append(shared.setdefault(response, response))
+        self.version = version
+        self.responses = responses
+        self.bounds = array("I", bounds)
+        self.vector_bounds = numpy.frombuffer(self.bounds, dtype=numpy.uint32) if numpy else None
+        self.names = total
+
+    def __len__(self):
+        """
+        :rtype: int number of elementary segments
+        """
+        return len(self.bounds)
+
+    def find(self, point):
+        """
+        :rtype: bytes FIND response for point
+        """
+        return self.responses[bisect_right(self.bounds, point)]
+
+    def find_many(self, points):
+        """
+        :rtype: list of bytes FIND responses for each point, in order
+        """
+        responses = self.responses
+        if self.vector_bounds is not None:
+            query = numpy.array(points, dtype=numpy.int64)
+            indexes = numpy.searchsorted(self.vector_bounds, query, side="right")
+            return [responses[index] for index in indexes.tolist()]
+        bounds = self.bounds
+        return [responses[bisect_right(bounds, point)] for point in points]
+
+    def find_names(self, point):
+        """
+        :rtype: list of sorted names of the intervals containing point
+        """
+        response = self.find(point)
+        return [] if response is NO_RESULTS else response.decode().split()
@@ -1,81 +1,227 @@
+import asyncio
+import bisect
+import errno
+import heapq
 import os
 import re
 import socket
-from socketserver import ThreadingMixIn
-from threading import Thread
+import struct
+import tempfile
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from threading import BoundedSemaphore, Condition, Lock, Thread, enumerate as enumerate_threads
 
 from intervaltree import Interval, IntervalTree
 from loguru import logger
 
+from tcp_server import binary, persistence, replication
+from tcp_server.aggregate import IntervalCounts
+from tcp_server.cache import FindCache
+from tcp_server.compact import CompactIntervalTree
+from tcp_server.expiry import Expiry, carried_deadlines, combined
+from tcp_server.metrics import CommandStats, Metrics, serve_prometheus
+from tcp_server.profiler import Profiler
+from tcp_server.slowlog import SlowLog, format_entry
+from tcp_server.static import NO_RESULTS, StaticIndex
+
 TCP_IP = os.environ.get("HOSTNAME", "0.0.0.0")
-TCP_PORT = os.environ.get("PORT", 2004)
+TCP_PORT = int(os.environ.get("PORT", 2004))
 BUFFER_SIZE = os.environ.get("BUFFER_SIZE", 20)  # Usually 1024, but we need quick response
+SERVER_MODE = os.environ.get("SERVER_MODE", "thread")  # "thread" or "async"
+RECV_SIZE = int(os.environ.get("RECV_SIZE", 65536))
+MAX_LINE_SIZE = int(os.environ.get("MAX_LINE_SIZE", 65536))
+WAL_DIR = os.environ.get("WAL_DIR")  # Persistence is disabled unless set
+WAL_FSYNC_BATCH = int(os.environ.get("WAL_FSYNC_BATCH", 64))
+WAL_FSYNC_INTERVAL = float(os.environ.get("WAL_FSYNC_INTERVAL", 1.0))
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", 300))
+STORAGE = os.environ.get("STORAGE", "tree")  # "tree" or "compact"
+FIND_CACHE_SIZE = int(os.environ.get("FIND_CACHE_SIZE", 0))  # 0 disables the cache
+SHARDS = int(os.environ.get("SHARDS", 0))  # Worker processes to shard across, 0 disables
+METRICS_PORT = os.environ.get("METRICS_PORT")  # Prometheus endpoint is disabled unless set
+STREAM_CHUNK = int(os.environ.get("STREAM_CHUNK", 4096))  # Names per streamed FIND chunk
+# Threads cost a stack each, so only thread mode is capped and reaps idle clients by default
+THREADED = SERVER_MODE != "async"
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 1024 if THREADED else 0))  # 0 disables
+IDLE_TIMEOUT = float(os.environ.get("IDLE_TIMEOUT", 300 if THREADED else 0))  # Seconds, 0 disables
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", 128))
+ACCEPT_BACKOFF = float(os.environ.get("ACCEPT_BACKOFF", 0.1))  # Seconds, after running out of fds
+REPLICATION_PORT = os.environ.get("REPLICATION_PORT")  # Serving followers is disabled unless set
+REPLICA_OF = os.environ.get("REPLICA_OF")  # "host:port" of a leader's REPLICATION_PORT
+REPLICATION_BACKLOG = int(os.environ.get("REPLICATION_BACKLOG", 100000))  # Commands kept
+REPLICATION_HEARTBEAT = float(os.environ.get("REPLICATION_HEARTBEAT", 1.0))  # Seconds
+STATIC_INDEX = float(os.environ.get("STATIC_INDEX", 0))  # Seconds without writes to rebuild, 0 off
+STATIC_INDEX_LIMIT = int(os.environ.get("STATIC_INDEX_LIMIT", 10000000))  # Names in its segments
+MERGE_ON_INSERT = os.environ.get("MERGE_ON_INSERT", "0") == "1"  # Join touching same-name ADDs
+EXPIRY_INTERVAL = float(os.environ.get("EXPIRY_INTERVAL", 0.02))  # Seconds between expiry passes
+EXPIRY_BATCH = int(os.environ.get("EXPIRY_BATCH", 100))  # Intervals expired per keyspace per pass
+MAX_INTERVALS = int(os.environ.get("MAX_INTERVALS", 0))  # Per keyspace, 0 disables eviction
+SLOWLOG_THRESHOLD = float(os.environ.get("SLOWLOG_THRESHOLD", 0.01))  # Seconds, 0 disables
+SLOWLOG_SIZE = int(os.environ.get("SLOWLOG_SIZE", 128))  # Slow commands kept for SLOWLOG
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))  # Seconds between samples
+PROFILE_FILE = os.environ.get(
+    "PROFILE_FILE", os.path.join(tempfile.gettempdir(), "nks-profile.folded")
+)
 
 
 class CustomIntervalTree(IntervalTree):
+    """
+    IntervalTree that also keeps a per-name index, mapping each name to an
+    IntervalTree holding only that name's intervals, so name-scoped
+    operations never look at other names' intervals, the IntervalCounts
+    that COUNT, DISTINCT and COVERAGE are answered from, and the Expiry of
+    the intervals added with a TTL.
+    """
+
+    def __init__(self, intervals=None):
+        IntervalTree.__init__(self, intervals)
+        self.expiry = Expiry()
+        by_name = {}
+        for iv in self.all_intervals:
+            by_name.setdefault(iv.data, []).append(iv)
+        self.name_index = {name: IntervalTree(ivs) for name, ivs in by_name.items()}
+        self.counts = IntervalCounts((iv.begin, iv.end, iv.data) for iv in self.all_intervals)
+
+    def add(self, interval):
+        if interval in self:
+            return
+        IntervalTree.add(self, interval)
+        names = self.name_index.get(interval.data)
+        if names is None:
+            names = self.name_index[interval.data] = IntervalTree()
+        names.add(interval)
+        self.counts.add(interval.begin, interval.end, interval.data)
+
+    append = add
+
+    def remove(self, interval):
+        IntervalTree.remove(self, interval)
+        self._unindex(interval)
+
+    def discard(self, interval):
+        if interval not in self:
+            return
+        IntervalTree.discard(self, interval)
+        self._unindex(interval)
+
+    def _unindex(self, interval):
+        names = self.name_index[interval.data]
+        names.remove(interval)
+        if not names:
+            del self.name_index[interval.data]
+        self.counts.remove(interval.begin, interval.end, interval.data)
+        if self.expiry.deadlines:
+            self.expiry.discard(interval)
+
+    def bulk_update(self, intervals):
+        """
+        Adds many intervals at once. If the batch is at least as large as
+        the tree, the tree is rebuilt in place with the bulk constructor,
+        which is much cheaper than inserting and rebalancing one interval
+        at a time.
+        """
+        intervals = set(intervals)
+        if len(intervals) < len(self):
+            self.update(intervals)
+            return
+        intervals.update(self.all_intervals)
+        expiry = self.expiry
+        self.__init__(intervals)
+        self.expiry = expiry
+
+    def overlap_name(self, data, begin, end):
+        """
+        Returns the set of intervals named data overlapping [begin, end).
+        Only intervals named data are visited.
+        :rtype: set of Interval
+        """
+        names = self.name_index.get(data)
+        if not names or begin >= end:
+            return set()
+        return set(iter_overlap(names.top_node, begin, end))
+
+    def overlap(self, begin, end=None):
+        """
+        Returns the set of intervals overlapping [begin, end). Walks the
+        tree with iter_overlap instead of querying every boundary inside
+        the range, which IntervalTree.overlap does and which makes wide
+        queries on large trees orders of magnitude slower.
+        :rtype: set of Interval
+        """
+        if end is None:
+            begin, end = begin.begin, begin.end
+        if not self.top_node or begin >= end:
+            return set()
+        return set(iter_overlap(self.top_node, begin, end))
+
+    def iter_overlap(self, begin, end):
+        """
+        Yields the intervals overlapping [begin, end) one at a time.
+        :rtype: iterator of Interval
+        """
+        return iter_overlap(self.top_node, begin, end)
+
+    def copy_intervals(self):
+        """
+        :rtype: list of Interval unaffected by later changes to the tree
+        """
+        return list(self.all_intervals)
+
     def chop(self, begin, end, data=None):
         """
-        Like remove_envelop(), but trims back Intervals hanging into
-        the chopped area so that nothing overlaps.
+        Like remove_envelop(). With data, only intervals named data are
+        removed, and those hanging into the chopped area are trimmed back
+        so that nothing overlaps; without, intervals hanging into it are
+        left alone.
+        Completes in O((m + h)*log n) time, where:
+          * n = size of the tree
+          * m = number of enveloped intervals
+          * h = number of intervals hanging over begin or end
         """
-        insertions = set()
         begin = int(begin)
         end = int(end)
-        begin_hits = [iv for iv in self.at(begin) if iv.begin < begin and iv.data == data]
-        end_hits = [iv for iv in self.at(end) if iv.end > end and iv.data == data]
+        if begin >= end:
+            return
+        source = self.name_index.get(data) if data else self
+        if not source:
+            return
+        hanging = set()
         if data:
-            for iv in begin_hits:
-                insertions.add(Interval(iv.begin, begin, data))
-            for iv in end_hits:
-                insertions.add(Interval(end, iv.end, data))
-        else:
-            for iv in begin_hits:
-                insertions.add(Interval(iv.begin, begin, iv.data))
-            for iv in end_hits:
-                insertions.add(Interval(end, iv.end, iv.data))
-        self.remove_envelop(begin, end, data)
-        self.difference_update(begin_hits)
-        self.difference_update(end_hits)
+            hanging.update(iv for iv in source.at(begin) if iv.begin < begin)
+            hanging.update(iv for iv in source.at(end) if iv.begin < end)
+        insertions = {}  # Trimmed piece to the deadlines of the intervals it was cut from
+        for iv in hanging:
+            deadline = self.expiry.get(iv)
+            if iv.begin < begin:
+                insertions.setdefault(Interval(iv.begin, begin, iv.data), []).append(deadline)
+            if iv.end > end:
+                insertions.setdefault(Interval(end, iv.end, iv.data), []).append(deadline)
+        self.difference_update(search_envelop(source.top_node, begin, end, set()))
+        self.difference_update(hanging)
+        expiring = carried_deadlines(self, insertions)
         self.update(insertions)
+        for iv, deadline in expiring.items():
+            self.expiry.set(iv, deadline)
 
     def envelop(self, begin, end=None, data=None):
         """
         Returns the set of all intervals fully contained in the range
-        [begin, end).
-        Completes in O(m + k*log n) time, where:
+        [begin, end). With data, only intervals named data are returned.
+        Completes in O(m + s + log n) time, where:
           * n = size of the tree
           * m = number of matches
-          * k = size of the search range
+          * s = number of intervals centered on visited nodes
         :rtype: set of Interval
         """
-        root = self.top_node
-        if not root:
-            return set()
         if end is None:
             iv = begin
-            return self.envelop(iv.begin, iv.end)
+            return self.envelop(iv.begin, iv.end, data)
         elif begin >= end:
             return set()
-        result = root.search_point(begin, set())  # bound_begin might be greater
-        boundary_table = self.boundary_table
-        bound_begin = boundary_table.bisect_left(begin)
-        bound_end = boundary_table.bisect_left(end)  # up to, but not including end
-        result.update(
-            root.search_overlap(
-                # slice notation is slightly slower
-                boundary_table.keys()[index]
-                for index in range(bound_begin, bound_end)
-            )
-        )
-
-        # TODO: improve envelop() to use node info instead of less-efficient filtering
-        if data:
-            result = set(
-                iv for iv in result if iv.begin >= begin and iv.end <= end and iv.data == data
-            )
-        else:
-            result = set(iv for iv in result if iv.begin >= begin and iv.end <= end)
-        return result
+        source = self.name_index.get(data) if data else self
+        if not source:
+            return set()
+        return search_envelop(source.top_node, begin, end, set())
 
     def remove_envelop(self, begin, end, data=None):
         """
@@ -89,120 +235,1483 @@ class CustomIntervalTree(IntervalTree):
         for iv in hitlist:
             self.remove(iv)
 
+    def verify(self):
+        """
+        ## FOR DEBUGGING ONLY ##
+        Checks the tree and the per-name index are intact and in sync.
+        """
+        IntervalTree.verify(self)
+        counts = self.counts
+        assert list(counts.begins) == sorted(iv.begin for iv in self.all_intervals)
+        assert list(counts.ends) == sorted(iv.end for iv in self.all_intervals)
+        assert counts.names.keys() == self.name_index.keys()
+        indexed = set()
+        for name, names in self.name_index.items():
+            assert names, f"Error: empty name index for {name}"
+            assert all(iv.data == name for iv in names)
+            names.verify()
+            indexed.update(names)
+        assert indexed == self.all_intervals, "Error: name index is out of sync with the tree"
+        assert all(iv in self.all_intervals for iv in self.expiry.deadlines)
 
-TREE = CustomIntervalTree()
+
+def search_envelop(node, begin, end, result):
+    """
+    Adds the intervals under node that lie fully inside [begin, end) to
+    result. Every interval in a node's s_center contains its x_center, the
+    left subtree only holds intervals ending at or before x_center and the
+    right subtree only intervals beginning after it, so s_centers and
+    subtrees that cannot hold an enveloped interval are skipped.
+    :rtype: set of Interval
+    """
+    while node:
+        x_center = node.x_center
+        if begin <= x_center < end:
+            for iv in node.s_center:
+                if iv.begin >= begin and iv.end <= end:
+                    result.add(iv)
+        if begin < x_center:
+            if x_center < end:
+                search_envelop(node.right_node, begin, end, result)
+            node = node.left_node
+        elif x_center < end:
+            node = node.right_node
+        else:
+            break
+    return result
+
+
+def iter_overlap(node, begin, end):
+    """
+    Yields the intervals under node overlapping [begin, end) one at a time,
+    pruning subtrees the same way as search_envelop, so a caller that only
+    keeps a few of them never holds the whole hit set in memory.
+    :rtype: iterator of Interval
+    """
+    while node:
+        x_center = node.x_center
+        if begin <= x_center < end:
+            yield from node.s_center
+        else:
+            for iv in node.s_center:
+                if iv.begin < end and iv.end > begin:
+                    yield iv
+        if begin < x_center:
+            if x_center < end:
+                yield from iter_overlap(node.right_node, begin, end)
+            node = node.left_node
+        elif x_center < end:
+            node = node.right_node
+        else:
+            break
+
+
+def find_page(tree, begin, end, limit, cursor=None):
+    """
+    Returns the next `limit` sorted names of the intervals overlapping
+    [begin, end), after the (name, count) cursor of the previous page:
+    names before `name` and the first `count` copies of it are skipped.
+    Memory is bounded by `limit`, not by the number of hits.
+    When the range holds many hits per stored name, the page is read from
+    the cursor on, name by name in sorted order, counting each name's hits
+    with two bisects. Otherwise every hit is visited and the smallest kept.
+    :rtype: tuple of (list of names, cursor for the next page or None)
+    """
+    after, skip = cursor or ("", 0)
+    counts = tree.counts
+    hits = counts.count(begin, end)
+    # Reading name by name visits about limit * names / hits of them, the other way all hits
+    if limit * len(counts.names) < hits * hits:
+        page = []
+        for name in counts.names_from(after):
+            count = counts.count_name(name, begin, end) - (skip if name == after else 0)
+            if count > 0:
+                page.extend([name] * min(count, limit + 1 - len(page)))
+                if len(page) > limit:
+                    break
+    else:
+        page = heapq.nsmallest(limit + 1, find_names(tree, begin, end, after, skip))
+    if len(page) <= limit:
+        return page, None
+    page.pop()
+    return page, next_cursor(page, cursor)
+
+
+def find_names(tree, begin, end, after, skip):
+    """
+    :rtype: iterator of the names of the intervals overlapping [begin, end),
+            unsorted, without those before after and skip copies of after
+    """
+    seen = 0
+    for iv in tree.iter_overlap(begin, end):
+        name = iv.data
+        if name < after:
+            continue
+        if name == after:
+            seen += 1
+            if seen <= skip:
+                continue
+        yield name
+
+
+def next_cursor(page, cursor=None):
+    """
+    :rtype: tuple of (name, count) cursor for the page after this sorted,
+            non-empty page, which itself followed cursor
+    """
+    after, skip = cursor or ("", 0)
+    last = page[-1]
+    count = len(page) - bisect.bisect_left(page, last)
+    return last, count + skip if last == after else count
+
+
+def encode_stream(names, chunk_size):
+    """
+    Encodes a Counter of names as one sorted, space-separated response
+    line, a chunk of at most chunk_size names at a time.
+    :rtype: iterator of bytes
+    """
+    chunk = []
+    separator = ""
+    for name in sorted(names):
+        for _ in range(names[name]):
+            if len(chunk) == chunk_size:
+                yield str.encode(separator + " ".join(chunk))
+                chunk = []
+                separator = " "
+            chunk.append(name)
+    yield str.encode(separator + " ".join(chunk) + "\n")
+
+
+class RWLock:
+    """
+    Writer-preferring reader/writer lock. Any number of readers may hold
+    it at once, while a writer holds it alone. A waiting writer stops new
+    readers from entering, so a steady stream of FINDs cannot starve
+    ADD/DEL. Not reentrant.
+    """
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self.cond:
+            while self.writing or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writing or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+
+def new_tree(intervals=None, deadlines=None):
+    """
+    :param deadlines: dict of each expiring interval to its deadline
+    :rtype: CustomIntervalTree, or CompactIntervalTree if STORAGE is "compact"
+    """
+    tree = CompactIntervalTree(intervals) if STORAGE == "compact" else CustomIntervalTree(intervals)
+    if deadlines:
+        tree.expiry.update(deadlines)
+    return tree
+
+
+TREE = new_tree()
+EMPTY_TREE = new_tree()  # Read by commands naming keyspaces that do not exist
+TREE_LOCK = RWLock()  # Guards TREE: FINDs share it, ADD/DEL hold it exclusively
+TREE_VERSION = 0  # Bumped under the write lock by every change to TREE
+STATIC = None  # StaticIndex of TREE, answering point FINDs while its version is current
+WAL = None  # persistence.WriteAheadLog once restore_state() has run
+REPLICATION = None  # replication.ReplicationLog once start_replication() has run
+FOLLOWER = None  # replication.Follower when this server is a read-only replica
+FIND_CACHE = FindCache(FIND_CACHE_SIZE)
+KEYSPACES = {}  # Keyspace by name, for every keyspace but the default one
+KEYSPACES_LOCK = Lock()  # Guards creating and dropping keyspaces
+DEFAULT_KEYSPACE = "default"
+MERGED = Counter()  # Intervals removed by merging, by "insert" and "compact", and COMPACT runs
+EXPIRED = Counter()  # Intervals removed by "EXPIRE" records and by "EVICT" records
+METRICS = Metrics()
+SLOWLOG = SlowLog(SLOWLOG_THRESHOLD, SLOWLOG_SIZE)
+PROFILER = None  # profiler.Profiler once PROFILE START has run
+CONNECTION_SLOTS = BoundedSemaphore(MAX_CONNECTIONS or 2**31)  # Further clients are refused
 MAX_INT = 2 ** 32 - 1
+# accept() failures that leave the listening socket usable
+ACCEPT_ERRORS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM, errno.ECONNABORTED}
+INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9-_]")
+DIGITS = re.compile(r"[0-9]+")
+MAX_PROFILE_SECONDS = 86400
+FIND_OPTIONS = {"LIMIT", "AFTER", "STREAM"}
+# Metric labels; anything else is counted as "unknown" to keep the label set bounded
+COMMANDS = {
+    *("ADD", "DEL", "FIND", "MADD", "MDEL", "MFIND", "BINARY", "STATS", "COMPACT"),
+    *("COUNT", "DISTINCT", "COVERAGE", "USE", "FLUSH", "DROP", "SLOWLOG", "PROFILE"),
+}
+WRITE_COMMANDS = {"ADD", "DEL", "MADD", "MDEL", "COMPACT", "FLUSH", "DROP"}
+CREATING_COMMANDS = {"ADD", "MADD"}  # The commands that create the keyspace they name
+BINARY_COMMANDS = {
+    binary.OP_ADD: "binary.ADD",
+    binary.OP_DEL: "binary.DEL",
+    binary.OP_FIND: "binary.FIND",
+    binary.OP_RANGE: "binary.RANGE",
+    binary.OP_INTERN: "binary.INTERN",
+    binary.OP_NAME: "binary.NAME",
+}
 
 
-# Multithreaded Python server : TCP Server Socket Thread Pool
-class ClientThread(Thread):
-    def __init__(self, conn, ip, port):
-        Thread.__init__(self)
+def triples(args):
+    """Groups batch arguments into (begin, end, name) triples."""
+    return zip(*[iter(args)] * 3)
+
+
+def split_option(data, option):
+    """
+    Splits a trailing "<option> <value>" off an ADD or MADD. Its token
+    count tells it apart from a name: triples plus two tokens.
+    :rtype: tuple of (data without the option, str value or None)
+    """
+    if len(data) >= 6 and len(data) % 3 == 0 and data[-2] == option:
+        return data[:-2], data[-1]
+    return data, None
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def merge_add(tree, begin, end, name, deadline=None):
+    """
+    Adds [begin, end) named name to tree, joined with every same-name
+    interval it overlaps or touches. The merged interval expires with the
+    last of them, or never if one of them never does.
+    :rtype: tuple of the (begin, end) range the merged interval covers
+    """
+    deadlines = [deadline]
+    while True:
+        # [begin - 1, end + 1) overlaps exactly the intervals touching [begin, end)
+        touching = tree.overlap_name(name, max(begin - 1, 0), end + 1)
+        if not touching:
+            break
+        for iv in touching:
+            deadlines.append(tree.expiry.get(iv))
+            tree.discard(iv)
+            begin, end = min(begin, iv.begin), max(end, iv.end)
+        MERGED["insert"] += len(touching)
+    merged = Interval(begin, end, name)
+    tree.add(merged)
+    tree.expiry.set(merged, combined(deadlines))
+    return begin, end
+
+
+def coalesce(tree):
+    """
+    Replaces every run of overlapping or touching same-name intervals in
+    tree with one interval covering the run.
+    :rtype: int number of intervals removed
+    """
+    removed = 0
+    run = []
+    reach = None  # End of the current run
+    for iv in sorted(tree.copy_intervals(), key=lambda iv: (iv.data, iv.begin)):
+        if run and iv.data == run[0].data and iv.begin <= reach:
+            run.append(iv)
+            reach = max(reach, iv.end)
+            continue
+        removed += merge_run(tree, run, reach)
+        run, reach = [iv], iv.end
+    return removed + merge_run(tree, run, reach)
+
+
+def merge_run(tree, run, end):
+    """
+    Replaces a sorted run of touching same-name intervals ending at end
+    with a single interval.
+    :rtype: int number of intervals removed
+    """
+    if len(run) < 2:
+        return 0
+    deadlines = [tree.expiry.get(iv) for iv in run]
+    for iv in run:
+        tree.discard(iv)
+    merged = Interval(run[0].begin, end, run[0].data)
+    tree.add(merged)
+    tree.expiry.set(merged, combined(deadlines))
+    return len(run) - 1
+
+
+def apply_write(tree, data):
+    """
+    Applies a validated ADD, DEL, MADD, MDEL or COMPACT command to tree,
+    or a REMOVE record, which the shard router logs when it hands one
+    exact interval over to a worker. An ADD or MADD ending in
+    "EXPIRES <deadline>" adds intervals expiring at that time, in
+    milliseconds since the epoch; "EXPIRE <now> <limit>" and
+    "EVICT <size> [<limit>]" records remove expiring intervals, see
+    expire_write().
+    With MERGE_ON_INSERT, added intervals are merged with the same-name
+    intervals they touch, and the ranges the merged intervals cover are
+    returned.
+    :rtype: list of (begin, end), or None if only write_ranges(data) changed
+    """
+    if data[0] in ("EXPIRE", "EVICT"):
+        return expire_write(tree, data)
+    if data[0] in ("ADD", "MADD"):
+        data, deadline = split_option(data, "EXPIRES")
+        deadline = None if deadline is None else int(deadline)
+        added = [Interval(int(b), int(e), name) for b, e, name in triples(data[1:])]
+        if MERGE_ON_INSERT:
+            return [merge_add(tree, *iv, deadline) for iv in added]
+        if data[0] == "ADD":
+            tree.add(added[0])
+        else:
+            tree.bulk_update(added)
+        if deadline is not None or tree.expiry.deadlines:
+            # The latest ADD of an interval decides when, or whether, it expires
+            for iv in added:
+                tree.expiry.set(iv, deadline)
+    elif data[0] == "COMPACT":
+        MERGED["compact"] += coalesce(tree)
+        MERGED["runs"] += 1
+    elif data[0] == "REMOVE":
+        tree.discard(Interval(int(data[1]), int(data[2]), data[3]))
+    elif data[0] == "MDEL":
+        for begin, end, name in triples(data[1:]):
+            tree.chop(int(begin), int(end) + 1, name)
+    elif len(data) == 3:
+        tree.chop(int(data[1]), int(data[2]) + 1)
+    else:
+        tree.chop(int(data[1]), int(data[2]) + 1, data[3])
+
+
+def expire_write(tree, data):
+    """
+    Applies "EXPIRE <now> <limit>", which removes up to limit intervals
+    whose deadline is at or before now, or "EVICT <size> [<limit>]", which
+    removes up to limit of the intervals expiring soonest, stopping once
+    tree holds at most size. Intervals without a TTL are never evicted.
+    Both only depend on tree and their arguments, so replaying them
+    removes the same intervals.
+    :rtype: list of the (begin, end) of each interval removed
+    """
+    if data[0] == "EXPIRE":
+        removed = tree.expiry.pop_due(int(data[1]), int(data[2]))
+    else:
+        excess = len(tree) - int(data[1])
+        # Records logged before EVICT took a limit have none
+        removed = tree.expiry.pop_soonest(min(excess, int(data[2])) if len(data) > 2 else excess)
+    for iv in removed:
+        tree.discard(iv)
+    EXPIRED[data[0]] += len(removed)
+    return [(iv.begin, iv.end) for iv in removed]
+
+
+def write_ranges(data):
+    """
+    Yields the [begin, end) ranges of the tree a validated write command
+    can change.
+    """
+    if data[0] in ("EXPIRE", "EVICT"):
+        return  # Only the intervals expire_write() removes
+    data = split_option(data, "EXPIRES")[0]
+    if data[0] in ("MADD", "MDEL"):
+        for begin, end, _ in triples(data[1:]):
+            yield int(begin), int(end) + (data[0] == "MDEL")
+    elif data[0] == "COMPACT":
+        yield 0, MAX_INT + 1
+    else:
+        yield int(data[1]), int(data[2]) + (data[0] == "DEL")
+
+
+def commit_write(data, log=True):
+    """
+    Applies a validated write command to TREE and logs it, atomically.
+    :param log: False to leave logging it to the caller
+    """
+    global TREE_VERSION
+    with TREE_LOCK.write_lock():
+        TREE_VERSION += 1
+        changed = apply_write(TREE, data)
+        for begin, end in changed or write_ranges(data):
+            FIND_CACHE.invalidate(begin, end)
+        if log:
+            log_write(data)
+
+
+def log_write(data):
+    """Appends a write command to the WAL and the replication log, if enabled."""
+    if WAL or REPLICATION:
+        command = " ".join(data)
+        if WAL:
+            WAL.append(command)
+        if REPLICATION:
+            REPLICATION.append(command)
+
+
+def release(trees):
+    """
+    Empties a list holding the only references to detached trees on a
+    background thread, so freeing a large tree never delays a client.
+    """
+    Thread(target=trees.clear, daemon=True).start()
+
+
+class Keyspace:
+    """
+    A named tree, independent of every other one, selected with
+    USE <name> or an @<name> prefix. It has its own lock, FIND cache and
+    command stats, so writing to or reloading one keyspace never blocks
+    queries on another. Its writes are logged prefixed with @<name>.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.tree = new_tree()
+        self.lock = RWLock()
+        self.cache = FindCache(FIND_CACHE_SIZE)
+        self.stats = CommandStats()
+        self.dropped = False
+
+    def static_index(self):
+        return None  # Only the default keyspace keeps a static index
+
+    def commit(self, data):
+        """Applies a validated write command to the tree and logs it, atomically."""
+        with self.lock.write_lock():
+            if not self.dropped:
+                changed = apply_write(self.tree, data)
+                for begin, end in changed or write_ranges(data):
+                    self.cache.invalidate(begin, end)
+                log_write([f"@{self.name}", *data])
+                return
+        # Dropped since it was looked up: only an ADD or MADD recreates it, and
+        # other writes go to a keyspace recreated since, if any, or are dropped
+        get_keyspace(self.name, create=data[0] in CREATING_COMMANDS).commit(data)
+
+    def flush(self):
+        """Replaces the tree with an empty one."""
+        with self.lock.write_lock():
+            trees = [self.tree]
+            self.tree = new_tree()
+            self.cache.clear()
+            log_write([f"@{self.name}", "FLUSH"])
+        release(trees)
+
+    def register_gauges(self):
+        """
+        Registers keyspace.<name>.<stat> gauges, exported to Prometheus as
+        one keyspace_<stat> metric labelled with each keyspace's name.
+        """
+        gauges = {
+            "intervals": lambda: len(self.tree),
+            "commands": lambda: self.stats.calls,
+            "errors": lambda: self.stats.errors,
+            "p99_us": lambda: round(self.stats.quantile(0.99) * 1e6),
+        }
+        for stat, func in gauges.items():
+            METRICS.register_gauge(
+                f"keyspace.{self.name}.{stat}",
+                func,
+                family=f"keyspace.{stat}",
+                labels={"keyspace": self.name},
+            )
+
+    def unregister_gauges(self):
+        for stat in ("intervals", "commands", "errors", "p99_us"):
+            METRICS.unregister_gauge(f"keyspace.{self.name}.{stat}")
+
+
+class DefaultKeyspace:
+    """
+    The keyspace connections use until they send USE: TREE, guarded by
+    TREE_LOCK and cached in FIND_CACHE. Its writes are logged unprefixed.
+    """
+
+    name = DEFAULT_KEYSPACE
+    tree = property(lambda self: TREE)
+    lock = property(lambda self: TREE_LOCK)
+    cache = property(lambda self: FIND_CACHE)
+
+    def __init__(self):
+        self.stats = CommandStats()
+
+    def static_index(self):
+        return static_index()
+
+    def commit(self, data):
+        commit_write(data)
+
+    def flush(self):
+        """Replaces TREE with an empty tree."""
+        global TREE, TREE_VERSION
+        with TREE_LOCK.write_lock():
+            trees = [TREE]
+            TREE = new_tree()
+            TREE_VERSION += 1
+            FIND_CACHE.clear()
+            log_write(["FLUSH"])
+        release(trees)
+
+
+DEFAULT = DefaultKeyspace()
+
+
+class MissingKeyspace:
+    """
+    A keyspace that does not exist yet: reads see an empty tree, and only
+    an ADD or MADD that passed validation creates it. So naming keyspaces
+    in reads or USE never leaves trees, locks, caches and gauges behind.
+    """
+
+    tree = property(lambda self: EMPTY_TREE)
+    lock = RWLock()  # Only ever read-locked
+    cache = FindCache(0)
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = CommandStats()  # Discarded with the command
+
+    def static_index(self):
+        return None
+
+    def commit(self, data):
+        if data[0] in CREATING_COMMANDS:
+            get_keyspace(self.name).commit(data)
+        # Otherwise there is nothing to delete, compact or evict
+
+    def flush(self):
+        pass
+
+
+def get_keyspace(name, create=True):
+    """
+    :param create: False to look a keyspace up without creating it
+    :rtype: Keyspace called name, created empty if there is none unless
+        create is False, when a MissingKeyspace stands in for it, or
+        DEFAULT for the default keyspace
+    """
+    if name == DEFAULT_KEYSPACE:
+        return DEFAULT
+    keyspace = KEYSPACES.get(name)
+    if keyspace is None and not create:
+        return MissingKeyspace(name)
+    if keyspace is None:
+        with KEYSPACES_LOCK:
+            keyspace = KEYSPACES.get(name)
+            if keyspace is None:
+                keyspace = KEYSPACES[name] = Keyspace(name)
+                keyspace.register_gauges()
+    return keyspace
+
+
+def drop_keyspace(name):
+    """Removes a keyspace and its tree; using the name again starts an empty one."""
+    with KEYSPACES_LOCK:
+        keyspace = KEYSPACES.pop(name, None)
+        if keyspace is None:
+            return
+        with keyspace.lock.write_lock():
+            keyspace.dropped = True
+            trees = [keyspace.tree]
+            keyspace.tree = new_tree()
+            log_write([f"@{name}", "DROP"])
+    keyspace.unregister_gauges()
+    release(trees)
+
+
+def commit_add(keyspace, data):
+    """
+    Commits a validated ADD or MADD to keyspace, then evicts down to
+    MAX_INTERVALS. Eviction is committed as EVICT records of at most
+    EXPIRY_BATCH intervals each, so a large MADD past the cap never holds
+    the write lock for longer than one expiry pass does.
+    """
+    keyspace.commit(data)
+    if not MAX_INTERVALS:
+        return
+    keyspace = get_keyspace(keyspace.name, create=False)  # Created by the commit if missing
+    size = len(keyspace.tree)
+    while size > MAX_INTERVALS and len(keyspace.tree.expiry):
+        keyspace.commit(["EVICT", str(MAX_INTERVALS), str(EXPIRY_BATCH)])
+        size, before = len(keyspace.tree), size
+        if size >= before:
+            return  # Dropped, flushed or refilled meanwhile
+
+
+def commit_logged(data):
+    """
+    Applies a write command in the form it is logged to the WAL and to
+    followers: prefixed with @<keyspace> unless it is for the default one.
+    """
+    keyspace = DEFAULT
+    if data[0].startswith("@"):
+        keyspace, data = get_keyspace(data[0][1:]), data[1:]
+    if data[0] == "FLUSH":
+        keyspace.flush()
+    elif data[0] == "DROP":
+        drop_keyspace(keyspace.name)
+    else:
+        keyspace.commit(data)
+
+
+@contextmanager
+def read_locked_keyspaces():
+    """
+    Holds the read lock of every keyspace, and stops keyspaces from being
+    created or dropped, so they can be copied as of a single moment.
+    :rtype: context manager yielding a list of the keyspaces, DEFAULT first
+    """
+    with KEYSPACES_LOCK, ExitStack() as stack:
+        keyspaces = [DEFAULT, *(KEYSPACES[name] for name in sorted(KEYSPACES))]
+        for keyspace in keyspaces:
+            stack.enter_context(keyspace.lock.read_lock())
+        yield keyspaces
+
+
+def static_index():
+    """
+    :rtype: StaticIndex of TREE as it is now, or None if there is none yet
+        or it predates a write
+    """
+    index = STATIC
+    if index is not None and index.version == TREE_VERSION:
+        return index
+    return None
+
+
+class CommandHandler:
+    """
+    Validates and executes ADD/DEL/FIND commands against the connection's
+    keyspace, TREE until it sends USE.
+    Commands are newline-framed until a client switches the connection to
+    the binary protocol with BINARY; feed() accepts raw bytes as they
+    arrive, runs every complete command and returns their responses joined
+    together, so the same logic serves both the threaded and the asyncio
+    server modes. Once ``closed`` is set the connection should be dropped.
+    """
+
+    def __init__(self, conn):
         self.conn = conn
-        self.ip = ip
-        self.port = port
-        logger.debug(f"[+] New server socket thread started for {ip}:{port}")
+        self.buffer = b""
+        self.discarding = False
+        self.binary = False
+        self.names = None  # binary.NameTable of the name ids handed out, once BINARY has run
+        self.closed = False
+        self.pending = None
+        self.use = DEFAULT_KEYSPACE  # Chosen with USE
+        self.keyspace = DEFAULT  # The current command's keyspace
+        self.results = None  # Results the current command returned, for SLOWLOG
 
-    def run(self):
-        while True:
-            data = self.conn.recv(2048).decode("utf-8").strip().split()
-            is_valid = self.validate_data(data)
-            if not is_valid:
+    def feed(self, chunk):
+        """
+        Consume received bytes and execute every complete command in them.
+        Partial commands are kept until the rest of the line arrives.
+        :rtype: bytes of all responses, in command order
+        """
+        return b"".join(self.feed_chunks(chunk))
+
+    def feed_chunks(self, chunk):
+        """
+        Like feed(), but yields the responses in pieces. Streamed responses
+        are only encoded as the caller asks for the next piece, so a caller
+        that sends each piece before asking for the next one never holds
+        more than a chunk of them in memory.
+        :rtype: iterator of bytes
+        """
+        batch = []
+        for response in self.collect(chunk):
+            if isinstance(response, bytes):
+                batch.append(response)
                 continue
-            self.perform_action(data)
+            if batch:
+                yield b"".join(batch)
+                batch = []
+            yield from response
+        if batch:
+            yield b"".join(batch)
+
+    def collect(self, chunk):
+        """
+        Executes every complete command in chunk, queueing their responses.
+        :rtype: list of responses, each bytes or an iterator of bytes
+        """
+        self.pending = []
+        try:
+            self.buffer += chunk
+            if not self.binary:
+                self.feed_lines()
+            if self.binary:
+                self.feed_frames()
+        finally:
+            pending, self.pending = self.pending, None
+        return pending
+
+    def feed_lines(self):
+        buffer = self.buffer
+        start = 0
+        while not self.binary:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            start = end + 1
+            if self.discarding:
+                self.discarding = False  # Tail end of an over-long command
+                continue
+            if len(line) > MAX_LINE_SIZE:
+                self.reply(str.encode("ERROR command too long\n"))
+                continue
+            self.handle_line(line)
+        self.buffer = buffer[start:]
+        if not self.binary and len(self.buffer) > MAX_LINE_SIZE:
+            self.buffer = b""
+            if not self.discarding:
+                self.reply(str.encode("ERROR command too long\n"))
+            self.discarding = True
+
+    def feed_frames(self):
+        payloads, self.buffer = binary.split_frames(self.buffer, MAX_LINE_SIZE)
+        for payload in payloads:
+            self.handle_frame(payload)
+        if self.buffer is None:
+            # The stream cannot be resynchronised after an oversized frame
+            self.buffer = b""
+            self.reply(binary.error("frame too long"))
+            self.closed = True
+
+    def handle_frame(self, payload):
+        actions = {
+            binary.OP_ADD: self.perform_binary_write,
+            binary.OP_DEL: self.perform_binary_write,
+            binary.OP_FIND: self.perform_binary_find,
+            binary.OP_RANGE: self.perform_binary_find,
+            binary.OP_INTERN: self.perform_binary_intern,
+            binary.OP_NAME: self.perform_binary_name,
+        }
+        action = actions.get(payload[0]) if payload else None
+        if action is None:
+            METRICS.record("binary.unknown", error=True)
+            self.reply(binary.error("invalid command"))
+            return
+        command = BINARY_COMMANDS[payload[0]]
+        self.keyspace = get_keyspace(self.use, create=False)
+        start = time.perf_counter()
+        try:
+            response = action(payload[0], payload[1:])
+        except struct.error:
+            response = binary.error("malformed frame")
+        METRICS.record(command, time.perf_counter() - start, response[4] == binary.STATUS_ERROR)
+        self.reply(response)
+
+    def perform_binary_write(self, opcode, body):
+        if FOLLOWER:
+            return binary.error("read-only replica")
+        begin, end, name_id = binary.TRIPLE.unpack(body)
+        command = "ADD" if opcode == binary.OP_ADD else "DEL"
+        if command == "ADD" and begin >= end:
+            return binary.error("begin must be less than end")
+        if command == "DEL" and name_id == binary.ANY_NAME:
+            self.keyspace.commit([command, str(begin), str(end)])
+            return binary.ok()
+        name = self.names.name(name_id)
+        if name is None:
+            return binary.error("unknown name id")
+        data = [command, str(begin), str(end), name]
+        if command == "ADD":
+            commit_add(self.keyspace, data)
+        else:
+            self.keyspace.commit(data)
+        return binary.ok()
+
+    def perform_binary_find(self, opcode, body):
+        index = self.keyspace.static_index()
+        if index is not None and opcode == binary.OP_FIND:
+            names = index.find_names(binary.UINT32.unpack(body)[0])
+            return binary.encode_ids([self.names.intern(name) for name in names])
+        with self.keyspace.lock.read_lock():
+            if opcode == binary.OP_FIND:
+                hits = self.keyspace.tree.at(binary.UINT32.unpack(body)[0])
+            else:
+                hits = self.keyspace.tree.overlap(*binary.PAIR.unpack(body))
+        names = sorted([iv.data for iv in hits])
+        return binary.encode_ids([self.names.intern(name) for name in names])
+
+    def perform_binary_intern(self, opcode, body):
+        name = body.decode("utf-8", errors="replace")
+        if not name or not validate_text_arg(name):
+            return binary.error("name arg must be a string")
+        return binary.ok(binary.UINT32.pack(self.names.intern(name)))
+
+    def perform_binary_name(self, opcode, body):
+        name = self.names.name(binary.UINT32.unpack(body)[0])
+        if name is None:
+            return binary.error("unknown name id")
+        return binary.ok(str.encode(name))
+
+    def handle_line(self, line):
+        data = line.decode("utf-8", errors="replace").strip().split()
+        if not data:
+            return
+        keyspace = self.use
+        if data[0].startswith("@"):
+            # @<keyspace> <command> runs one command against another keyspace
+            keyspace, data = data[0][1:], data[1:]
+            if not (data and keyspace and validate_text_arg(keyspace)):
+                METRICS.record("unknown", error=True)
+                self.reply(str.encode("ERROR invalid keyspace\n"))
+                return
+        self.keyspace = get_keyspace(keyspace, create=False)
+        command = data[0] if data[0] in COMMANDS else "unknown"
+        start = time.perf_counter()
+        valid = self.validate_data(data)
+        validated = time.perf_counter()
+        METRICS.histogram("validate").record(validated - start)
+        if not valid:
+            METRICS.record(command, error=True)
+            self.keyspace.stats.record_call(None, True)
+            return
+        self.results = None
+        self.perform_action(data)
+        seconds = time.perf_counter() - validated
+        if isinstance(self.keyspace, MissingKeyspace):
+            self.keyspace = get_keyspace(self.keyspace.name, create=False)  # Created if it added
+        METRICS.record(command, seconds)
+        self.keyspace.stats.record_call(seconds, False)
+        if SLOWLOG.is_slow(seconds):
+            self.log_slow(data, seconds)
+
+    def log_slow(self, data, seconds):
+        keyspace = self.keyspace
+        entry = SLOWLOG.record(data, seconds, keyspace.name, self.results, len(keyspace.tree))
+        logger.warning(f"Slow command: {entry}")
+
+    def reply(self, response):
+        """
+        Queue a response while feeding, otherwise send it straight away.
+        A response is either bytes or an iterator of bytes to stream.
+        """
+        if self.pending is not None:
+            self.pending.append(response)
+        elif isinstance(response, bytes):
+            self.conn.send(response)
+        else:
+            for piece in response:
+                self.conn.sendall(piece)
 
     def perform_action(self, data):
-        actions = {"ADD": self.perform_add, "DEL": self.perform_delete, "FIND": self.perform_find}
+        actions = {
+            "ADD": self.perform_add,
+            "DEL": self.perform_delete,
+            "FIND": self.perform_find,
+            "MADD": self.perform_add,
+            "MDEL": self.perform_delete,
+            "MFIND": self.perform_multi_find,
+            "BINARY": self.perform_binary,
+            "STATS": self.perform_stats,
+            "COMPACT": self.perform_compact,
+            "COUNT": self.perform_count,
+            "DISTINCT": self.perform_count,
+            "COVERAGE": self.perform_coverage,
+            "USE": self.perform_use,
+            "FLUSH": self.perform_flush,
+            "DROP": self.perform_drop,
+            "SLOWLOG": self.perform_slowlog,
+            "PROFILE": self.perform_profile,
+        }
         actions[data[0]](data)
 
+    def perform_binary(self, data):
+        self.reply(str.encode("OK\n"))
+        self.binary = True
+        self.names = binary.NameTable()
+
+    def perform_stats(self, data):
+        self.reply(str.encode(METRICS.format_stats() + "\n"))
+
+    def perform_slowlog(self, data):
+        if data[1:] == ["RESET"]:
+            SLOWLOG.reset()
+            self.reply(str.encode("OK\n"))
+            return
+        # One ";"-separated entry per slow command, newest first
+        entries = SLOWLOG.latest(int(data[1]) if len(data) > 1 else None)
+        self.reply(str.encode(";".join(format_entry(entry) for entry in entries) + "\n"))
+
+    def perform_profile(self, data):
+        global PROFILER
+        if PROFILER is None:
+            PROFILER = Profiler(profile_roots(), PROFILE_INTERVAL)
+        if data[1] == "START":
+            seconds = int(data[2]) if len(data) > 2 else None
+            if not PROFILER.start(PROFILE_FILE, seconds):
+                self.reply(str.encode("ERROR profiler is already running\n"))
+                return
+            logger.info(f"Profiling to {PROFILE_FILE}")
+            self.reply(str.encode("OK\n"))
+            return
+        samples = PROFILER.stop()
+        if samples is None:
+            self.reply(str.encode("ERROR profiler is not running\n"))
+            return
+        logger.info(f"Wrote {samples} profile samples to {PROFILE_FILE}")
+        self.reply(str.encode(PROFILE_FILE + "\n"))
+
     def perform_add(self, data):
-        TREE[int(data[1]) : int(data[2])] = data[3]
-        self.conn.send(str.encode("OK\n"))
+        data, ttl = split_option(data, "TTL")
+        if ttl is not None:
+            # Logged with the deadline itself, so replaying the log later expires it on time
+            data = [*data, "EXPIRES", str(now_ms() + int(ttl) * 1000)]
+        commit_add(self.keyspace, data)
+        self.reply(str.encode("OK\n"))
 
     def perform_delete(self, data):
-        if len(data) == 3:
-            TREE.chop(int(data[1]), int(data[2]) + 1)
-        else:
-            TREE.chop(int(data[1]), int(data[2]) + 1, data[3])
-        self.conn.send(str.encode("OK\n"))
+        self.keyspace.commit(data)
+        self.reply(str.encode("OK\n"))
+
+    def perform_compact(self, data):
+        self.keyspace.commit(data)
+        self.reply(str.encode("OK\n"))
 
     def perform_find(self, data):
-        results = []
-        if len(data) == 2:
-            results = sorted([iv.data for iv in TREE.at(int(data[1]))])
+        query, options = split_find_options(data)
+        if "STREAM" in options:
+            self.perform_streamed_find(query)
+            return
+        if "LIMIT" in options:
+            self.perform_paged_find(query, int(options["LIMIT"]), options.get("AFTER"))
+            return
+        index = self.keyspace.static_index()
+        if index is not None and len(data) == 2:
+            response = index.find(int(data[1]))
+            self.results = count_names(response)
+            self.reply(response)
+            return
+        key = tuple(data)
+        response = self.keyspace.cache.get(key)
+        if response is not None:
+            self.results = count_names(response)
+            self.reply(response)
+            return
+        with self.keyspace.lock.read_lock():
+            generation = self.keyspace.cache.generation
+            if len(data) == 2:
+                begin = int(data[1])
+                end = begin + 1
+                hits = self.keyspace.tree.at(begin)
+            elif len(data) == 3:
+                begin, end = int(data[1]), int(data[2])
+                hits = self.keyspace.tree.overlap(begin, end)
+            else:
+                begin, end = int(data[2]), int(data[3])
+                hits = self.keyspace.tree.overlap_name(data[1], begin, end)
+        if len(data) < 4:
+            results = sorted([iv.data for iv in hits])
         else:
-            results = sorted([iv.data for iv in TREE.overlap(int(data[1]), int(data[2]))])
+            hits = sorted(hits)
+            results = [f"{iv.begin}-{iv.end}" for iv in hits]
+            if hits:
+                # The answer also depends on how far the matched intervals extend
+                begin = min(begin, hits[0].begin)
+                end = max(end, max(iv.end for iv in hits))
+        self.results = len(results)
         if not results:
-            self.conn.send(str.encode("ERROR no results\n"))
+            response = str.encode("ERROR no results\n")
+        else:
+            response = str.encode(" ".join(results) + "\n")
+        self.keyspace.cache.put(key, response, begin, end, generation)
+        self.reply(response)
+
+    def perform_use(self, data):
+        self.use = data[1]
+        self.reply(str.encode("OK\n"))
+
+    def perform_flush(self, data):
+        self.keyspace.flush()
+        self.reply(str.encode("OK\n"))
+
+    def perform_drop(self, data):
+        drop_keyspace(self.keyspace.name)
+        self.reply(str.encode("OK\n"))
+
+    def perform_count(self, data):
+        begin, end = find_range(data)
+        with self.keyspace.lock.read_lock():
+            if data[0] == "COUNT":
+                total = self.keyspace.tree.counts.count(begin, end)
+            else:
+                total = self.keyspace.tree.counts.distinct(begin, end)
+        self.results = total
+        self.reply(str.encode(f"{total}\n"))
+
+    def perform_coverage(self, data):
+        begin, end = (int(data[2]), int(data[3])) if len(data) == 4 else (0, MAX_INT + 1)
+        with self.keyspace.lock.read_lock():
+            covered = self.keyspace.tree.counts.coverage(data[1], begin, end)
+        self.reply(str.encode(f"{covered}\n"))
+
+    def perform_paged_find(self, query, limit, after):
+        begin, end = find_range(query)
+        keyspace = self.keyspace
+        cursor = after and parse_cursor(after)
+        with keyspace.lock.read_lock():
+            page, cursor = find_page(keyspace.tree, begin, end, limit, cursor)
+        self.results = len(page)
+        if not page and after is None:
+            self.reply(str.encode("ERROR no results\n"))
+            return
+        # The cursor follows a ";" (never part of a name) and is empty on the last page
+        cursor = f"{cursor[0]}:{cursor[1]}" if cursor else ""
+        self.reply(str.encode(" ".join(page) + ";" + cursor + "\n"))
+
+    def perform_streamed_find(self, query):
+        begin, end = find_range(query)
+        # Only a count per distinct name is kept; the line itself is encoded as it is sent
+        with self.keyspace.lock.read_lock():
+            names = Counter(iv.data for iv in self.keyspace.tree.iter_overlap(begin, end))
+        self.results = sum(names.values())
+        if not names:
+            self.reply(str.encode("ERROR no results\n"))
             return
-        response = " ".join(results) + "\n"
-        self.conn.send(str.encode(response))
+        self.reply(encode_stream(names, STREAM_CHUNK))
+
+    def perform_multi_find(self, data):
+        # One ";"-separated field of sorted names per point, empty if nothing matched
+        index = self.keyspace.static_index()
+        if index is not None:
+            responses = index.find_many([int(point) for point in data[1:]])
+            fields = [b"" if r is NO_RESULTS else r[:-1] for r in responses]
+            self.results = sum(count_names(r) for r in responses)
+            self.reply(b";".join(fields) + b"\n")
+            return
+        with self.keyspace.lock.read_lock():
+            hits = [self.keyspace.tree.at(int(point)) for point in data[1:]]
+        self.results = sum(len(h) for h in hits)
+        response = ";".join(" ".join(sorted([iv.data for iv in h])) for h in hits) + "\n"
+        self.reply(str.encode(response))
 
     def validate_data(self, data):
         validator = {
             "ADD": self.validate_add,
             "DEL": self.validate_delete,
             "FIND": self.validate_find,
+            "MADD": self.validate_multi_add,
+            "MDEL": self.validate_multi_delete,
+            "MFIND": self.validate_multi_find,
+            "BINARY": self.validate_binary,
+            "STATS": self.validate_stats,
+            "COMPACT": self.validate_compact,
+            "COUNT": self.validate_count,
+            "DISTINCT": self.validate_count,
+            "COVERAGE": self.validate_coverage,
+            "USE": self.validate_use,
+            "FLUSH": self.validate_flush,
+            "DROP": self.validate_drop,
+            "SLOWLOG": self.validate_slowlog,
+            "PROFILE": self.validate_profile,
         }
         if len(data) == 0:
             return False
+        elif FOLLOWER and data[0] in WRITE_COMMANDS:
+            self.reply(str.encode("ERROR read-only replica\n"))
+            return False
         elif validator.get(data[0]):
             return validator[data[0]](data)
-        self.conn.send(str.encode("ERROR invalid command\n"))
+        self.reply(str.encode("ERROR invalid command\n"))
         return False
 
     def validate_add(self, data):
+        data, ttl = split_option(data, "TTL")
+        if ttl is not None and not self.validate_ttl(ttl):
+            return False
         if len(data) != 4:
-            self.conn.send(str.encode("ERROR invalid ADD command\n"))
+            self.reply(str.encode("ERROR invalid ADD command\n"))
             return False
         first_arg_valid, response = validate_numeric_arg(data[1], place="first")
         if not first_arg_valid:
-            self.conn.send(response)
+            self.reply(response)
             return False
         second_arg_valid, response = validate_numeric_arg(data[2], place="second")
         if not second_arg_valid:
-            self.conn.send(response)
+            self.reply(response)
             return False
         third_arg_valid = validate_text_arg(data[3])
         if not third_arg_valid:
-            self.conn.send(str.encode("ERROR name arg must be a string\n"))
+            self.reply(str.encode("ERROR name arg must be a string\n"))
+            return False
+        if int(data[1]) >= int(data[2]):
+            self.reply(str.encode("ERROR begin must be less than end\n"))
+            return False
+        return True
+
+    def validate_multi_add(self, data):
+        data, ttl = split_option(data, "TTL")
+        if ttl is not None and not self.validate_ttl(ttl):
+            return False
+        if len(data) < 4 or len(data) % 3 != 1:
+            self.reply(str.encode("ERROR invalid MADD command\n"))
+            return False
+        return all(self.validate_add(["ADD", *args]) for args in triples(data[1:]))
+
+    def validate_ttl(self, ttl):
+        if not (ttl.isascii() and ttl.isdigit()) or not 0 < int(ttl) <= MAX_INT:
+            self.reply(str.encode("ERROR TTL must be a positive integer\n"))
+            return False
+        return True
+
+    def validate_multi_delete(self, data):
+        if len(data) < 4 or len(data) % 3 != 1:
+            self.reply(str.encode("ERROR invalid MDEL command\n"))
+            return False
+        return all(self.validate_delete(["DEL", *args]) for args in triples(data[1:]))
+
+    def validate_multi_find(self, data):
+        if len(data) < 2:
+            self.reply(str.encode("ERROR invalid MFIND command\n"))
+            return False
+        for point in data[1:]:
+            arg_valid, response = validate_numeric_arg(point)
+            if not arg_valid:
+                self.reply(response)
+                return False
+        return True
+
+    def validate_binary(self, data):
+        if len(data) != 1:
+            self.reply(str.encode("ERROR invalid BINARY command\n"))
+            return False
+        return True
+
+    def validate_stats(self, data):
+        if len(data) != 1:
+            self.reply(str.encode("ERROR invalid STATS command\n"))
+            return False
+        return True
+
+    def validate_compact(self, data):
+        if len(data) != 1:
+            self.reply(str.encode("ERROR invalid COMPACT command\n"))
+            return False
+        return True
+
+    def validate_use(self, data):
+        if len(data) != 2 or not validate_text_arg(data[1]):
+            self.reply(str.encode("ERROR invalid USE command\n"))
             return False
         return True
 
+    def validate_flush(self, data):
+        if len(data) != 1:
+            self.reply(str.encode("ERROR invalid FLUSH command\n"))
+            return False
+        return True
+
+    def validate_drop(self, data):
+        if len(data) != 1:
+            self.reply(str.encode("ERROR invalid DROP command\n"))
+            return False
+        if self.keyspace is DEFAULT:
+            self.reply(str.encode("ERROR cannot drop the default keyspace\n"))
+            return False
+        return True
+
+    def validate_slowlog(self, data):
+        # SLOWLOG [<count> | RESET]
+        count = data[1] if len(data) == 2 and data[1] != "RESET" else "0"
+        if len(data) > 2 or not validate_digits(count) or int(count) > MAX_INT:
+            self.reply(str.encode("ERROR invalid SLOWLOG command\n"))
+            return False
+        return True
+
+    def validate_profile(self, data):
+        # PROFILE START [<seconds>] | PROFILE STOP
+        if data[1:] == ["STOP"]:
+            return True
+        if data[1:2] != ["START"] or len(data) > 3:
+            self.reply(str.encode("ERROR invalid PROFILE command\n"))
+            return False
+        if len(data) == 3 and not (
+            validate_digits(data[2]) and 0 < int(data[2]) <= MAX_PROFILE_SECONDS
+        ):
+            self.reply(str.encode(f"ERROR seconds must be from 1 to {MAX_PROFILE_SECONDS}\n"))
+            return False
+        return True
+
+    def validate_count(self, data):
+        # COUNT|DISTINCT <point> | <begin> <end>
+        if len(data) not in (2, 3):
+            self.reply(str.encode(f"ERROR invalid {data[0]} command\n"))
+            return False
+        for arg, place in zip(data[1:], ("first", "second")):
+            arg_valid, response = validate_numeric_arg(arg, place=place)
+            if not arg_valid:
+                self.reply(response)
+                return False
+        return True
+
+    def validate_coverage(self, data):
+        # COVERAGE <name> [<begin> <end>]
+        if len(data) not in (2, 4):
+            self.reply(str.encode("ERROR invalid COVERAGE command\n"))
+            return False
+        if not validate_text_arg(data[1]):
+            self.reply(str.encode("ERROR name arg must be a string\n"))
+            return False
+        for arg, place in zip(data[2:], ("second", "third")):
+            arg_valid, response = validate_numeric_arg(arg, place=place)
+            if not arg_valid:
+                self.reply(response)
+                return False
+        return True
+
     def validate_delete(self, data):
         if len(data) not in (3, 4):
-            self.conn.send(str.encode("ERROR invalid DEL command\n"))
+            self.reply(str.encode("ERROR invalid DEL command\n"))
             return False
         first_arg_valid, response = validate_numeric_arg(data[1], place="first")
         if not first_arg_valid:
-            self.conn.send(response)
+            self.reply(response)
             return False
         second_arg_valid, response = validate_numeric_arg(data[2], place="second")
         if not second_arg_valid:
-            self.conn.send(response)
+            self.reply(response)
             return False
         if len(data) > 3:
             third_arg_valid = validate_text_arg(data[3])
             if not third_arg_valid:
-                self.conn.send(str.encode("ERROR name arg must be a string\n"))
+                self.reply(str.encode("ERROR name arg must be a string\n"))
                 return False
         return True
 
     def validate_find(self, data):
-        if len(data) not in (2, 3):
-            self.conn.send(str.encode("ERROR invalid FIND command\n"))
+        query, options = split_find_options(data)
+        if options is None:
+            self.reply(str.encode("ERROR invalid FIND command\n"))
+            return False
+        if options:
+            return self.validate_find_options(query, options)
+        if len(data) not in (2, 3, 4):
+            self.reply(str.encode("ERROR invalid FIND command\n"))
             return False
+        if len(data) == 4:
+            return self.validate_find_name(data)
         first_arg_valid, response = validate_numeric_arg(data[1], place="first")
         if not first_arg_valid:
-            self.conn.send(response)
+            self.reply(response)
             return False
         if len(data) > 2:
             second_arg_valid, response = validate_numeric_arg(data[2], place="second")
             if not second_arg_valid:
-                self.conn.send(response)
+                self.reply(response)
                 return False
         return True
 
+    def validate_find_options(self, query, options):
+        # FIND <point> | <begin> <end>, then STREAM or LIMIT <n> [AFTER <name>:<count>]
+        if len(query) not in (2, 3) or ("STREAM" in options and len(options) > 1):
+            self.reply(str.encode("ERROR invalid FIND command\n"))
+            return False
+        if "AFTER" in options and "LIMIT" not in options:
+            self.reply(str.encode("ERROR invalid FIND command\n"))
+            return False
+        if "LIMIT" in options and not (
+            validate_digits(options["LIMIT"]) and 0 < int(options["LIMIT"]) <= MAX_INT
+        ):
+            self.reply(str.encode("ERROR invalid LIMIT\n"))
+            return False
+        if "AFTER" in options and parse_cursor(options["AFTER"]) is None:
+            self.reply(str.encode("ERROR invalid cursor\n"))
+            return False
+        return self.validate_find(query)
+
+    def validate_find_name(self, data):
+        # FIND <name> <begin> <end>
+        if not validate_text_arg(data[1]):
+            self.reply(str.encode("ERROR name arg must be a string\n"))
+            return False
+        if not (validate_digits(data[2]) and validate_digits(data[3])):
+            self.reply(str.encode("ERROR invalid FIND command\n"))
+            return False
+        second_arg_valid, response = validate_numeric_arg(data[2], place="second")
+        if not second_arg_valid:
+            self.reply(response)
+            return False
+        third_arg_valid, response = validate_numeric_arg(data[3], place="third")
+        if not third_arg_valid:
+            self.reply(response)
+            return False
+        return True
+
+
+# Multithreaded Python server : TCP Server Socket Thread Pool
+class ClientThread(CommandHandler, Thread):
+    def __init__(self, conn, ip, port, slot=None):
+        Thread.__init__(self)
+        CommandHandler.__init__(self, conn)
+        self.ip = ip
+        self.port = port
+        self.slot = slot  # Released when the connection closes
+        logger.debug(f"[+] New server socket thread started for {ip}:{port}")
+
+    def run(self):
+        METRICS.connection_opened()
+        # Reads and writes that stall for IDLE_TIMEOUT end the connection
+        self.conn.settimeout(IDLE_TIMEOUT or None)
+        try:
+            self.serve()
+        except socket.timeout:
+            METRICS.increment("connections.timed_out")
+            logger.debug(f"[-] Closing idle connection from {self.ip}:{self.port}")
+        except OSError as e:
+            METRICS.increment("connections.errors")
+            logger.debug(f"[-] Connection from {self.ip}:{self.port} failed: {e}")
+        finally:
+            METRICS.connection_closed()
+            self.conn.close()
+            if self.slot:
+                self.slot.release()
+
+    def serve(self):
+        while True:
+            start = time.perf_counter()
+            chunk = self.conn.recv(RECV_SIZE)
+            METRICS.histogram("recv").record(time.perf_counter() - start)
+            if not chunk:
+                break
+            METRICS.increment("bytes.received", len(chunk))
+            # sendall() blocks until each piece is out, which throttles streamed responses
+            for response in self.feed_chunks(chunk):
+                start = time.perf_counter()
+                self.conn.sendall(response)
+                METRICS.histogram("send").record(time.perf_counter() - start)
+                METRICS.increment("bytes.sent", len(response))
+            if self.closed:
+                break
+
+
+class StreamConnection:
+    """Adapts an asyncio StreamWriter to the socket-like ``send`` used by CommandHandler."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data):
+        self.writer.write(data)
+        return len(data)
+
+
+async def handle_stream(reader, writer):
+    """
+    Serves a single client connection on the event loop.
+    Idle connections only cost a StreamReader/StreamWriter pair instead
+    of a whole OS thread.
+    """
+    ip, port = writer.get_extra_info("peername")[:2]
+    if not CONNECTION_SLOTS.acquire(blocking=False):
+        METRICS.increment("connections.refused")
+        writer.write(str.encode("ERROR server busy\n"))
+        writer.close()
+        return
+    logger.debug(f"[+] New event-loop connection from {ip}:{port}")
+    handler = CommandHandler(StreamConnection(writer))
+    METRICS.connection_opened()
+    timeout = IDLE_TIMEOUT or None
+    try:
+        while True:
+            start = time.perf_counter()
+            chunk = await asyncio.wait_for(reader.read(RECV_SIZE), timeout)
+            METRICS.histogram("recv").record(time.perf_counter() - start)
+            if not chunk:
+                break
+            METRICS.increment("bytes.received", len(chunk))
+            # Draining after each piece throttles streamed responses to the client's pace
+            for response in handler.feed_chunks(chunk):
+                start = time.perf_counter()
+                writer.write(response)
+                await asyncio.wait_for(writer.drain(), timeout)
+                METRICS.histogram("send").record(time.perf_counter() - start)
+                METRICS.increment("bytes.sent", len(response))
+            if handler.closed:
+                break
+    except asyncio.TimeoutError:
+        METRICS.increment("connections.timed_out")
+        logger.debug(f"[-] Closing idle connection from {ip}:{port}")
+    except OSError as e:
+        METRICS.increment("connections.errors")
+        logger.debug(f"[-] Connection from {ip}:{port} failed: {e}")
+    finally:
+        METRICS.connection_closed()
+        writer.close()
+        CONNECTION_SLOTS.release()
+
+
+def count_names(response):
+    """:rtype: int names in a FIND response"""
+    if response.startswith(b"ERROR"):
+        return 0
+    return response.count(b" ") + 1
+
+
+def split_find_options(data):
+    """
+    Splits a FIND command into its query and the LIMIT <n>, AFTER <cursor>
+    and STREAM options following it. Options are only looked for after the
+    first argument, so a named FIND may still use a name such as LIMIT.
+    :rtype: tuple of (query tokens, dict of option to value, or None if malformed)
+    """
+    index = next((i for i in range(2, len(data)) if data[i] in FIND_OPTIONS), len(data))
+    query, rest = data[:index], data[index:]
+    options = {}
+    while rest:
+        option = rest[0]
+        if option not in FIND_OPTIONS or option in options:
+            return query, None
+        if option == "STREAM":
+            options[option], rest = True, rest[1:]
+        elif len(rest) < 2:
+            return query, None
+        else:
+            options[option], rest = rest[1], rest[2:]
+    return query, options
+
+
+def parse_cursor(text):
+    """
+    :rtype: tuple of (name, count) from a "<name>:<count>" cursor, or None
+    """
+    name, separator, count = text.rpartition(":")
+    if not separator or not name or not validate_text_arg(name) or not validate_digits(count):
+        return None
+    return name, int(count)
+
+
+def find_range(query):
+    """
+    :rtype: tuple of the [begin, end) range queried by FIND <point> or FIND <begin> <end>
+    """
+    if len(query) == 2:
+        return int(query[1]), int(query[1]) + 1
+    return int(query[1]), int(query[2])
+
 
 def validate_numeric_arg(data, place="first"):
     try:
@@ -216,30 +1725,406 @@ def validate_numeric_arg(data, place="first"):
     return True, ""
 
 
+def validate_digits(data):
+    """
+    str.isdigit() also accepts characters int() rejects, such as "²"
+    :rtype: bool True if data is a non-negative integer in ASCII digits
+    """
+    return DIGITS.fullmatch(data) is not None
+
+
 def validate_text_arg(data):
     # Check that string only made up of allowed characters
-    return not re.compile(r"[^a-zA-Z0-9-_]").search(data)
+    return not INVALID_NAME_CHARS.search(data)
+
+
+def restore_state():
+    """
+    Rebuilds TREE and the named keyspaces from the latest snapshot in
+    WAL_DIR plus the WAL segments written after it, then opens a fresh WAL
+    segment.
+    """
+    global TREE, TREE_VERSION, WAL
+    intervals, seq, deadlines = persistence.load_latest_snapshot(WAL_DIR)
+    TREE = new_tree(intervals, deadlines)
+    TREE_VERSION += 1
+    FIND_CACHE.clear()
+    WAL = None  # Replayed commands are already logged
+    for name in persistence.list_keyspaces(WAL_DIR):
+        path = persistence.snapshot_path(persistence.keyspace_directory(WAL_DIR, name), seq)
+        if os.path.exists(path):
+            intervals, _, deadlines = persistence.read_snapshot(path)
+            get_keyspace(name).tree = new_tree(intervals, deadlines)
+    persistence.replay_wal(WAL_DIR, seq, commit_logged)
+    WAL = persistence.WriteAheadLog(WAL_DIR, WAL_FSYNC_BATCH, WAL_FSYNC_INTERVAL)
+
+
+def take_snapshot():
+    """
+    Writes a snapshot of TREE, and one of each named keyspace, and drops
+    the WAL segments they cover. The read locks are only held while copying
+    the interval sets and rotating the WAL; the files themselves are
+    written while writes carry on. TREE's snapshot is written last: its
+    seq is where restore_state() restores every keyspace from, so a crash
+    before it leaves the previous, complete set of snapshots in use.
+    """
+    with read_locked_keyspaces() as keyspaces:
+        copies = [
+            (keyspace.name, keyspace.tree.copy_intervals(), dict(keyspace.tree.expiry.deadlines))
+            for keyspace in keyspaces
+        ]
+        seq = WAL.rotate()
+    copies.sort(key=lambda copy: copy[0] == DEFAULT_KEYSPACE)
+    for name, intervals, deadlines in copies:
+        directory = WAL_DIR
+        if name != DEFAULT_KEYSPACE:
+            directory = persistence.keyspace_directory(WAL_DIR, name)
+        path = persistence.write_snapshot(directory, seq, intervals, deadlines)
+        logger.info(f"Wrote {len(intervals)} intervals to {path}")
+    WAL.prune(seq)
+
+
+def persistence_loop():
+    """Syncs the WAL every WAL_FSYNC_INTERVAL and snapshots every SNAPSHOT_INTERVAL."""
+    last_snapshot = time.monotonic()
+    snapshot_appended = WAL.appended
+    while True:
+        time.sleep(min(WAL_FSYNC_INTERVAL, SNAPSHOT_INTERVAL))
+        WAL.sync()
+        if time.monotonic() - last_snapshot < SNAPSHOT_INTERVAL:
+            continue
+        if WAL.appended != snapshot_appended:
+            snapshot_appended = WAL.appended
+            take_snapshot()
+        last_snapshot = time.monotonic()
+
+
+def start_persistence():
+    if not WAL_DIR:
+        return
+    restore_state()
+    Thread(target=persistence_loop, daemon=True).start()
+
+
+def stop_persistence():
+    if WAL:
+        take_snapshot()
+        WAL.close()
+
+
+def replication_snapshot():
+    """
+    Copies every keyspace for a follower's full sync. Like take_snapshot(),
+    only the copy holds the read locks; the intervals are sent while writes
+    carry on.
+    :rtype: tuple of (dict of keyspace name to its intervals and the dict
+        of their deadlines, int replication offset of the copy)
+    """
+    with read_locked_keyspaces() as keyspaces:
+        copies = {
+            keyspace.name: (keyspace.tree.copy_intervals(), dict(keyspace.tree.expiry.deadlines))
+            for keyspace in keyspaces
+        }
+        return copies, REPLICATION.offset
+
+
+def load_replica(keyspaces, replid, offset):
+    """
+    Replaces every keyspace with a full copy of the leader's, received at
+    offset.
+    :param keyspaces: dict of keyspace name to (intervals, dict of their
+        deadlines)
+    """
+    global TREE, TREE_VERSION
+    trees = {name: new_tree(*copy) for name, copy in keyspaces.items()}
+    with KEYSPACES_LOCK:
+        for name in set(KEYSPACES) - set(trees):
+            KEYSPACES.pop(name).unregister_gauges()
+    for name, tree in trees.items():
+        if name != DEFAULT_KEYSPACE:
+            keyspace = get_keyspace(name)
+            with keyspace.lock.write_lock():
+                keyspace.tree = tree
+                keyspace.cache.clear()
+    with TREE_LOCK.write_lock():
+        TREE = trees.get(DEFAULT_KEYSPACE) or new_tree()
+        TREE_VERSION += 1
+        FIND_CACHE.clear()
+        REPLICATION.reset(replid, offset)
+
+
+def start_replication():
+    """
+    Starts following REPLICA_OF and/or serving followers on
+    REPLICATION_PORT. A follower rejects writes and applies the leader's
+    through commit_logged(), so it can serve followers of its own.
+    """
+    global REPLICATION, FOLLOWER
+    if not (REPLICA_OF or REPLICATION_PORT):
+        return
+    REPLICATION = replication.ReplicationLog(REPLICATION_BACKLOG)
+    METRICS.register_gauge("replication.offset", lambda: REPLICATION.offset)
+    if REPLICA_OF:
+        host, _, port = REPLICA_OF.rpartition(":")
+        FOLLOWER = replication.Follower(
+            host, int(port), REPLICATION, load_replica, commit_logged, REPLICATION_HEARTBEAT
+        )
+        FOLLOWER.start()
+        METRICS.register_gauge("replication.connected", lambda: int(FOLLOWER.connected))
+        METRICS.register_gauge("replication.lag_ms", lambda: int(FOLLOWER.lag * 1000))
+        METRICS.register_gauge(
+            "replication.last_contact_ms", lambda: int(FOLLOWER.contact_age() * 1000)
+        )
+        METRICS.register_gauge("replication.full_syncs", lambda: FOLLOWER.full_syncs)
+    if REPLICATION_PORT:
+        replication.serve_replication(
+            REPLICATION, replication_snapshot, TCP_IP, int(REPLICATION_PORT), REPLICATION_HEARTBEAT
+        )
+        METRICS.register_gauge("replication.followers", lambda: len(REPLICATION.followers))
+        METRICS.register_gauge("replication.follower_lag", REPLICATION.follower_lag)
+        logger.info(f"Serving followers on port {REPLICATION_PORT}")
+
+
+def rebuild_static_index():
+    """
+    Builds a StaticIndex of TREE and swaps it in. Only the copy holds the
+    read lock; until the swap, FINDs are answered as before.
+    """
+    global STATIC
+    with TREE_LOCK.read_lock():
+        intervals = TREE.copy_intervals()
+        version = TREE_VERSION
+    start = time.perf_counter()
+    try:
+        index = StaticIndex(intervals, version, STATIC_INDEX_LIMIT)
+    except ValueError as e:
+        logger.warning(f"Static index not rebuilt: {e}")
+        return
+    METRICS.histogram("static.build").record(time.perf_counter() - start)
+    STATIC = index
+
+
+def static_index_loop():
+    """Rebuilds the static index once TREE has gone STATIC_INDEX seconds without a write."""
+    seen = built = None
+    while True:
+        time.sleep(STATIC_INDEX)
+        version = TREE_VERSION
+        if version != seen:
+            seen = version  # Still being written to
+        elif version != built:
+            rebuild_static_index()
+            built = version
+
+
+def start_static_index():
+    if not STATIC_INDEX:
+        return
+    Thread(target=static_index_loop, daemon=True).start()
+    METRICS.register_gauge("static.segments", lambda: len(STATIC) if STATIC else 0)
+    METRICS.register_gauge("static.current", lambda: int(static_index() is not None))
+
+
+def expire_intervals():
+    """
+    Removes up to EXPIRY_BATCH expired intervals from each keyspace, each
+    batch in one write logged as an EXPIRE record.
+    :rtype: int intervals removed
+    """
+    removed = EXPIRED["EXPIRE"]
+    now = now_ms()
+    for keyspace in [DEFAULT, *list(KEYSPACES.values())]:
+        deadline = keyspace.tree.expiry.next_deadline()
+        if deadline is not None and deadline <= now:
+            keyspace.commit(["EXPIRE", str(now), str(EXPIRY_BATCH)])
+    return EXPIRED["EXPIRE"] - removed
+
+
+def expiry_loop():
+    """
+    Expires intervals every EXPIRY_INTERVAL seconds. Each pass holds a
+    keyspace's write lock for at most EXPIRY_BATCH removals, so a mass
+    expiry is spread over many short writes instead of one long one.
+    """
+    while True:
+        time.sleep(EXPIRY_INTERVAL)
+        expire_intervals()
+
+
+def start_expiry():
+    """Starts expiring intervals, unless following a leader, which logs its own EXPIRE records."""
+    if FOLLOWER:
+        return
+    Thread(target=expiry_loop, daemon=True).start()
+
+
+def profile_roots():
+    """
+    :rtype: set of code objects PROFILE samples from: perform_action() and
+            every method of the interval trees, wherever they are called
+    """
+    roots = {CommandHandler.perform_action.__code__}
+    for tree in (CustomIntervalTree, CompactIntervalTree):
+        for cls in tree.__mro__[:-1]:  # Not object
+            for attribute in vars(cls).values():
+                code = getattr(attribute, "__code__", None)
+                if code is not None:
+                    roots.add(code)
+    return roots
+
+
+def raise_nofile_limit():
+    """
+    Lift the soft open-file limit to the hard limit so the event loop can
+    hold tens of thousands of sockets.
+    """
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            logger.warning(f"Unable to raise open file limit above {soft}")
+
+
+def run_async():
+    logger.info(f"TCP Server (asyncio) started on port {TCP_PORT}...")
+    raise_nofile_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        asyncio.start_server(
+            handle_stream, TCP_IP, TCP_PORT, reuse_address=True, backlog=LISTEN_BACKLOG
+        )
+    )
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass  # Handle SIGINT from terminal
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+def tree_depth():
+    top_node = TREE.top_node
+    return top_node.depth if top_node else 0
+
+
+def register_gauges():
+    METRICS.register_gauge("tree.intervals", lambda: len(TREE))
+    if STORAGE == "compact":
+        METRICS.register_gauge("tree.chunks", lambda: len(TREE.keys))
+        METRICS.register_gauge("tree.bytes", lambda: TREE.nbytes())
+        METRICS.register_gauge("tree.names", lambda: len(TREE.name_counts))
+    else:
+        METRICS.register_gauge("tree.depth", tree_depth)
+        METRICS.register_gauge("tree.boundaries", lambda: len(TREE.boundary_table))
+        METRICS.register_gauge("tree.names", lambda: len(TREE.name_index))
+    METRICS.register_gauge(
+        "threads", lambda: sum(isinstance(t, ClientThread) for t in enumerate_threads())
+    )
+    for stat in ("size", "hits", "misses", "evictions", "invalidations"):
+        METRICS.register_gauge(f"cache.{stat}", lambda stat=stat: FIND_CACHE.stats()[stat])
+    METRICS.register_gauge("wal.appended", lambda: WAL.appended if WAL else 0)
+    METRICS.register_gauge("keyspaces", lambda: len(KEYSPACES) + 1)
+    METRICS.register_gauge("merge.removed", lambda: MERGED["insert"])
+    METRICS.register_gauge("compact.removed", lambda: MERGED["compact"])
+    METRICS.register_gauge("compact.runs", lambda: MERGED["runs"])
+    METRICS.register_gauge(
+        "expiry.pending",
+        lambda: sum(len(ks.tree.expiry) for ks in [DEFAULT, *list(KEYSPACES.values())]),
+    )
+    METRICS.register_gauge("expiry.expired", lambda: EXPIRED["EXPIRE"])
+    METRICS.register_gauge("expiry.evicted", lambda: EXPIRED["EVICT"])
+    METRICS.register_gauge("slowlog.logged", lambda: SLOWLOG.logged)
+    METRICS.register_gauge("profile.running", lambda: int(bool(PROFILER and PROFILER.running())))
+
+
+register_gauges()
 
 
 def run():
+    if METRICS_PORT:
+        serve_prometheus(METRICS, TCP_IP, int(METRICS_PORT))
+        logger.info(f"Prometheus metrics served on port {METRICS_PORT}")
+    if SHARDS:
+        from tcp_server import shard  # Imports this module
+
+        shard.run_router()
+        return
+    if not REPLICA_OF:
+        start_persistence()  # A replica's state comes from its leader
+    start_replication()
+    start_static_index()
+    start_expiry()
+    try:
+        if SERVER_MODE == "async":
+            run_async()
+        else:
+            run_threaded()
+    finally:
+        stop_persistence()
+
+
+def run_threaded():
     logger.info(f"TCP Server started on port {TCP_PORT}...")
+    raise_nofile_limit()
     tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     tcp_server.bind((TCP_IP, TCP_PORT))
-    threads = []
+    tcp_server.listen(LISTEN_BACKLOG)
 
-    while True:
+    try:
+        while True:
+            accept_connection(tcp_server)
+    except KeyboardInterrupt:
+        pass  # Handle SIGINT from terminal
+    finally:
+        tcp_server.close()
+
+    for t in enumerate_threads():
+        if isinstance(t, ClientThread):
+            t.join()
+
+
+def accept_connection(tcp_server):
+    """
+    Accepts one client and serves it from a new ClientThread, or refuses it
+    with "ERROR server busy" when MAX_CONNECTIONS clients are already
+    connected, so overload costs the new client a reply instead of slowing
+    every connected one down. Running out of file descriptors only pauses
+    accepting for ACCEPT_BACKOFF seconds.
+    """
+    try:
+        conn, (ip, port) = tcp_server.accept()[:2]
+    except OSError as e:
+        if e.errno not in ACCEPT_ERRORS:
+            raise  # The listening socket itself failed
+        METRICS.increment("connections.accept_errors")
+        logger.warning(f"Unable to accept a connection: {e}")
+        if e.errno != errno.ECONNABORTED:
+            # Out of file descriptors or memory: give closing connections a moment
+            time.sleep(ACCEPT_BACKOFF)
+        return
+    # Lets the kernel notice peers that vanished without closing the connection
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if not CONNECTION_SLOTS.acquire(blocking=False):
+        METRICS.increment("connections.refused")
+        logger.warning(f"Refusing {ip}:{port}, {MAX_CONNECTIONS} connections already open")
         try:
-            tcp_server.listen(4)  # How large can the backlog get
-            (conn, (ip, port)) = tcp_server.accept()
-            newthread = ClientThread(conn, ip, port)
-            newthread.start()
-            threads.append(newthread)
-        except KeyboardInterrupt:
-            break  # Handle SIGINT from terminal
-
-    for t in threads:
-        t.join()
+            # Never blocks the accept loop; a client that cannot take the reply just misses it
+            conn.setblocking(False)
+            conn.send(str.encode("ERROR server busy\n"))
+        except OSError:
+            pass
+        conn.close()
+        return
+    ClientThread(conn, ip, port, slot=CONNECTION_SLOTS).start()
 
 
 if __name__ == "__main__":
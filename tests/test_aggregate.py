@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.aggregate`."""
+
+
+import random
+import unittest
+
+import mock
+
+from tcp_server import aggregate, compact, tcp_server
+from tcp_server.aggregate import IntervalCounts, SortedCounts
+
+
+def covered(intervals, name, begin, end):
+    points = set()
+    for iv in intervals:
+        if iv.data == name:
+            points.update(range(max(iv.begin, begin), min(iv.end, end)))
+    return len(points)
+
+
+class TestSortedCounts(unittest.TestCase):
+    """Tests for the chunked sorted multiset."""
+
+    def test_matches_sorted_list(self):
+        rng = random.Random(0)
+        with mock.patch.object(aggregate, "LOAD", 4):
+            values = [rng.randrange(50) for _ in range(30)]
+            counts = SortedCounts(values)
+            for _ in range(500):
+                if values and rng.random() < 0.4:
+                    value = rng.choice(values)
+                    values.remove(value)
+                    counts.remove(value)
+                else:
+                    value = rng.randrange(50)
+                    values.append(value)
+                    counts.add(value)
+                assert list(counts) == sorted(values) and len(counts) == len(values)
+                bound = rng.randrange(52)
+                assert counts.count_below(bound) == sum(value < bound for value in values)
+            assert all(0 < len(chunk) <= 8 for chunk in counts.chunks)
+
+
+class TestIntervalCounts(unittest.TestCase):
+    """Tests for the counts kept by both tree types."""
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        with mock.patch.object(aggregate, "LOAD", 4), mock.patch.object(compact, "CHUNK_SIZE", 4):
+            for tree in (tcp_server.CustomIntervalTree(), compact.CompactIntervalTree()):
+                for _ in range(300):
+                    begin = rng.randrange(0, 200)
+                    end = begin + rng.randrange(1, 30)
+                    name = rng.choice("abc")
+                    if rng.random() < 0.6:
+                        tcp_server.apply_write(tree, ["ADD", str(begin), str(end), name])
+                    else:
+                        tcp_server.apply_write(tree, ["DEL", str(begin), str(end), name])
+                    tree.verify()
+                    begin = rng.randrange(0, 220)
+                    end = begin + rng.randrange(0, 40)
+                    hits = tree.overlap(begin, end)
+                    assert tree.counts.count(begin, end) == len(hits)
+                    assert tree.counts.distinct(begin, end) == len({iv.data for iv in hits})
+                    named = sum(iv.data == name for iv in hits)
+                    assert tree.counts.count_name(name, begin, end) == named
+                    names = sorted(set(iv.data for iv in tree.copy_intervals()))
+                    assert list(tree.counts.names_from(name)) == [n for n in names if n >= name]
+                    expected = covered(tree.copy_intervals(), name, begin, end)
+                    assert tree.counts.coverage(name, begin, end) == expected
+                    assert tree.counts.coverage(name, begin, end) == expected  # Cached runs
+
+    def test_merge_runs(self):
+        counts = IntervalCounts([(1, 5, "x"), (5, 9, "x"), (2, 3, "x"), (20, 30, "x")])
+        assert aggregate.merge_runs(*counts.names["x"]) == ([1, 20], [9, 30], [0, 8, 18])
+        assert counts.coverage("x", 0, tcp_server.MAX_INT) == 18
+        assert counts.coverage("x", 4, 25) == 10
+        assert counts.coverage("x", 9, 20) == 0
+        assert counts.coverage("y", 0, 100) == 0
+        assert counts.count(5, 5) == 0
+
+
+class TestAggregateCommands(unittest.TestCase):
+    """Tests for COUNT, DISTINCT and COVERAGE."""
+
+    def test_commands(self):
+        with mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()):
+            handler = tcp_server.CommandHandler(mock.Mock())
+            response = handler.feed(
+                b"MADD 1 5 x 3 9 x 4 6 y 20 30 z\nCOUNT 4\nCOUNT 0 100\nCOUNT 10\n"
+                b"DISTINCT 4\nDISTINCT 0 100\nCOVERAGE x\nCOVERAGE x 4 100\nCOVERAGE q\n"
+            )
+            assert response == b"OK\n3\n4\n0\n2\n3\n8\n5\n0\n"
+            for line, error in [
+                (b"COUNT\n", b"ERROR invalid COUNT command\n"),
+                (b"DISTINCT 1 2 3\n", b"ERROR invalid DISTINCT command\n"),
+                (b"COUNT x\n", b"ERROR first arg must be an integer\n"),
+                (b"COVERAGE x 1\n", b"ERROR invalid COVERAGE command\n"),
+                (b"COVERAGE x! 1 2\n", b"ERROR name arg must be a string\n"),
+                (b"COVERAGE x 1 y\n", b"ERROR third arg must be an integer\n"),
+            ]:
+                assert handler.feed(line) == error, line
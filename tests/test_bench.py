@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.bench`."""
+
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from tcp_server import bench, tcp_server
+
+
+class TestHelpers(unittest.TestCase):
+    """Tests for the benchmark helpers."""
+
+    def test_percentile(self):
+        ordered = list(range(1, 1001))
+        assert bench.percentile(ordered, 0.5) == 501
+        assert bench.percentile(ordered, 0.999) == 1000
+        assert bench.percentile([], 0.5) == 0.0
+
+    def test_parse_mix(self):
+        assert bench.parse_mix("add=1,find=3") == {"add": 0.25, "find": 0.75}
+        with self.assertRaises(argparse.ArgumentTypeError):
+            bench.parse_mix("blah=1")
+        with self.assertRaises(argparse.ArgumentTypeError):
+            bench.parse_mix("add=0")
+
+    def test_workload_commands_are_valid(self):
+        handler = tcp_server.CommandHandler(mock.Mock())
+        mix = bench.parse_mix("add=1,del=1,find=1,range=1")
+        for distribution in ("fixed", "uniform", "exponential"):
+            workload = bench.Workload(1000, 50, distribution, 5, mix, 0)
+            for _ in range(50):
+                _, line = workload.command()
+                assert handler.validate_data(line.split()) is True
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Tests for the load and micro benchmarks."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_micro_saves_results(self):
+        output = os.path.join(self.directory, "micro.json")
+        bench.main(["micro", "--size", "500", "--iterations", "20", "--output", output])
+        with open(output) as f:
+            saved = json.load(f)
+        assert saved["benchmark"] == "micro"
+        assert set(saved["results"]) >= {"at", "overlap", "envelop", "chop", "chop_named"}
+        assert saved["results"]["at"]["count"] == 20
+
+    def test_load_against_local_server(self):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(
+            asyncio.start_server(tcp_server.handle_stream, "127.0.0.1", 0)
+        )
+        port = server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            with mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()):
+                results = bench.main(
+                    [
+                        "load",
+                        "--port", str(port),
+                        "--connections", "4",
+                        "--duration", "0.3",
+                        "--preload", "2000",
+                    ]
+                )
+                assert len(tcp_server.TREE) > 1000
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+            loop.close()
+        assert results["ops"] > 0
+        assert results["latency"]["p50_ms"] <= results["latency"]["p999_ms"]
+
+    def test_client_against_local_server(self):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(
+            asyncio.start_server(tcp_server.handle_stream, "127.0.0.1", 0)
+        )
+        port = server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            with mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()):
+                results = bench.main(
+                    ["client", "--port", str(port), "--requests", "200", "--preload", "500"]
+                )
+                assert len(tcp_server.TREE) == 700  # The same 200 ADDs are sent twice
+                mix = ["--mix", "add=1,del=1,find=1,range=1", "--preload", "0"]
+                results = bench.main(["client", "--port", str(port), "--requests", "50", *mix])
+                assert set(results) == {
+                    "mix_naive", "mix_pipelined", "mix_threads", "add_naive", "add_many"
+                }
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+            loop.close()
+        assert set(results) == {
+            "mix_naive",
+            "mix_pipelined",
+            "mix_threads",
+            "add_naive",
+            "add_many",
+        }
+
+    def test_compare(self):
+        paths = []
+        for name, value in (("before", 2.0), ("after", 1.0)):
+            paths.append(os.path.join(self.directory, f"{name}.json"))
+            with open(paths[-1], "w") as f:
+                json.dump({"results": {"at": {"p50_ms": value}}}, f)
+        with mock.patch("builtins.print") as printed:
+            bench.main(["compare", *paths])
+        assert "0.50x" in printed.call_args[0][0]
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.binary`."""
+
+
+import unittest
+
+import mock
+
+from intervaltree import Interval
+from tcp_server import binary, tcp_server
+
+
+def responses(data):
+    payloads, rest = binary.split_frames(data, 1 << 20)
+    assert rest == b""
+    return [binary.decode_response(payload) for payload in payloads]
+
+
+class TestCodec(unittest.TestCase):
+    """Tests for frame encoding and the name table."""
+
+    def test_split_frames(self):
+        data = binary.request(binary.OP_FIND, 3) + binary.request(binary.OP_INTERN, "x")
+        payloads, rest = binary.split_frames(data + data[:3], 100)
+        assert payloads == [b"\x03\x00\x00\x00\x03", b"\x05x"]
+        assert rest == data[:3]
+
+    def test_split_frames_too_long(self):
+        payloads, rest = binary.split_frames(binary.request(binary.OP_RANGE, 1, 2), 4)
+        assert payloads == []
+        assert rest is None
+
+    def test_ids_round_trip(self):
+        status, body = responses(binary.encode_ids([3, 1, 2]))[0]
+        assert status == binary.STATUS_OK
+        assert binary.decode_ids(body) == [3, 1, 2]
+
+    def test_name_table(self):
+        names = binary.NameTable()
+        assert names.intern("x") == 0
+        assert names.intern("y") == 1
+        assert names.intern("x") == 0
+        assert names.name(1) == "y"
+        assert names.name(2) is None
+        assert len(names) == 2
+
+
+class TestBinaryProtocol(unittest.TestCase):
+    """Tests for binary connections in the request path."""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.handler = tcp_server.CommandHandler(mock.Mock())
+        assert self.handler.feed(b"BINARY\n") == b"OK\n"
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def intern(self, name):
+        (status, body), = responses(self.handler.feed(binary.request(binary.OP_INTERN, name)))
+        assert status == binary.STATUS_OK
+        return binary.UINT32.unpack(body)[0]
+
+    def test_switch_mid_chunk(self):
+        handler = tcp_server.CommandHandler(mock.Mock())
+        response = handler.feed(b"ADD 1 5 x\nBINARY\n" + binary.request(binary.OP_FIND, 3))
+        assert response.startswith(b"OK\nOK\n")
+        (status, body), = responses(response[6:])
+        assert handler.names.name(binary.decode_ids(body)[0]) == "x"
+
+    def test_add_find_delete(self):
+        x, y = self.intern("x"), self.intern("y")
+        requests = [
+            binary.request(binary.OP_ADD, 1, 5, y),
+            binary.request(binary.OP_ADD, 3, 9, x),
+            binary.request(binary.OP_FIND, 4),
+            binary.request(binary.OP_RANGE, 5, 10),
+            binary.request(binary.OP_DEL, 0, 5, binary.ANY_NAME),
+            binary.request(binary.OP_FIND, 4),
+        ]
+        replies = responses(self.handler.feed(b"".join(requests)))
+        assert [status for status, _ in replies] == [binary.STATUS_OK] * 6
+        assert binary.decode_ids(replies[2][1]) == [x, y]
+        assert binary.decode_ids(replies[3][1]) == [x]
+        assert binary.decode_ids(replies[5][1]) == [x]
+        assert tcp_server.TREE == tcp_server.CustomIntervalTree([Interval(3, 9, "x")])
+
+    def test_split_frame_across_reads(self):
+        x = self.intern("x")
+        data = binary.request(binary.OP_ADD, 1, 5, x)
+        assert self.handler.feed(data[:6]) == b""
+        assert responses(self.handler.feed(data[6:])) == [(binary.STATUS_OK, b"")]
+
+    def test_name_lookup(self):
+        x = self.intern("x")
+        replies = responses(
+            self.handler.feed(
+                binary.request(binary.OP_NAME, x) + binary.request(binary.OP_NAME, x + 1)
+            )
+        )
+        assert replies == [(binary.STATUS_OK, b"x"), (binary.STATUS_ERROR, b"unknown name id")]
+
+    def test_names_are_per_connection(self):
+        self.intern("x")
+        other = tcp_server.CommandHandler(mock.Mock())
+        other.feed(b"BINARY\n")
+        name = binary.request(binary.OP_NAME, 0)
+        assert responses(other.feed(name)) == [(binary.STATUS_ERROR, b"unknown name id")]
+        assert responses(self.handler.feed(name)) == [(binary.STATUS_OK, b"x")]
+
+    def test_errors(self):
+        requests = [
+            binary.request(binary.OP_ADD, 1, 5, 42),
+            binary.request(binary.OP_ADD, 5, 1, 0),
+            binary.request(binary.OP_FIND, 1, 2),
+            binary.request(99),
+            binary.request(binary.OP_INTERN, "bad name"),
+        ]
+        assert responses(self.handler.feed(b"".join(requests))) == [
+            (binary.STATUS_ERROR, b"unknown name id"),
+            (binary.STATUS_ERROR, b"begin must be less than end"),
+            (binary.STATUS_ERROR, b"malformed frame"),
+            (binary.STATUS_ERROR, b"invalid command"),
+            (binary.STATUS_ERROR, b"name arg must be a string"),
+        ]
+        assert not self.handler.closed
+
+    def test_oversized_frame_closes_connection(self):
+        with mock.patch.object(tcp_server, "MAX_LINE_SIZE", 8):
+            reply = self.handler.feed(binary.request(binary.OP_INTERN, "x" * 20))
+        assert responses(reply) == [(binary.STATUS_ERROR, b"frame too long")]
+        assert self.handler.closed
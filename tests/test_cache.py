@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.cache`."""
+
+
+import unittest
+
+import mock
+
+from tcp_server import tcp_server
+from tcp_server.cache import FindCache
+
+
+class TestFindCache(unittest.TestCase):
+    """Tests for the FIND response cache."""
+
+    def setUp(self):
+        self.cache = FindCache(3)
+
+    def test_get_and_put(self):
+        assert self.cache.get("a") is None
+        self.cache.put("a", b"x\n", 1, 5, self.cache.generation)
+        assert self.cache.get("a") == b"x\n"
+        assert self.cache.stats()["hits"] == 1
+        assert self.cache.stats()["misses"] == 1
+
+    def test_lru_eviction(self):
+        for key in "abc":
+            self.cache.put(key, key.encode(), 1, 5, self.cache.generation)
+        self.cache.get("a")
+        self.cache.put("d", b"d", 1, 5, self.cache.generation)
+        assert self.cache.get("b") is None
+        assert self.cache.get("a") == b"a"
+        assert self.cache.stats()["evictions"] == 1
+        assert len(self.cache.ranges) == 3
+
+    def test_invalidate_only_overlapping(self):
+        self.cache.put("a", b"a", 1, 5, self.cache.generation)
+        self.cache.put("b", b"b", 5, 10, self.cache.generation)
+        self.cache.put("c", b"c", 20, 30, self.cache.generation)
+        self.cache.invalidate(4, 6)
+        assert self.cache.get("a") is None
+        assert self.cache.get("b") is None
+        assert self.cache.get("c") == b"c"
+        assert self.cache.stats()["invalidations"] == 2
+
+    def test_put_after_invalidate_is_dropped(self):
+        generation = self.cache.generation
+        self.cache.invalidate(100, 200)
+        self.cache.put("a", b"a", 1, 5, generation)
+        assert self.cache.get("a") is None
+
+    def test_disabled(self):
+        cache = FindCache(0)
+        cache.put("a", b"a", 1, 5, cache.generation)
+        assert cache.get("a") is None
+        assert cache.stats()["size"] == 0
+
+
+class TestServerFindCache(unittest.TestCase):
+    """Tests for FIND caching in the request path."""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "FIND_CACHE", FindCache(100)),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.handler = tcp_server.CommandHandler(mock.Mock())
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def test_repeated_find_is_cached(self):
+        self.handler.feed(b"ADD 1 5 x\nADD 3 9 y\n")
+        with mock.patch.object(tcp_server.TREE, "at", wraps=tcp_server.TREE.at) as at:
+            assert self.handler.feed(b"FIND 4\nFIND 4\n") == b"x y\nx y\n"
+            assert at.call_count == 1
+        assert tcp_server.FIND_CACHE.stats()["hits"] == 1
+
+    def test_write_evicts_only_overlapping_queries(self):
+        self.handler.feed(b"ADD 1 5 x\nADD 20 30 y\n")
+        self.handler.feed(b"FIND 4\nFIND 25\nFIND 0 10\nFIND x 0 2\n")
+        assert len(tcp_server.FIND_CACHE.entries) == 4
+        assert self.handler.feed(b"DEL 4 4 x\n") == b"OK\n"
+        assert set(tcp_server.FIND_CACHE.entries) == {("FIND", "25")}
+        response = self.handler.feed(b"FIND 4\nFIND 0 10\nFIND x 0 2\n")
+        assert response == b"ERROR no results\nx\n1-4\n"
+
+    def test_named_find_depends_on_matched_extent(self):
+        self.handler.feed(b"ADD 1 50 x\n")
+        assert self.handler.feed(b"FIND x 0 2\n") == b"1-50\n"
+        self.handler.feed(b"DEL 30 39 x\n")
+        assert self.handler.feed(b"FIND x 0 2\n") == b"1-30\n"
+
+    def test_batch_writes_invalidate_each_range(self):
+        self.handler.feed(b"FIND 3\nFIND 50\nFIND 100\n")
+        self.handler.feed(b"MADD 1 5 x 40 60 y\n")
+        assert set(tcp_server.FIND_CACHE.entries) == {("FIND", "100")}
+        assert self.handler.feed(b"FIND 3\nFIND 50\n") == b"x\ny\n"
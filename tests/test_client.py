@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.client`."""
+
+
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+from intervaltree import Interval
+
+from tcp_server import client, tcp_server
+
+
+class TestParsing(unittest.TestCase):
+    """Tests for turning replies into Python values."""
+
+    def test_replies(self):
+        assert client.parse_names(b"x x y\n") == ["x", "x", "y"]
+        assert client.parse_names(b"ERROR no results\n") == []
+        assert client.parse_intervals("x")(b"1-5 7-9\n") == [
+            Interval(1, 5, "x"),
+            Interval(7, 9, "x"),
+        ]
+        assert client.parse_page(b"a b;b:1\n") == client.Page(["a", "b"], "b:1")
+        assert client.parse_page(b"c;\n") == client.Page(["c"], None)
+        assert client.parse_multi(b"x y;;z\n") == [["x", "y"], [], ["z"]]
+        assert client.parse_int(b"12\n") == 12
+        assert client.parse_stats(b"tree.intervals=3 ratio=0.5\n") == {
+            "tree.intervals": 3,
+            "ratio": 0.5,
+        }
+        with self.assertRaises(client.ServerError) as raised:
+            client.parse_ok(b"ERROR invalid command\n")
+        assert str(raised.exception) == "invalid command"
+
+    def test_invalid_arguments(self):
+        nks = client.Client()
+        with mock.patch.object(client.Client, "call") as call:
+            for args in [(1, 5, "y\nCOUNT 0 100"), (1, 5, "a b"), (1, 5, ""), (1, 5, "x:1")]:
+                with self.assertRaises(ValueError):
+                    nks.add(*args)
+            with self.assertRaises(ValueError):
+                nks.find("1\nDROP")
+            with self.assertRaises(ValueError) as raised:
+                nks.madd([(1, 5, "x"), (2, 6, "y;z")])
+            assert "'y;z'" in str(raised.exception)
+            with self.assertRaises(ValueError), mock.patch.object(nks, "connect", list):
+                nks.add_many([(1, 5, "x y")])
+            nks.keyspace = "a b"
+            with self.assertRaises(ValueError):
+                nks.find(1)
+        call.assert_not_called()
+
+    def test_batches(self):
+        intervals = [(i, i + 1, "x") for i in range(5)]
+        assert list(client.batches(intervals, 2)) == [
+            (2, "MADD 0 1 x 1 2 x"),
+            (2, "MADD 2 3 x 3 4 x"),
+            (1, "MADD 4 5 x"),
+        ]
+
+
+class TestClient(unittest.TestCase):
+    """Tests for the sync and asyncio clients against a local server."""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "KEYSPACES", {}),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(tcp_server.handle_stream, "127.0.0.1", 0)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        self.loop.close()
+        for name in list(tcp_server.KEYSPACES):
+            tcp_server.drop_keyspace(name)
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def test_commands(self):
+        with client.Client(port=self.port, connections=2, timeout=5) as nks:
+            assert nks.add(1, 5, "x") is None
+            nks.madd([(3, 9, "y"), Interval(20, 30, "x")])
+            assert nks.find(4) == ["x", "y"]
+            assert nks.find(10) == []
+            assert nks.find(0, 100) == ["x", "x", "y"]
+            assert nks.find_name("x", 0, 100) == [Interval(1, 5, "x"), Interval(20, 30, "x")]
+            assert nks.find_page(0, 100, limit=2) == client.Page(["x", "x"], "x:2")
+            assert nks.find_page(0, 100, limit=2, after="x:2") == client.Page(["y"], None)
+            assert nks.mfind([4, 10, 25]) == [["x", "y"], [], ["x"]]
+            assert (nks.count(4), nks.distinct(0, 100), nks.coverage("x")) == (2, 2, 14)
+            nks.delete(4, 4, "y")
+            nks.mdel([(20, 30, "x")])
+            assert nks.find(0, 100) == ["x", "y", "y"]
+            assert nks.stats()["tree.intervals"] == 3
+            with self.assertRaises(client.ServerError):
+                nks.add(5, 1, "x")
+            with self.assertRaises(client.ServerError):
+                nks.drop()
+
+    def test_pipelining_and_keyspaces(self):
+        with client.Client(port=self.port, connections=2, keyspace="a", timeout=5) as nks:
+            pipeline = nks.pipeline()
+            futures = [pipeline.add(i, i + 2, f"n{i}") for i in range(100)]
+            futures.append(pipeline.find(50))
+            assert pipeline.execute()[-1] == ["n49", "n50"]
+            assert futures[-1].result() == ["n49", "n50"]
+            with ThreadPoolExecutor(8) as pool:
+                results = list(pool.map(nks.find, range(100)))
+            assert results[0] == ["n0"] and results[99] == ["n98", "n99"]
+            assert len(nks.connections) == 2
+            assert nks.add_many(((i, i + 1, "bulk") for i in range(5000)), batch=64) == 5000
+            assert nks.count(0, 10000) == 5100
+            nks.flush()
+        assert len(tcp_server.TREE) == 0 and len(tcp_server.KEYSPACES["a"].tree) == 0
+
+    def test_connection_failure(self):
+        nks = client.Client(port=self.port, connections=1, timeout=5)
+        nks.add(1, 2, "x")
+        conn = nks.connections[0]
+        conn.close()
+        with self.assertRaises(ConnectionError):
+            conn.send(b"FIND 1\n", client.parse_names)
+        assert nks.find(1) == ["x"]
+        assert nks.connections[0] is not conn
+        nks.close()
+
+    def test_async_client(self):
+        async def run():
+            async with client.AsyncClient(port=self.port, connections=2) as nks:
+                await nks.add(1, 5, "x")
+                results = await asyncio.gather(*(nks.find(i) for i in range(7)))
+                pipeline = await nks.pipeline()
+                await pipeline.add(3, 9, "y")
+                future = await pipeline.find(4)
+                replies = await pipeline.execute()
+                added = await nks.add_many([(i, i + 1, "z") for i in range(300)], batch=50)
+                with self.assertRaises(client.ServerError):
+                    await nks.count("a")
+                return results, replies, await future, added, await nks.count(0, 1000)
+
+        results, replies, found, added, count = asyncio.run(run())
+        assert results == [[], ["x"], ["x"], ["x"], ["x"], [], []]
+        assert replies == [None, ["x", "y"]] and found == ["x", "y"]
+        assert (added, count) == (300, 302)
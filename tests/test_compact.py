@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.compact`."""
+
+
+import random
+import unittest
+
+import mock
+from intervaltree import Interval
+
+from tcp_server import compact, tcp_server
+from tcp_server.compact import CompactIntervalTree
+
+
+class TestCompactIntervalTree(unittest.TestCase):
+    """Tests for the array-backed tree against CustomIntervalTree."""
+
+    def setUp(self):
+        # Tiny chunks exercise splitting and merging
+        self.patch = mock.patch.object(compact, "CHUNK_SIZE", 4)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def random_command(self, rng):
+        begin = rng.randrange(0, 300)
+        end = begin + rng.randrange(1, 40)
+        name = rng.choice("abc")
+        kind = rng.random()
+        if kind < 0.4:
+            return ["ADD", str(begin), str(end), name]
+        if kind < 0.5:
+            args = []
+            for _ in range(rng.randrange(1, 30)):
+                point = rng.randrange(300)
+                args += [str(point), str(point + rng.randrange(1, 20)), rng.choice("abc")]
+            return ["MADD"] + args
+        if kind < 0.7:
+            return ["DEL", str(begin), str(end)]
+        if kind < 0.85:
+            return ["DEL", str(begin), str(end), name]
+        return ["MDEL", str(begin), str(end), name]
+
+    def test_matches_custom_interval_tree(self):
+        for seed in range(10):
+            rng = random.Random(seed)
+            expected = tcp_server.CustomIntervalTree()
+            tree = CompactIntervalTree()
+            for _ in range(300):
+                command = self.random_command(rng)
+                tcp_server.apply_write(expected, command)
+                tcp_server.apply_write(tree, command)
+                tree.verify()
+                assert tree == expected and len(tree) == len(expected)
+                begin = rng.randrange(0, 320)
+                end = begin + rng.randrange(1, 50)
+                name = rng.choice("abc")
+                assert tree.at(begin) == expected.at(begin)
+                assert tree.overlap(begin, end) == expected.overlap(begin, end)
+                named = expected.overlap_name(name, begin, end)
+                assert tree.overlap_name(name, begin, end) == named
+                assert tree.envelop(begin, end) == expected.envelop(begin, end)
+
+    def test_set_semantics(self):
+        intervals = [Interval(1, 5, "x"), Interval(1, 5, "x"), Interval(1, 5, "y")]
+        tree = CompactIntervalTree(intervals)
+        tree[1:5] = "x"
+        assert len(tree) == 2 and Interval(1, 5, "y") in tree
+        tree.discard(Interval(1, 5, "y"))
+        tree.discard(Interval(1, 5, "z"))
+        assert list(tree) == [Interval(1, 5, "x")]
+        with self.assertRaises(ValueError):
+            tree.remove(Interval(1, 5, "y"))
+        with self.assertRaises(ValueError):
+            tree[5:5] = "x"
+
+    def test_copy_intervals(self):
+        intervals = {Interval(i, i + 10, f"n{i % 3}") for i in range(50)}
+        tree = CompactIntervalTree(intervals)
+        copy = tree.copy_intervals()
+        tree.chop(0, 100)
+        assert len(tree) == 0
+        assert len(copy) == 50 and set(copy) == intervals
+
+    def test_bulk_update_merges(self):
+        tree = CompactIntervalTree(Interval(i, i + 2, "a") for i in range(0, 100, 2))
+        tree.bulk_update(Interval(i, i + 3, "b") for i in range(0, 100, 3))
+        tree.bulk_update([Interval(0, 2, "a"), Interval(1000, 1001, "c")])
+        tree.verify()
+        assert len(tree) == 50 + 34 + 1
+        assert tree.at(3) == {Interval(2, 4, "a"), Interval(3, 6, "b")}
+
+    def test_size(self):
+        rng = random.Random(0)
+        intervals = []
+        for _ in range(20000):
+            begin = rng.randrange(tcp_server.MAX_INT - 1000)
+            name = f"n{rng.randrange(50)}"
+            intervals.append(Interval(begin, begin + rng.randrange(1, 1000), name))
+        with mock.patch.object(compact, "CHUNK_SIZE", 128):
+            tree = CompactIntervalTree(intervals)
+        counts = tree.counts.nbytes()
+        assert (tree.nbytes() - counts) / len(tree) < 20
+        # Four 4-byte sorted values per interval: begin and end, overall and per name
+        assert 16 <= counts / len(tree) < 20
+
+
+class TestCompactServer(unittest.TestCase):
+    """Tests for serving commands from a CompactIntervalTree."""
+
+    def test_responses_match(self):
+        lines = (
+            b"ADD 1 5 x\nADD 3 9 y\nMADD 4 6 x 20 30 z\nDEL 2 3 x\nFIND 4\nFIND 0 100\n"
+            b"FIND x 0 100\nMFIND 4 25\nFIND 0 100 LIMIT 2\nFIND 0 100 STREAM\nMDEL 4 4 x\n"
+            b"FIND 4\nFIND 1 2\n"
+        )
+        responses = []
+        for tree in (tcp_server.CustomIntervalTree(), CompactIntervalTree()):
+            with mock.patch.object(tcp_server, "TREE", tree):
+                responses.append(tcp_server.CommandHandler(mock.Mock()).feed(lines))
+        assert responses[0] == responses[1]
+        assert responses[1].count(b"\n") == 13
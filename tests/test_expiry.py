@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.expiry`."""
+
+
+import random
+import unittest
+
+import mock
+from intervaltree import Interval
+
+from tcp_server import binary, tcp_server
+from tcp_server.client import Client
+from tcp_server.expiry import Expiry, combined
+
+
+class TestExpiry(unittest.TestCase):
+    """Tests for the deadline heap."""
+
+    def test_pop_due_and_soonest(self):
+        expiry = Expiry()
+        a, b, c = Interval(1, 5, "a"), Interval(2, 6, "b"), Interval(3, 7, "c")
+        expiry.set(a, 300)
+        expiry.set(b, 100)
+        expiry.set(c, 200)
+        expiry.set(b, 400)  # Leaves a stale heap entry behind
+        assert expiry.next_deadline() == 100
+        assert expiry.pop_due(250, 10) == [c]
+        assert expiry.pop_due(1000, 1) == [a]
+        expiry.set(a, 50)
+        expiry.discard(a)
+        assert expiry.pop_soonest(5) == [b]
+        assert len(expiry) == 0 and expiry.pop_due(1000, 10) == []
+
+    def test_ties_expire_in_interval_order(self):
+        expiry = Expiry()
+        intervals = [Interval(i % 7, 10, f"n{i}") for i in range(20)]
+        for iv in random.Random(1).sample(intervals, len(intervals)):
+            expiry.set(iv, 100)
+        assert expiry.pop_soonest(20) == sorted(intervals, key=lambda iv: (iv.begin, iv.data))
+
+    def test_heap_is_rebuilt_when_mostly_stale(self):
+        expiry = Expiry()
+        for deadline in range(1000):
+            expiry.set(Interval(1, 2, "x"), deadline)
+        assert len(expiry) == 1 and len(expiry.heap) < 100
+        assert expiry.pop_due(10 ** 6, 10) == [Interval(1, 2, "x")]
+
+    def test_combined(self):
+        assert combined([3, 7, 5]) == 7
+        assert combined([3, None]) is None
+
+
+class TestServerExpiry(unittest.TestCase):
+    """Tests for ADD ... TTL, the expiry passes and eviction."""
+
+    def setUp(self):
+        self.now = 1000000
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "KEYSPACES", {}),
+            mock.patch.object(tcp_server, "now_ms", lambda: self.now),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.handler = tcp_server.CommandHandler(mock.Mock())
+
+    def tearDown(self):
+        for name in list(tcp_server.KEYSPACES):
+            tcp_server.drop_keyspace(name)
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def test_ttl(self):
+        response = self.handler.feed(
+            b"ADD 1 5 x TTL 10\nMADD 3 9 y 20 30 z TTL 20\nADD 40 50 w\n@a ADD 1 5 v TTL 5\n"
+            b"ADD 1 5 TTL\nFIND 0 100\n"
+        )
+        assert response == b"OK\nOK\nOK\nOK\nOK\nTTL w x y z\n"
+        assert tcp_server.TREE.expiry.get(Interval(1, 5, "x")) == self.now + 10000
+        assert tcp_server.expire_intervals() == 0
+        self.now += 10000
+        assert tcp_server.expire_intervals() == 2  # x, and v in keyspace a
+        assert self.handler.feed(b"FIND 0 100\n@a FIND 2\n") == b"TTL w y z\nERROR no results\n"
+        self.now += 10000
+        with mock.patch.object(tcp_server, "EXPIRY_BATCH", 1):
+            assert tcp_server.expire_intervals() == 1
+            assert tcp_server.expire_intervals() == 1
+        assert self.handler.feed(b"FIND 0 100\n") == b"TTL w\n"
+        tcp_server.TREE.verify()
+
+    def test_invalid_ttl(self):
+        for command in (b"ADD 1 5 x TTL 0\n", b"ADD 1 5 x TTL -3\n", b"MADD 1 5 x TTL a\n"):
+            assert self.handler.feed(command) == b"ERROR TTL must be a positive integer\n"
+        assert self.handler.feed(b"ADD 1 5 x TTL\n") == b"ERROR invalid ADD command\n"
+
+    def test_latest_add_decides(self):
+        self.handler.feed(b"ADD 1 5 x TTL 10\nADD 1 5 x\nADD 6 9 y\nADD 6 9 y TTL 10\n")
+        self.now += 10000
+        tcp_server.expire_intervals()
+        assert self.handler.feed(b"FIND 0 10\n") == b"x\n"
+
+    def test_trimmed_and_merged_intervals_keep_deadlines(self):
+        for tree in (tcp_server.CustomIntervalTree(), tcp_server.CompactIntervalTree()):
+            tcp_server.TREE = tree
+            self.handler.feed(b"ADD 1 10 x TTL 10\nADD 0 20 y\nDEL 4 5 x\nMDEL 15 16 y\n")
+            assert tree.expiry.deadlines == {
+                Interval(1, 4, "x"): self.now + 10000,
+                Interval(6, 10, "x"): self.now + 10000,
+            }
+            self.handler.feed(b"ADD 10 12 x TTL 20\nCOMPACT\n")
+            assert tree.expiry.deadlines == {
+                Interval(1, 4, "x"): self.now + 10000,
+                Interval(6, 12, "x"): self.now + 20000,
+            }
+            with mock.patch.object(tcp_server, "MERGE_ON_INSERT", True):
+                self.handler.feed(b"ADD 4 6 x\n")  # Never expires, so neither does the merge
+            assert tree.expiry.deadlines == {}
+            tree.verify()
+
+    def test_eviction(self):
+        with mock.patch.object(tcp_server, "MAX_INTERVALS", 3):
+            self.handler.feed(b"ADD 1 2 a\nADD 1 2 b TTL 30\nADD 1 2 c TTL 10\nADD 1 2 d TTL 20\n")
+            assert self.handler.feed(b"FIND 1\n") == b"a b d\n"
+            self.handler.feed(b"MADD 1 2 e 1 2 f\n")
+            assert self.handler.feed(b"FIND 1\n") == b"a e f\n"  # Only TTL intervals are evicted
+        assert tcp_server.EXPIRED["EVICT"] >= 3
+
+    def test_eviction_is_batched(self):
+        intervals = b" ".join(b"1 2 n%d" % i for i in range(8))
+        with mock.patch.object(tcp_server, "MAX_INTERVALS", 3), mock.patch.object(
+            tcp_server, "EXPIRY_BATCH", 2
+        ), mock.patch.object(tcp_server, "log_write") as log_write:
+            self.handler.feed(b"MADD " + intervals + b" TTL 10\n")
+        evictions = [c.args[0] for c in log_write.call_args_list if c.args[0][0] == "EVICT"]
+        assert evictions == [["EVICT", "3", "2"]] * 3  # 8 -> 6 -> 4 -> 3
+        assert len(tcp_server.TREE) == 3
+        # Records logged before EVICT took a limit still replay
+        tcp_server.apply_write(tcp_server.TREE, ["EVICT", "1"])
+        assert len(tcp_server.TREE) == 1
+
+    def test_binary_adds_are_capped(self):
+        self.handler.feed(b"ADD 1 2 a TTL 5\nADD 1 3 a TTL 6\nBINARY\n")
+        frame = bytes([binary.OP_ADD]) + binary.TRIPLE.pack(1, 4, self.handler.names.intern("b"))
+        with mock.patch.object(tcp_server, "MAX_INTERVALS", 2):
+            self.handler.feed(binary.frame(frame))
+        assert tcp_server.TREE.items() == {Interval(1, 3, "a"), Interval(1, 4, "b")}
+
+    def test_client_ttl(self):
+        with mock.patch.object(Client, "call", lambda self, parse, line: line):
+            nks = Client()
+            assert nks.add(1, 5, "x", ttl=60) == b"ADD 1 5 x TTL 60\n"
+            assert nks.madd([(1, 5, "x")], ttl=60) == b"MADD 1 5 x TTL 60\n"
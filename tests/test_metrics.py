@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.metrics`."""
+
+
+import unittest
+import urllib.request
+
+import mock
+
+from tcp_server import binary, tcp_server
+from tcp_server.metrics import Histogram, Metrics, serve_prometheus
+
+
+class TestHistogram(unittest.TestCase):
+    """Tests for the power-of-two latency histogram."""
+
+    def test_quantiles(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.record(3e-6)
+        histogram.record(0.5)
+        assert histogram.count() == 100
+        assert histogram.quantile(0.5) == 4e-6
+        assert histogram.quantile(0.99) == 4e-6
+        assert 0.5 <= histogram.quantile(1.0) < 1.0
+
+    def test_empty(self):
+        assert Histogram().quantile(0.99) == 0.0
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the metrics registry and its report formats."""
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.register_gauge("tree.intervals", lambda: 7)
+        for name in ("a", "b-c"):
+            gauge = f"keyspace.{name}.intervals"
+            self.metrics.register_gauge(gauge, lambda: 1, "keyspace.intervals", {"keyspace": name})
+        self.metrics.record("ADD", 2e-6)
+        self.metrics.record("ADD", error=True)
+        self.metrics.increment("bytes.sent", 10)
+
+    def test_format_stats(self):
+        fields = dict(field.split("=") for field in self.metrics.format_stats().split())
+        assert fields["tree.intervals"] == "7"
+        assert fields["keyspace.b-c.intervals"] == "1"
+        assert fields["connections"] == "0"
+        assert fields["commands.ADD"] == "2"
+        assert fields["errors.ADD"] == "1"
+        assert fields["bytes.sent"] == "10"
+        assert fields["perform.ADD.p50_us"] == "4"
+
+    def test_prometheus_endpoint(self):
+        server = serve_prometheus(self.metrics, "127.0.0.1", 0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            body = urllib.request.urlopen(url, timeout=5).read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert 'nks_commands_total{command="ADD"} 2' in body
+        assert 'nks_latency_seconds_count{op="perform.ADD"} 1' in body
+        assert "nks_bytes_sent_total 10" in body
+        assert "nks_tree_intervals 7" in body
+        assert body.count("# TYPE nks_keyspace_intervals gauge") == 1
+        assert 'nks_keyspace_intervals{keyspace="b-c"} 1' in body
+        self.metrics.unregister_gauge("keyspace.b-c.intervals")
+        assert "b-c" not in self.metrics.format_prometheus()
+
+
+class TestServerMetrics(unittest.TestCase):
+    """Tests for instrumentation in the request path."""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "METRICS", Metrics()),
+        ]
+        for patch in self.patches:
+            patch.start()
+        tcp_server.register_gauges()
+        self.handler = tcp_server.CommandHandler(mock.Mock())
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def stats(self):
+        response = self.handler.feed(b"STATS\n").decode()
+        assert response.endswith("\n") and response.count("\n") == 1
+        return dict(field.split("=") for field in response.split())
+
+    def test_commands_and_errors_are_counted(self):
+        self.handler.feed(b"ADD 1 5 x\nADD 3 9 y\nFIND 4\nADD 5 1 x\nBOGUS\n\n")
+        stats = self.stats()
+        assert stats["commands.ADD"] == "3"
+        assert stats["errors.ADD"] == "1"
+        assert stats["commands.FIND"] == "1"
+        assert stats["errors.unknown"] == "1"
+        assert stats["tree.intervals"] == "2"
+        assert stats["tree.names"] == "2"
+        assert int(stats["tree.depth"]) >= 1
+        assert "perform.ADD.p99_us" in stats
+        assert "validate.p50_us" in stats
+
+    def test_socket_latencies_are_recorded(self):
+        conn = mock.Mock()
+        conn.recv.side_effect = [b"ADD 1 5 x\n", b"FIND 2\n", b""]
+        tcp_server.ClientThread(conn, "localhost", 2004).run()
+        histograms = tcp_server.METRICS.histograms
+        assert histograms["recv"].count() == 3
+        assert histograms["send"].count() == 2
+
+    def test_binary_commands_are_counted(self):
+        self.handler.feed(b"BINARY\n")
+        self.handler.feed(binary.request(binary.OP_FIND, 1) + binary.request(binary.OP_NAME, 9))
+        commands = tcp_server.METRICS.commands
+        assert (commands["binary.FIND"].calls, commands["binary.FIND"].errors) == (1, 0)
+        assert (commands["binary.NAME"].calls, commands["binary.NAME"].errors) == (1, 1)
+
+    def test_invalid_stats_command(self):
+        assert self.handler.feed(b"STATS now\n") == b"ERROR invalid STATS command\n"
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.persistence`."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from intervaltree import Interval
+from tcp_server import persistence, tcp_server
+
+
+class TestPersistence(unittest.TestCase):
+    """Tests for the write-ahead log and snapshot files."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self, seq=0):
+        commands = []
+        persistence.replay_wal(self.directory, seq, commands.append)
+        return commands
+
+    def test_wal_append_and_replay(self):
+        wal = persistence.WriteAheadLog(self.directory, fsync_batch=2)
+        wal.append("ADD 1 5 x")
+        wal.append("DEL 2 3 x")
+        wal.close()
+        assert self.replay() == [["ADD", "1", "5", "x"], ["DEL", "2", "3", "x"]]
+
+    def test_wal_fsync_batching(self):
+        wal = persistence.WriteAheadLog(self.directory, fsync_batch=3, fsync_interval=60)
+        with mock.patch("os.fsync") as fsync:
+            wal.append("ADD 1 5 x")
+            wal.append("ADD 1 5 y")
+            assert fsync.call_count == 0
+            wal.append("ADD 1 5 z")
+            assert fsync.call_count == 1
+            wal.sync()
+            assert fsync.call_count == 1
+        wal.close()
+
+    def test_wal_skips_torn_record(self):
+        wal = persistence.WriteAheadLog(self.directory)
+        wal.append("ADD 1 5 x")
+        wal.close()
+        with open(persistence.segment_path(self.directory, wal.seq), "ab") as f:
+            f.write(b"ADD 1 9")
+        assert self.replay() == [["ADD", "1", "5", "x"]]
+
+    def test_wal_reopen_starts_new_segment(self):
+        wal = persistence.WriteAheadLog(self.directory)
+        wal.append("ADD 1 5 x")
+        wal.close()
+        reopened = persistence.WriteAheadLog(self.directory)
+        assert reopened.seq == wal.seq + 1
+        reopened.append("ADD 6 9 y")
+        reopened.close()
+        assert self.replay() == [["ADD", "1", "5", "x"], ["ADD", "6", "9", "y"]]
+
+    def test_snapshot_round_trip(self):
+        intervals = [Interval(1, 5, "x"), Interval(3, 4294967295, "y"), Interval(7, 9, "x")]
+        path = persistence.write_snapshot(self.directory, 4, intervals, {intervals[1]: 1 << 40})
+        loaded, seq, deadlines = persistence.read_snapshot(path)
+        assert seq == 4
+        assert sorted(loaded) == sorted(intervals)
+        assert deadlines == {Interval(3, 4294967295, "y"): 1 << 40}
+        assert persistence.load_latest_snapshot(self.directory) == (loaded, 4, deadlines)
+
+    def test_snapshot_without_deadlines(self):
+        path = persistence.write_snapshot(self.directory, 2, [Interval(1, 5, "x")])
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data[: -persistence.INTERVAL_COUNT.size])  # As written before TTLs
+        assert persistence.read_snapshot(path) == ([Interval(1, 5, "x")], 2, {})
+
+    def test_snapshot_rejects_other_files(self):
+        path = os.path.join(self.directory, "snapshot-00000000000000000001.bin")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 32)
+        with self.assertRaises(ValueError):
+            persistence.read_snapshot(path)
+
+    def test_rotate_and_prune(self):
+        wal = persistence.WriteAheadLog(self.directory)
+        wal.append("ADD 1 5 x")
+        seq = wal.rotate()
+        persistence.write_snapshot(self.directory, seq, [Interval(1, 5, "x")])
+        wal.append("ADD 6 9 y")
+        wal.prune(seq)
+        wal.close()
+        assert persistence.list_files(self.directory, persistence.SEGMENT_PATTERN) == [seq]
+        assert self.replay(seq) == [["ADD", "6", "9", "y"]]
+
+
+class TestServerRecovery(unittest.TestCase):
+    """Tests for restoring TREE across server restarts."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch.object(tcp_server, "WAL_DIR", self.directory),
+            mock.patch.object(tcp_server, "WAL", None),
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        if tcp_server.WAL:
+            tcp_server.WAL.close()
+        for patch in reversed(self.patches):
+            patch.stop()
+        shutil.rmtree(self.directory)
+
+    def restart(self):
+        tcp_server.WAL.close()
+        tcp_server.TREE = tcp_server.CustomIntervalTree()
+        tcp_server.restore_state()
+
+    def test_restore_from_wal(self):
+        tcp_server.restore_state()
+        handler = tcp_server.CommandHandler(mock.Mock())
+        handler.feed(b"ADD 1 5 x\nADD 3 9 y\nDEL 2 3 x\nFIND 1\n")
+        handler.feed(b"MADD 10 20 z 12 14 x\nMDEL 11 12 z\n")
+        expected = tcp_server.TREE.all_intervals.copy()
+        self.restart()
+        assert tcp_server.TREE.all_intervals == expected
+        tcp_server.TREE.verify()
+
+    def test_restore_from_snapshot_and_wal_tail(self):
+        tcp_server.restore_state()
+        handler = tcp_server.CommandHandler(mock.Mock())
+        handler.feed(b"ADD 1 5 x\nADD 3 9 y\n")
+        tcp_server.take_snapshot()
+        handler.feed(b"DEL 4 4 y\n")
+        self.restart()
+        assert tcp_server.TREE == tcp_server.CustomIntervalTree(
+            [
+                Interval(1, 5, "x"),
+                Interval(3, 4, "y"),
+                Interval(5, 9, "y"),
+            ]
+        )
+        segments = persistence.list_files(self.directory, persistence.SEGMENT_PATTERN)
+        snapshots = persistence.list_files(self.directory, persistence.SNAPSHOT_PATTERN)
+        assert snapshots == [segments[0]]
+
+    def test_restore_keyspaces(self):
+        tcp_server.restore_state()
+        handler = tcp_server.CommandHandler(mock.Mock())
+        with mock.patch.object(tcp_server, "KEYSPACES", {}):
+            handler.feed(b"ADD 1 5 x\n@a ADD 2 6 y\n@b ADD 3 7 z\n")
+            tcp_server.take_snapshot()
+            handler.feed(b"@a ADD 8 9 y\n@b DROP\n@c ADD 1 2 w\n")
+            tcp_server.KEYSPACES.clear()
+            self.restart()
+            assert sorted(tcp_server.KEYSPACES) == ["a", "c"]
+            assert handler.feed(b"FIND 0 10\n@a FIND 0 10\n@c FIND 1\n") == b"x\ny y\nw\n"
+            for name in list(tcp_server.KEYSPACES):
+                tcp_server.drop_keyspace(name)
+
+    def test_interrupted_snapshot_keeps_keyspaces(self):
+        tcp_server.restore_state()
+        handler = tcp_server.CommandHandler(mock.Mock())
+        write_snapshot = persistence.write_snapshot
+
+        def fail_keyspaces(directory, *args):
+            if directory != self.directory:
+                raise OSError("disk full")
+            return write_snapshot(directory, *args)
+
+        with mock.patch.object(tcp_server, "KEYSPACES", {}):
+            handler.feed(b"ADD 1 5 x\n@a ADD 2 6 y\n")
+            tcp_server.take_snapshot()
+            handler.feed(b"@a ADD 8 9 y\n")
+            with mock.patch.object(persistence, "write_snapshot", side_effect=fail_keyspaces):
+                with self.assertRaises(OSError):
+                    tcp_server.take_snapshot()
+            tcp_server.KEYSPACES.clear()
+            self.restart()
+            assert handler.feed(b"FIND 0 10\n@a FIND 0 10\n") == b"x\ny y\n"
+            tcp_server.drop_keyspace("a")
+
+    def test_restore_deadlines(self):
+        tcp_server.restore_state()
+        handler = tcp_server.CommandHandler(mock.Mock())
+        with mock.patch.object(tcp_server, "now_ms", return_value=1000):
+            handler.feed(b"ADD 1 5 x TTL 1\nADD 2 6 y TTL 2\n")
+            tcp_server.take_snapshot()
+            handler.feed(b"ADD 3 7 z TTL 3\nDEL 4 4 y\n")
+        tcp_server.commit_write(["EXPIRE", "2500", "10"])
+        expected = dict(tcp_server.TREE.expiry.deadlines)
+        assert len(expected) == 3  # Both trimmed pieces of y, and z
+        self.restart()
+        assert tcp_server.TREE.expiry.deadlines == expected
+        assert sorted(iv.data for iv in tcp_server.TREE) == ["y", "y", "z"]
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.profiler`."""
+
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from tcp_server import shard, tcp_server
+from tcp_server.profiler import Profiler
+
+
+def spin(stop):
+    while not stop.is_set():
+        busy()
+
+
+def busy():
+    sum(range(1000))
+
+
+class TestProfiler(unittest.TestCase):
+    """Tests for sampling stacks and writing them folded."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "profile.folded")
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=spin, args=(self.stop,))
+        self.thread.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.path) as f:
+            return [line.rsplit(" ", 1) for line in f.read().splitlines()]
+
+    def test_samples_stacks_from_the_roots(self):
+        profiler = Profiler({spin.__code__}, 0.001)
+        assert profiler.stop() is None
+        assert profiler.start(self.path)
+        assert not profiler.start(self.path)
+        time.sleep(0.2)
+        samples = profiler.stop()
+        assert samples > 0 and not profiler.running()
+        stacks = self.read()
+        assert stacks and all(s.startswith("test_profiler.py:spin") for s, _ in stacks)
+        assert "test_profiler.py:spin;test_profiler.py:busy" in [s for s, _ in stacks]
+        assert sum(int(count) for _, count in stacks) <= samples
+
+    def test_stops_after_seconds(self):
+        profiler = Profiler({spin.__code__}, 0.001)
+        profiler.start(self.path, seconds=0.05)
+        profiler.thread.join(5)
+        assert not profiler.running() and self.read()
+
+
+class TestServerProfile(unittest.TestCase):
+    """Tests for the PROFILE command."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "nks.folded")
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "PROFILER", None),
+            mock.patch.object(tcp_server, "PROFILE_FILE", self.path),
+            mock.patch.object(tcp_server, "PROFILE_INTERVAL", 0.001),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.handler = tcp_server.CommandHandler(mock.Mock())
+
+    def tearDown(self):
+        if tcp_server.PROFILER:
+            tcp_server.PROFILER.stop()
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.directory.cleanup()
+
+    def test_profile(self):
+        self.handler.feed(b"".join(b"ADD %d %d n%d\n" % (i, i + 10, i) for i in range(1000)))
+        assert self.handler.feed(b"PROFILE START\nPROFILE START 5\n") == (
+            b"OK\nERROR profiler is already running\n"
+        )
+        client = tcp_server.CommandHandler(mock.Mock())
+        worker = threading.Thread(
+            target=lambda: [client.feed(b"FIND 0 1000\nFIND %d\n" % i) for i in range(300)]
+        )
+        worker.start()
+        worker.join()
+        assert self.handler.feed(b"PROFILE STOP\n") == str.encode(self.path + "\n")
+        with open(self.path) as f:
+            stacks = f.read()
+        assert "tcp_server.py:CommandHandler.perform_action;" in stacks
+        assert "perform_find;tcp_server.py:CustomIntervalTree.overlap" in stacks
+        assert self.handler.feed(b"PROFILE STOP\n") == b"ERROR profiler is not running\n"
+
+    def test_invalid(self):
+        for command in (b"PROFILE\n", b"PROFILE GO\n", b"PROFILE START 1 2\n"):
+            assert self.handler.feed(command) == b"ERROR invalid PROFILE command\n"
+        for seconds in ("0", "a", "\u00b2", "86401", "1" * 400):
+            response = self.handler.feed(str.encode(f"PROFILE START {seconds}\n"))
+            assert response == b"ERROR seconds must be from 1 to 86400\n"
+        assert tcp_server.PROFILER is None
+        handler = shard.RouterHandler(mock.Mock(shard_map=None), mock.Mock())
+        response = handler.feed(b"PROFILE STOP\n")
+        assert response == b"ERROR PROFILE is not supported by the shard router\n"
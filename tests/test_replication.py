@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.replication`."""
+
+
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from tcp_server import replication, tcp_server
+from tcp_server.net import wait_for_port
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+class TestReplicationLog(unittest.TestCase):
+    """Tests for the backlog of replicated commands."""
+
+    def test_since(self):
+        log = replication.ReplicationLog(3)
+        for i in range(5):
+            log.append(f"ADD {i} {i + 1} x")
+        assert log.offset == 5
+        assert log.since(3) == ["ADD 3 4 x", "ADD 4 5 x"]
+        assert log.since(2) == ["ADD 2 3 x", "ADD 3 4 x", "ADD 4 5 x"]
+        assert log.since(1) is None  # No longer kept
+        assert log.since(6) is None
+        assert log.since(5, timeout=0.01) == []
+
+    def test_reset(self):
+        log = replication.ReplicationLog(3)
+        log.append("ADD 1 2 x")
+        log.reset("abc", 40)
+        assert (log.replid, log.offset, log.since(40, timeout=0)) == ("abc", 40, [])
+        log.followers["follower"] = 38
+        assert log.follower_lag() == 2
+
+
+class TestStreaming(unittest.TestCase):
+    """Tests for streaming a leader's writes to followers in-process."""
+
+    def setUp(self):
+        self.leader_tree = tcp_server.CustomIntervalTree()
+        self.leader_log = replication.ReplicationLog(10)
+        self.server = replication.serve_replication(
+            self.leader_log, self.snapshot, "127.0.0.1", 0, heartbeat=0.05
+        )
+        self.tree = tcp_server.CustomIntervalTree()
+        self.log = replication.ReplicationLog(10)
+        self.follower = replication.Follower(
+            "127.0.0.1", self.server.server_address[1], self.log, self.load, self.apply, 0.05
+        )
+
+    def tearDown(self):
+        self.follower.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def snapshot(self):
+        copy = list(self.leader_tree.all_intervals), dict(self.leader_tree.expiry.deadlines)
+        return {"default": copy}, self.leader_log.offset
+
+    def write(self, command):
+        tcp_server.apply_write(self.leader_tree, command.split())
+        self.leader_log.append(command)
+
+    def load(self, keyspaces, replid, offset):
+        intervals, deadlines = keyspaces.get("default", ([], {}))
+        self.tree = tcp_server.CustomIntervalTree(intervals)
+        self.tree.expiry.update(deadlines)
+        self.log.reset(replid, offset)
+
+    def apply(self, data):
+        tcp_server.apply_write(self.tree, data)
+        self.log.append(" ".join(data))
+
+    def in_sync(self):
+        return self.log.offset == self.leader_log.offset and self.tree == self.leader_tree
+
+    def test_full_sync_then_stream(self):
+        self.write("MADD 1 5 a 3 9 b")
+        self.follower.start()
+        wait_until(self.in_sync)
+        assert self.follower.full_syncs == 1
+        self.write("DEL 2 3")
+        self.write("ADD 20 30 c")
+        wait_until(self.in_sync)
+        assert sorted(self.tree) == sorted(self.leader_tree)
+        wait_until(lambda: self.leader_log.follower_lag() == 0 and self.follower.lag > 0)
+        assert self.follower.connected
+
+    def test_expiring_intervals(self):
+        self.write("MADD 1 5 a 3 9 b EXPIRES 2000")
+        self.write("ADD 10 20 c EXPIRES 1000")
+        self.write("ADD 30 40 d")
+        self.follower.start()
+        wait_until(self.in_sync)
+        assert self.tree.expiry.deadlines == self.leader_tree.expiry.deadlines
+        assert len(self.tree.expiry) == 3
+        self.write("EXPIRE 1500 10")
+        wait_until(self.in_sync)
+        assert sorted(iv.data for iv in self.tree) == ["a", "b", "d"]
+
+    def test_reconnect_continues_or_resyncs(self):
+        self.write("ADD 1 5 a")
+        self.follower.start()
+        wait_until(self.in_sync)
+        self.server.shutdown()
+        self.server.server_close()
+        wait_until(lambda: not self.follower.connected)
+        # A restarted listener with the backlog intact resumes the stream
+        self.write("ADD 2 6 b")
+        self.server = replication.serve_replication(
+            self.leader_log, self.snapshot, "127.0.0.1", self.follower.port, heartbeat=0.05
+        )
+        wait_until(self.in_sync)
+        assert self.follower.full_syncs == 1
+        # One that dropped commands the follower lacks sends the whole tree again
+        self.server.shutdown()
+        self.server.server_close()
+        wait_until(lambda: not self.follower.connected)
+        for i in range(20):
+            self.write(f"ADD {i} {i + 10} c")
+        self.server = replication.serve_replication(
+            self.leader_log, self.snapshot, "127.0.0.1", self.follower.port, heartbeat=0.05
+        )
+        wait_until(self.in_sync)
+        assert self.follower.full_syncs == 2
+
+    def test_invalid_sync_command(self):
+        with socket.create_connection(self.server.server_address) as conn:
+            conn.sendall(b"SYNC x\n")
+            assert conn.recv(100) == b"ERROR invalid SYNC command\n"
+
+
+class TestReplicatedServers(unittest.TestCase):
+    """Tests for a leader and followers running as separate processes."""
+
+    def setUp(self):
+        self.processes = []
+        self.replication_port = free_port()
+        self.leader_port = self.start_server(REPLICATION_PORT=str(self.replication_port))
+
+    def tearDown(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait(timeout=10)
+
+    def start_server(self, **env):
+        port = free_port()
+        env = dict(
+            os.environ,
+            HOSTNAME="127.0.0.1",
+            PORT=str(port),
+            REPLICATION_HEARTBEAT="0.05",
+            **env,
+        )
+        env.pop("WAL_DIR", None)
+        process = subprocess.Popen([sys.executable, "-m", "tcp_server.tcp_server"], env=env)
+        self.processes.append(process)
+        wait_for_port("127.0.0.1", port)
+        return port
+
+    def start_follower(self):
+        return self.start_server(
+            REPLICA_OF=f"127.0.0.1:{self.replication_port}", SERVER_MODE="async"
+        )
+
+    def send(self, port, line):
+        with socket.create_connection(("127.0.0.1", port)) as conn:
+            conn.sendall(str.encode(line + "\n"))
+            received = b""
+            while not received.endswith(b"\n"):
+                chunk = conn.recv(1 << 16)
+                assert chunk
+                received += chunk
+        return received.decode().strip()
+
+    def stats(self, port):
+        return dict(field.split("=") for field in self.send(port, "STATS").split())
+
+    def test_followers_serve_reads(self):
+        assert self.send(self.leader_port, "MADD 1 10 a 5 20 b") == "OK"
+        first = self.start_follower()
+        wait_until(lambda: self.send(first, "FIND 7") == "a b")
+        # Writes go to the leader only
+        assert self.send(first, "ADD 1 2 c") == "ERROR read-only replica"
+        assert self.send(self.leader_port, "DEL 5 7 b") == "OK"
+        for i in range(100):
+            assert self.send(self.leader_port, f"ADD {100 + i} {200 + i} n{i}") == "OK"
+        # A follower joining later bootstraps from a full transfer
+        second = self.start_follower()
+        for port in (first, second):
+            wait_until(lambda: self.stats(port)["replication.offset"] == "102")
+            assert self.send(port, "FIND 6") == "a"
+            assert self.send(port, "FIND 9 101").split() == ["a", "b", "n0"]
+            stats = self.stats(port)
+            assert stats["replication.connected"] == "1"
+            assert stats["tree.intervals"] == "102"
+        stats = self.stats(self.leader_port)
+        assert stats["replication.followers"] == "2"
+        wait_until(lambda: self.stats(self.leader_port)["replication.follower_lag"] == "0")
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.shard`."""
+
+
+import asyncio
+import random
+import socket
+import threading
+import unittest
+
+import mock
+from intervaltree import Interval
+
+from tcp_server import shard, tcp_server
+
+
+def free_ports(count):
+    """Finds `count` consecutive free ports."""
+    rng = random.Random()
+    while True:
+        base = rng.randrange(20000, 60000)
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+
+
+class TestRouting(unittest.TestCase):
+    """Tests for splitting commands between shards."""
+
+    def setUp(self):
+        self.patch = mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree())
+        self.patch.start()
+        self.router = shard.ShardRouter(4, 0)
+        self.handler = shard.RouterHandler(self.router, mock.Mock())
+        self.quarter = (tcp_server.MAX_INT + 1) // 4
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def route(self, line):
+        (item,) = self.handler.collect(str.encode(line + "\n"))
+        return item
+
+    def test_shard_map(self):
+        shard_map = self.router.shard_map
+        assert shard_map.shard(0) == 0
+        assert shard_map.shard(self.quarter - 1) == 0
+        assert shard_map.shard(self.quarter) == 1
+        assert shard_map.shard(tcp_server.MAX_INT) == 3
+        assert list(shard_map.shards(self.quarter - 1, self.quarter + 1)) == [0, 1]
+        assert list(shard_map.shards(5, 5)) == []
+        assert shard_map.owner(1, self.quarter) == 0
+        assert shard_map.owner(1, self.quarter + 1) is None
+
+    def test_add_goes_to_one_shard(self):
+        item = self.route(f"MADD 1 5 x {self.quarter} {self.quarter + 5} y")
+        assert sorted(item.parts) == [(0, b"MADD 1 5 x\n"), (1, b"MADD 1073741824 1073741829 y\n")]
+        assert item.local == []
+        # Intervals crossing a boundary stay with the router
+        item = self.route(f"ADD 1 {self.quarter + 5} z")
+        assert (item.parts, item.local) == ([], [b"OK\n"])
+        assert len(tcp_server.TREE) == 1
+
+    def test_find_and_delete_fan_out(self):
+        self.route(f"ADD 1 {self.quarter + 5} z")
+        item = self.route(f"FIND 10 {self.quarter + 1}")
+        assert [shard for shard, _ in item.parts] == [0, 1]
+        assert item.local == [b"z\n"]
+        # DEL's end is inclusive
+        item = self.route(f"DEL 10 {self.quarter - 1} x")
+        assert [shard for shard, _ in item.parts] == [0]
+        item = self.route(f"DEL 10 {self.quarter} x")
+        assert [shard for shard, _ in item.parts] == [0, 1]
+        assert self.route("FIND 3").parts == [(0, b"FIND 3\n")]
+
+    def test_trimmed_intervals_are_handed_over(self):
+        self.route(f"ADD 1 {self.quarter + 5} z")
+        item = self.route(f"DEL {self.quarter} {self.quarter + 10} z")
+        assert item.parts == [(1, str.encode(f"DEL {self.quarter} {self.quarter + 10} z\n")),
+                              (0, str.encode(f"MADD 1 {self.quarter} z\n"))]
+        assert len(tcp_server.TREE) == 0
+        with mock.patch.object(shard, "log_write") as log_write:
+            item.acknowledge([b"OK\n", b"ERROR boom\n"])
+        log_write.assert_not_called()
+        assert tcp_server.TREE.items() == {Interval(1, self.quarter, "z")}  # Refused, so kept
+        item = self.route(f"DEL {self.quarter} {self.quarter} z")
+        with mock.patch.object(shard, "log_write") as log_write:
+            item.acknowledge([b"OK\n", b"OK\n"])
+        log_write.assert_called_once_with(["REMOVE", "1", str(self.quarter), "z"])
+        assert len(tcp_server.TREE) == 0
+
+    def test_invalid_commands_are_answered_locally(self):
+        assert self.route("ADD 5 1 x") == b"ERROR begin must be less than end\n"
+        assert self.route("BINARY") == b"ERROR BINARY is not supported by the shard router\n"
+        assert self.route("DISTINCT 1") == b"ERROR DISTINCT is not supported by the shard router\n"
+        assert self.route("COVERAGE x") == b"ERROR COVERAGE is not supported by the shard router\n"
+        assert self.route("ADD 1 5 x TTL 9") == b"ERROR TTL is not supported by the shard router\n"
+
+    def test_merges(self):
+        assert shard.merge_names([b"a c\n", b"ERROR no results\n", b"b c\n"]) == b"a b c c\n"
+        assert shard.merge_names([b"ERROR no results\n"]) == b"ERROR no results\n"
+        assert shard.merge_intervals([b"1-5 20-30\n", b"3-4\n"]) == b"1-5 3-4 20-30\n"
+        assert shard.merge_ok([b"OK\n", b"ERROR boom\n"]) == b"ERROR boom\n"
+        assert shard.merge_sum([b"2\n", b"0\n", b"3\n"]) == b"5\n"
+        item = self.route(f"MFIND 1 {self.quarter} 2")
+        assert item.merge([b"x;y\n", b"z\n"]) == b"x;z;y\n"
+
+    def test_merge_tokens(self):
+        async def source(*batches):
+            for batch in batches:
+                yield batch
+
+        async def merged():
+            sources = [source([b"a", b"c"], [b"e"]), source(), source([b"b"], [b"d", b"f"])]
+            return [token async for token in shard.merge_tokens(sources)]
+
+        assert asyncio.run(merged()) == [b"a", b"b", b"c", b"d", b"e", b"f"]
+
+
+class TestShardedServer(unittest.TestCase):
+    """Runs a router and real worker processes against a single in-process tree."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.base_port = free_ports(2)
+        cls.processes = shard.start_workers(2, cls.base_port)
+        cls.loop = asyncio.new_event_loop()
+        cls.patch = mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree())
+        cls.patch.start()
+        cls.router = shard.ShardRouter(2, cls.base_port)
+        cls.server = cls.loop.run_until_complete(
+            asyncio.start_server(cls.router.handle_client, "127.0.0.1", 0)
+        )
+        cls.port = cls.server.sockets[0].getsockname()[1]
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.server.close()
+        cls.loop.run_until_complete(cls.server.wait_closed())
+        tasks = asyncio.all_tasks(cls.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            cls.loop.run_until_complete(asyncio.wait(tasks))
+        cls.loop.close()
+        cls.patch.stop()
+        shard.stop_workers(cls.processes)
+
+    def exchange(self, conn, lines):
+        conn.sendall(str.encode("".join(lines)))
+        received = b""
+        while received.count(b"\n") < len(lines):
+            chunk = conn.recv(1 << 16)
+            assert chunk
+            received += chunk
+        return received
+
+    def test_matches_single_process(self):
+        rng = random.Random(3)
+        half = (tcp_server.MAX_INT + 1) // 2
+
+        def interval():
+            begin = rng.randrange(half - 200, half + 200)
+            return begin, begin + rng.randrange(1, 60), rng.choice("abcd")
+
+        lines = []
+        for _ in range(400):
+            begin, end, name = interval()
+            kind = rng.random()
+            if kind < 0.3:
+                lines.append(f"ADD {begin} {end} {name}\n")
+            elif kind < 0.4:
+                lines.append("MADD %d %d %s %d %d %s\n" % (interval() + interval()))
+            elif kind < 0.5:
+                lines.append(f"DEL {begin} {end}{rng.choice(['', ' ' + name])}\n")
+            elif kind < 0.55:
+                lines.append("MDEL %d %d %s\n" % interval())
+            elif kind < 0.7:
+                lines.append(f"FIND {begin}\n")
+            elif kind < 0.8:
+                lines.append(f"FIND {begin} {end + 100}\n")
+            elif kind < 0.85:
+                lines.append(f"FIND {name} {begin} {end}\n")
+            elif kind < 0.9:
+                lines.append(f"MFIND {begin} {end} {half}\n")
+            elif kind < 0.93:
+                lines.append(f"FIND {begin - 100} {end + 100} STREAM\n")
+            elif kind < 0.95:
+                lines.append(f"COUNT {begin - 100} {end + 100}\n")
+            else:
+                lines.append(f"FIND {begin - 100} {end + 100} LIMIT 3\n")
+        with mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()):
+            expected = tcp_server.CommandHandler(mock.Mock()).feed(str.encode("".join(lines)))
+        expected = expected.splitlines()
+        with socket.create_connection(("127.0.0.1", self.port)) as conn:
+            for start in range(0, len(lines), 50):
+                batch = lines[start : start + 50]
+                replies = self.exchange(conn, batch).splitlines()
+                for line, reply, want in zip(batch, replies, expected[start : start + 50]):
+                    assert reply == want, line
+            assert len(tcp_server.TREE) > 0
+            self.exchange(conn, [f"DEL {half - 1000} {half + 1000}\n"])
+
+    def test_paging_across_shards(self):
+        half = (tcp_server.MAX_INT + 1) // 2
+        adds = [
+            f"MADD {half - 5} {half - 1} b {half + 1} {half + 5} b {half - 2} {half + 2} b"
+            f" {half - 3} {half - 2} a {half + 2} {half + 3} c\n"
+        ]
+        with socket.create_connection(("127.0.0.1", self.port)) as conn:
+            assert self.exchange(conn, adds) == b"OK\n"
+            query = f"FIND {half - 10} {half + 10}"
+            pages = []
+            line = f"{query} LIMIT 2\n"
+            while True:
+                names, _, cursor = self.exchange(conn, [line]).decode().strip().partition(";")
+                pages.append(names)
+                if not cursor:
+                    break
+                line = f"{query} LIMIT 2 AFTER {cursor}\n"
+            assert pages == ["a b", "b b", "c"]
+            with mock.patch.object(tcp_server, "STREAM_CHUNK", 2):
+                assert self.exchange(conn, [f"{query} STREAM\n"]) == b"a b b b c\n"
+            stats = self.exchange(conn, ["STATS\n"]).decode().split()
+            assert stats[0] == "tree.intervals=5"
+            assert "shard1.tree.intervals=2" in stats and "spanning.tree.intervals=1" in stats
+            self.exchange(conn, [f"DEL {half - 10} {half + 10}\n"])
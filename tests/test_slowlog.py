@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.slowlog`."""
+
+
+import unittest
+
+import mock
+
+from tcp_server import shard, tcp_server
+from tcp_server.slowlog import SlowLog, format_entry
+
+
+class TestSlowLog(unittest.TestCase):
+    """Tests for the bounded log itself."""
+
+    def test_record(self):
+        log = SlowLog(0.01, 2)
+        assert not log.is_slow(0.005) and log.is_slow(0.01)
+        assert not SlowLog(0, 2).is_slow(100)
+        with mock.patch("time.time", lambda: 1700000000.5):
+            text = log.record(["FIND", "1", "5"], 0.0123, "default", 3, 10)
+        assert text == (
+            "id=1 time=1700000000.500 us=12300 keyspace=default results=3 intervals=10 FIND 1 5"
+        )
+        log.record(["ADD", "1", "5", "x"], 0.02, "a", None, 11)
+        log.record(["MADD", *["1", "5", "x"] * 10], 0.03, "a", None, 21)
+        assert len(log) == 2 and log.logged == 3
+        newest, oldest = log.latest()
+        assert (newest[0], oldest[0]) == (3, 2)
+        assert format_entry(oldest).endswith("results=- intervals=11 ADD 1 5 x")
+        assert newest[-1][-2:] == ["1", "...(+14)"]
+        assert log.latest(1) == [newest]
+        log.reset()
+        assert log.latest() == []
+
+
+class TestServerSlowLog(unittest.TestCase):
+    """Tests for the SLOWLOG command."""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "KEYSPACES", {}),
+            mock.patch.object(tcp_server, "SLOWLOG", SlowLog(1e-9, 3)),  # Everything is slow
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.handler = tcp_server.CommandHandler(mock.Mock())
+
+    def tearDown(self):
+        for name in list(tcp_server.KEYSPACES):
+            tcp_server.drop_keyspace(name)
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def test_slowlog(self):
+        self.handler.feed(b"MADD 1 5 x 3 9 y 20 30 z\nFIND 0 100\nFIND 4\n@a MFIND 1 2\n")
+        entries = self.handler.feed(b"SLOWLOG\n").decode().rstrip("\n").split(";")
+        assert [entry.split(" ", 3)[-1] for entry in entries] == [
+            "keyspace=a results=0 intervals=0 MFIND 1 2",
+            "keyspace=default results=2 intervals=3 FIND 4",
+            "keyspace=default results=3 intervals=3 FIND 0 100",
+        ]
+        # Cached and paged FINDs, COUNT and slow writes
+        self.handler.feed(b"FIND 4\nFIND 0 100 LIMIT 1\nCOUNT 0 100\nDEL 0 100\n")
+        entries = self.handler.feed(b"SLOWLOG 5\n").decode().rstrip("\n").split(";")
+        assert [entry.split(" ", 4)[-1] for entry in entries] == [
+            "results=- intervals=0 DEL 0 100",
+            "results=3 intervals=3 COUNT 0 100",
+            "results=1 intervals=3 FIND 0 100 LIMIT 1",
+        ]
+        assert self.handler.feed(b"SLOWLOG 1\n").startswith(b"id=10 ")
+        assert self.handler.feed(b"SLOWLOG RESET\nSLOWLOG 0\n") == b"OK\n\n"
+        for command in ("SLOWLOG a", "SLOWLOG 1 2", "SLOWLOG \u00b2", "SLOWLOG " + "9" * 30):
+            command = str.encode(command + "\n")
+            assert self.handler.feed(command) == b"ERROR invalid SLOWLOG command\n"
+
+    def test_threshold(self):
+        tcp_server.SLOWLOG.threshold = 60
+        self.handler.feed(b"ADD 1 5 x\nFIND 1\n")
+        assert self.handler.feed(b"SLOWLOG\n") == b"\n"
+
+    def test_shard_router(self):
+        handler = shard.RouterHandler(mock.Mock(shard_map=None), mock.Mock())
+        assert handler.feed(b"SLOWLOG\n") == b"ERROR SLOWLOG is not supported by the shard router\n"
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Tests for `tcp_server.static`."""
+
+
+import random
+import unittest
+
+import mock
+from intervaltree import Interval
+
+from tcp_server import tcp_server
+from tcp_server.static import NO_RESULTS, StaticIndex
+
+
+def expected_response(tree, point):
+    names = sorted(iv.data for iv in tree.at(point))
+    return str.encode(" ".join(names) + "\n") if names else NO_RESULTS
+
+
+class TestStaticIndex(unittest.TestCase):
+    """Tests for point lookups in the static index."""
+
+    def test_matches_tree(self):
+        for seed in range(5):
+            rng = random.Random(seed)
+            intervals = []
+            for _ in range(200):
+                begin = rng.randrange(0, 500)
+                intervals.append(Interval(begin, begin + rng.randrange(1, 60), rng.choice("abc")))
+            tree = tcp_server.CustomIntervalTree(intervals)
+            index = StaticIndex(tree.copy_intervals(), 1, 10 ** 6)
+            points = list(range(-1, 600)) + [tcp_server.MAX_INT]
+            expected = [expected_response(tree, point) for point in points]
+            assert [index.find(point) for point in points] == expected
+            assert index.find_many(points) == expected
+            with mock.patch.object(index, "vector_bounds", None):
+                assert index.find_many(points) == expected
+
+    def test_empty_and_shared_responses(self):
+        index = StaticIndex([], 0, 10)
+        assert len(index) == 0 and index.find(5) is NO_RESULTS
+        index = StaticIndex([Interval(1, 3, "a"), Interval(5, 8, "a"), Interval(2, 6, "b")], 0, 10)
+        assert index.find_names(2) == ["a", "b"] and index.find_names(8) == []
+        assert index.find(1) is index.find(7)
+        assert index.names == 7
+
+    def test_limit(self):
+        intervals = [Interval(i, 100, "a") for i in range(20)]
+        with self.assertRaises(ValueError):
+            StaticIndex(intervals, 0, 50)
+
+
+class TestStaticServer(unittest.TestCase):
+    """Tests for serving point FINDs from the static index."""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "TREE_VERSION", 0),
+            mock.patch.object(tcp_server, "STATIC", None),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def feed(self, lines):
+        return tcp_server.CommandHandler(mock.Mock()).feed(lines)
+
+    def test_served_while_current(self):
+        self.feed(b"MADD 1 5 x 3 9 y 20 30 z\n")
+        queries = b"FIND 4\nFIND 10\nMFIND 4 25 10 1\nFIND 0 100\n"
+        expected = self.feed(queries)
+        tcp_server.rebuild_static_index()
+        assert tcp_server.static_index() is tcp_server.STATIC
+        with mock.patch.object(tcp_server.TREE, "at", side_effect=AssertionError):
+            assert self.feed(queries) == expected
+        assert expected == b"x y\nERROR no results\nx y;z;;x\nx y z\n"
+
+    def test_stale_index_is_not_served(self):
+        self.feed(b"ADD 1 5 x\n")
+        tcp_server.rebuild_static_index()
+        self.feed(b"DEL 1 5\n")
+        assert tcp_server.static_index() is None
+        assert self.feed(b"FIND 2\nMFIND 2\n") == b"ERROR no results\n\n"
+        tcp_server.rebuild_static_index()
+        assert tcp_server.STATIC.find(2) is NO_RESULTS
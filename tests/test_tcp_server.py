@@ -3,11 +3,20 @@
 """Tests for `tcp_server` package."""
 
 
+import asyncio
+import errno
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
 import mock
 
-from tcp_server import tcp_server
+from tcp_server import binary, tcp_server
 from intervaltree import Interval
 
 
@@ -298,3 +307,681 @@ class TestSolution(unittest.TestCase):
         data = "FIND 2 7".split()
         self.thread.perform_find(data)
         self.thread.conn.send.assert_called_with(str.encode("x y\n"))
+
+    def test_perform_find_by_name(self):
+        self.thread.feed(b"ADD 1 5 x\nADD 3 9 y\nADD 7 12 x\nADD 20 30 x\n")
+        self.thread.perform_find("FIND x 4 8".split())
+        self.thread.conn.send.assert_called_with(str.encode("1-5 7-12\n"))
+        self.thread.perform_find("FIND z 4 8".split())
+        self.thread.conn.send.assert_called_with(str.encode("ERROR no results\n"))
+
+    def test_validate_find_by_name(self):
+        assert self.thread.validate_find("FIND x 4 8".split()) is True
+        assert self.thread.validate_find("FIND x! 4 8".split()) is False
+        self.thread.conn.send.assert_called_with(str.encode("ERROR name arg must be a string\n"))
+        assert self.thread.validate_find("FIND x 4 eight".split()) is False
+        self.thread.conn.send.assert_called_with(str.encode("ERROR invalid FIND command\n"))
+        assert self.thread.validate_find("FIND x 4 4294967296".split()) is False
+        self.thread.conn.send.assert_called_with(
+            str.encode('ERROR invalid integer "4294967296"\n')
+        )
+
+    def test_name_index_tracks_tree(self):
+        tree = tcp_server.CustomIntervalTree([Interval(1, 5, "x"), Interval(2, 6, "y")])
+        assert set(tree.name_index) == {"x", "y"}
+        tree[3:9] = "x"
+        tree.chop(4, 7, "x")
+        tree.verify()
+        assert tree.name_index["x"] == tcp_server.IntervalTree(
+            [Interval(1, 4, "x"), Interval(3, 4, "x"), Interval(7, 9, "x")]
+        )
+        tree.chop(0, 10, "y")
+        tree.verify()
+        assert "y" not in tree.name_index
+
+    def test_named_chop_only_visits_named_intervals(self):
+        tree = tcp_server.CustomIntervalTree(Interval(i, i + 10, f"n{i}") for i in range(100))
+        tree[0:200] = "x"
+        with mock.patch.object(tree, "at", side_effect=AssertionError), mock.patch.object(
+            tree, "overlap", side_effect=AssertionError
+        ):
+            tree.chop(50, 60, "x")
+        assert tree.name_index["x"] == tcp_server.IntervalTree(
+            [Interval(0, 50, "x"), Interval(60, 200, "x")]
+        )
+        tree.verify()
+
+    def test_perform_delete_unnamed_enclosed_entries(self):
+        self.thread.feed(b"ADD 1 5 x\nADD 3 9 y\nADD 6 7 z\n")
+        self.thread.perform_delete("DEL 4 6".split())
+        assert tcp_server.TREE == tcp_server.CustomIntervalTree(
+            [Interval(1, 5, "x"), Interval(3, 9, "y")]
+        )
+        self.thread.conn.send.assert_called_with(str.encode("OK\n"))
+
+    def test_envelop_matches_brute_force(self):
+        rng = random.Random(5)
+        intervals = set()
+        for _ in range(500):
+            begin = rng.randrange(0, 1000)
+            intervals.add(Interval(begin, begin + rng.randrange(1, 100), rng.choice("xyz")))
+        tree = tcp_server.CustomIntervalTree(intervals)
+        for _ in range(200):
+            begin = rng.randrange(0, 1000)
+            end = begin + rng.randrange(1, 300)
+            expected = set(iv for iv in intervals if iv.begin >= begin and iv.end <= end)
+            assert tree.envelop(begin, end) == expected
+            assert tree.envelop(begin, end, "x") == set(iv for iv in expected if iv.data == "x")
+
+    def test_chop_matches_brute_force(self):
+        rng = random.Random(7)
+        tree = tcp_server.CustomIntervalTree()
+        covered = {name: set() for name in "xyz"}
+        for _ in range(300):
+            begin = rng.randrange(0, 300)
+            end = begin + rng.randrange(1, 40)
+            name = rng.choice("xyz")
+            if rng.random() < 0.6:
+                tree[begin:end] = name
+                covered[name].update(range(begin, end))
+            elif rng.random() < 0.5:
+                tree.chop(begin, end, name)
+                covered[name].difference_update(range(begin, end))
+            else:
+                # Unnamed chops only remove the intervals inside the range
+                expected = set(iv for iv in tree if iv.begin >= begin and iv.end <= end)
+                expected = set(tree) - expected
+                tree.chop(begin, end)
+                assert set(tree) == expected
+                for key in covered:
+                    ivs = tree.name_index.get(key, ())
+                    covered[key] = set(p for iv in ivs for p in range(*iv[:2]))
+        tree.verify()
+        for name, points in covered.items():
+            assert set(p for iv in tree.name_index.get(name, ()) for p in range(*iv[:2])) == points
+
+    def test_validate_add_empty_interval(self):
+        assert self.thread.validate_add("ADD 5 5 x".split()) is False
+        self.thread.conn.send.assert_called_with(
+            str.encode("ERROR begin must be less than end\n")
+        )
+
+    def test_perform_multi_add(self):
+        self.thread.perform_add("MADD 1 5 x 3 9 y 1 5 x".split())
+        self.thread.conn.send.assert_called_once_with(str.encode("OK\n"))
+        assert tcp_server.TREE == tcp_server.CustomIntervalTree(
+            [Interval(1, 5, "x"), Interval(3, 9, "y")]
+        )
+        tcp_server.TREE.verify()
+
+    def test_bulk_update_rebuilds_small_tree(self):
+        tree = tcp_server.CustomIntervalTree([Interval(0, 1, "x")])
+        with mock.patch.object(tree, "add", side_effect=AssertionError):
+            tree.bulk_update(Interval(i, i + 2, "y") for i in range(10))
+        assert len(tree) == 11
+        tree.verify()
+        tree.bulk_update([Interval(20, 30, "z")])
+        assert len(tree) == 12
+        tree.verify()
+
+    def test_perform_multi_delete(self):
+        self.thread.feed(b"MADD 1 5 x 3 9 y 1 9 z\n")
+        self.thread.perform_delete("MDEL 2 3 x 0 20 y".split())
+        self.thread.conn.send.assert_called_with(str.encode("OK\n"))
+        assert tcp_server.TREE == tcp_server.CustomIntervalTree(
+            [Interval(1, 2, "x"), Interval(4, 5, "x"), Interval(1, 9, "z")]
+        )
+
+    def test_perform_multi_find(self):
+        self.thread.feed(b"MADD 1 5 x 3 9 y\n")
+        self.thread.perform_multi_find("MFIND 4 0 8".split())
+        self.thread.conn.send.assert_called_with(str.encode("x y;;y\n"))
+
+    def test_validate_multi_commands(self):
+        assert self.thread.validate_data("MADD 1 5 x 3 9".split()) is False
+        self.thread.conn.send.assert_called_with(str.encode("ERROR invalid MADD command\n"))
+        assert self.thread.validate_data("MADD 1 5 x 3 nine y".split()) is False
+        self.thread.conn.send.assert_called_with(
+            str.encode("ERROR second arg must be an integer\n")
+        )
+        assert self.thread.validate_data("MDEL 1 5".split()) is False
+        self.thread.conn.send.assert_called_with(str.encode("ERROR invalid MDEL command\n"))
+        assert self.thread.validate_data("MDEL 1 5 x! 3 9 y".split()) is False
+        self.thread.conn.send.assert_called_with(str.encode("ERROR name arg must be a string\n"))
+        assert self.thread.validate_data(["MFIND"]) is False
+        self.thread.conn.send.assert_called_with(str.encode("ERROR invalid MFIND command\n"))
+        assert self.thread.validate_data("MFIND 1 -2".split()) is False
+        self.thread.conn.send.assert_called_with(str.encode('ERROR invalid integer "-2"\n'))
+        assert self.thread.validate_data("MADD 1 5 x 3 9 y".split()) is True
+        assert self.thread.validate_data("MDEL 1 5 x 3 9 y".split()) is True
+        assert self.thread.validate_data("MFIND 1 5".split()) is True
+
+    def test_feed_pipelined_commands(self):
+        response = self.thread.feed(b"ADD 1 5 x\nADD 3 9 y\nFIND 4\nBLAH\n")
+        assert response == b"OK\nOK\nx y\nERROR invalid command\n"
+        assert self.thread.conn.send.call_count == 0
+
+    def test_feed_command_split_across_reads(self):
+        assert self.thread.feed(b"ADD 1 5") == b""
+        assert self.thread.feed(b" x\r\nFI") == b"OK\n"
+        assert self.thread.feed(b"ND 2\n") == b"x\n"
+
+    def test_feed_command_too_long(self):
+        with mock.patch.object(tcp_server, "MAX_LINE_SIZE", 8):
+            assert self.thread.feed(b"ADD 1 5 xxxxxxxx") == b"ERROR command too long\n"
+            assert self.thread.feed(b"xxxxxxxxxxxxxxxx") == b""
+            assert self.thread.feed(b"xx\nFIND 1\n") == b"ERROR no results\n"
+            # Complete lines are checked too, not only ones split across reads
+            assert self.thread.feed(b"ADD 1 5 xxxxxxxx\nFIND 1\n") == (
+                b"ERROR command too long\nERROR no results\n"
+            )
+            assert self.thread.feed(b"ADD 1 5\n") == b"ERROR invalid ADD command\n"
+
+    def test_run_coalesces_responses(self):
+        self.thread.conn.recv.side_effect = [b"ADD 1 5 x\nADD 2 6 y\n", b"FIND 3\n", b""]
+        self.thread.run()
+        assert self.thread.conn.sendall.call_args_list == [
+            mock.call(b"OK\nOK\n"),
+            mock.call(b"x y\n"),
+        ]
+        self.thread.conn.close.assert_called_once_with()
+
+    def test_iter_overlap_matches_overlap(self):
+        rng = random.Random(11)
+        intervals = set()
+        for _ in range(500):
+            begin = rng.randrange(0, 1000)
+            intervals.add(Interval(begin, begin + rng.randrange(1, 100), rng.choice("xyz")))
+        tree = tcp_server.CustomIntervalTree(intervals)
+        for _ in range(200):
+            begin = rng.randrange(0, 1000)
+            end = begin + rng.randrange(1, 300)
+            expected = set(iv for iv in intervals if iv.begin < end and iv.end > begin)
+            hits = list(tcp_server.iter_overlap(tree.top_node, begin, end))
+            assert len(hits) == len(set(hits))
+            assert set(hits) == expected
+            assert tree.overlap(begin, end) == expected
+            assert tree.overlap_name("x", begin, end) == set(
+                iv for iv in expected if iv.data == "x"
+            )
+
+    def test_find_pages_cover_all_results(self):
+        self.thread.feed(b"MADD 1 9 b 2 9 b 3 9 a 4 9 c 5 9 b 6 9 a 20 30 z\n")
+        pages = []
+        command = b"FIND 0 10 LIMIT 2\n"
+        while True:
+            names, _, cursor = self.thread.feed(command).decode().rstrip("\n").partition(";")
+            pages.append(names)
+            if not cursor:
+                break
+            command = str.encode(f"FIND 0 10 LIMIT 2 AFTER {cursor}\n")
+        assert pages == ["a a", "b b", "b c"]
+        assert self.thread.feed(b"FIND 8 LIMIT 10\n") == b"a a b b b c;\n"
+        assert self.thread.feed(b"FIND 15 LIMIT 10\n") == b"ERROR no results\n"
+
+    def test_find_page_matches_brute_force(self):
+        rng = random.Random(11)
+        # Few names are paged name by name, many are paged by visiting every hit
+        for names in (3, 300):
+            for tree in (tcp_server.CustomIntervalTree(), tcp_server.CompactIntervalTree()):
+                for _ in range(300):
+                    begin = rng.randrange(0, 1000)
+                    tree[begin : begin + rng.randrange(1, 200)] = f"n{rng.randrange(names)}"
+                for _ in range(20):
+                    begin = rng.randrange(0, 1000)
+                    end = begin + rng.randrange(1, 500)
+                    limit = rng.randrange(1, 30)
+                    pages, cursor = [], None
+                    while True:
+                        page, cursor = tcp_server.find_page(tree, begin, end, limit, cursor)
+                        assert len(page) <= limit
+                        pages += page
+                        if cursor is None:
+                            break
+                    assert pages == sorted(iv.data for iv in tree.overlap(begin, end))
+
+    def test_find_stream(self):
+        self.thread.feed(b"MADD 1 9 b 2 9 b 3 9 a 4 9 c 20 30 z\n")
+        with mock.patch.object(tcp_server, "STREAM_CHUNK", 2):
+            pieces = list(self.thread.feed_chunks(b"ADD 1 2 y\nFIND 0 10 STREAM\nFIND 50\n"))
+        assert pieces == [b"OK\n", b"a b", b" b c", b" y\n", b"ERROR no results\n"]
+        assert self.thread.feed(b"FIND 25 STREAM\n") == b"z\n"
+
+    def test_run_streams_in_pieces(self):
+        self.thread.feed(b"MADD 1 9 b 2 9 a\n")
+        self.thread.conn.recv.side_effect = [b"FIND 3 STREAM\n", b""]
+        with mock.patch.object(tcp_server, "STREAM_CHUNK", 1):
+            self.thread.run()
+        assert self.thread.conn.sendall.call_args_list == [mock.call(b"a"), mock.call(b" b\n")]
+
+    def test_validate_find_options(self):
+        for command, error in [
+            ("FIND 1 2 LIMIT", "ERROR invalid FIND command\n"),
+            ("FIND 1 2 LIMIT 0", "ERROR invalid LIMIT\n"),
+            ("FIND 1 LIMIT \u00b2", "ERROR invalid LIMIT\n"),
+            ("FIND 1 LIMIT 1 AFTER a:\u00b2", "ERROR invalid cursor\n"),
+            ("FIND 1 LIMIT 5 AFTER x", "ERROR invalid cursor\n"),
+            ("FIND 1 AFTER x:1", "ERROR invalid FIND command\n"),
+            ("FIND 1 STREAM LIMIT 5", "ERROR invalid FIND command\n"),
+            ("FIND x 1 2 STREAM", "ERROR invalid FIND command\n"),
+            ("FIND x \u00b2 5", "ERROR invalid FIND command\n"),
+            ("FIND x 1 \u0665", "ERROR invalid FIND command\n"),
+            ("FIND 1 2 STREAM STREAM", "ERROR invalid FIND command\n"),
+            ("FIND a LIMIT 5", "ERROR first arg must be an integer\n"),
+        ]:
+            assert self.thread.validate_data(command.split()) is False, command
+            self.thread.conn.send.assert_called_with(str.encode(error))
+        assert self.thread.validate_data("FIND 1 2 LIMIT 5 AFTER x:3".split()) is True
+        assert self.thread.validate_data("FIND 1 STREAM".split()) is True
+        assert self.thread.validate_data("FIND LIMIT 1 2".split()) is True
+
+    def test_merge_on_insert(self):
+        with mock.patch.object(tcp_server, "MERGE_ON_INSERT", True):
+            response = self.thread.feed(
+                b"ADD 1 5 x\nADD 5 9 x\nADD 20 30 x\nADD 3 4 y\nMADD 10 12 x 9 10 x\n"
+                b"FIND 3\nFIND x 0 100\nADD 0 25 x\nFIND x 0 100\n"
+            )
+        assert response == b"OK\nOK\nOK\nOK\nOK\nx y\n1-12 20-30\nOK\n0-30\n"
+        assert len(tcp_server.TREE) == 2
+        tcp_server.TREE.verify()
+
+    def test_merge_on_insert_invalidates_cached_range(self):
+        patches = [
+            mock.patch.object(tcp_server, "MERGE_ON_INSERT", True),
+            mock.patch.object(tcp_server, "FIND_CACHE", tcp_server.FindCache(10)),
+        ]
+        with patches[0], patches[1]:
+            self.thread.feed(b"ADD 1 5 x\n")
+            tcp_server.TREE.add(Interval(5, 9, "x"))  # Left unmerged, as without merging
+            assert self.thread.feed(b"FIND 4 6\n") == b"x x\n"
+            assert self.thread.feed(b"ADD 0 2 x\nFIND 4 6\n") == b"OK\nx\n"
+
+    def test_compact(self):
+        rng = random.Random(3)
+        for tree in (tcp_server.CustomIntervalTree(), tcp_server.CompactIntervalTree()):
+            tcp_server.TREE = tree
+            for _ in range(300):
+                begin = rng.randrange(0, 200)
+                tree.add(Interval(begin, begin + rng.randrange(1, 10), rng.choice("xyz")))
+            before = {point: {iv.data for iv in tree.at(point)} for point in range(220)}
+            size = len(tree)
+            removed = tcp_server.MERGED["compact"]
+            assert self.thread.feed(b"COMPACT\n") == b"OK\n"
+            assert tcp_server.MERGED["compact"] - removed == size - len(tree) > 0
+            tree.verify()
+            for point, names in before.items():
+                hits = [iv.data for iv in tree.at(point)]
+                assert sorted(hits) == sorted(names)
+            ivs = sorted(tree, key=lambda iv: (iv.data, iv.begin))
+            assert all(a.data != b.data or a.end < b.begin for a, b in zip(ivs, ivs[1:]))
+        assert self.thread.feed(b"COMPACT now\n") == b"ERROR invalid COMPACT command\n"
+
+
+class TestConcurrency(unittest.TestCase):
+    """Tests for concurrent access to the shared TREE."""
+
+    def setUp(self):
+        tcp_server.TREE = tcp_server.CustomIntervalTree()
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Force frequent thread switches
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+        tcp_server.TREE = tcp_server.CustomIntervalTree()
+
+    def test_rwlock_readers_share(self):
+        lock = tcp_server.RWLock()
+        with lock.read_lock():
+            with lock.read_lock():
+                assert lock.readers == 2
+        assert lock.readers == 0
+
+    def test_rwlock_writer_excludes_and_is_preferred(self):
+        lock = tcp_server.RWLock()
+        events = []
+        reader_done = threading.Event()
+
+        def writer():
+            with lock.write_lock():
+                events.append("write")
+
+        def late_reader():
+            with lock.read_lock():
+                events.append("late read")
+            reader_done.set()
+
+        with lock.read_lock():
+            writer_thread = threading.Thread(target=writer)
+            writer_thread.start()
+            while not lock.writers_waiting:
+                time.sleep(0.001)
+            reader_thread = threading.Thread(target=late_reader)
+            reader_thread.start()
+            assert not reader_done.wait(0.05)  # Queued behind the waiting writer
+            events.append("first read")
+        writer_thread.join()
+        reader_thread.join()
+        assert events == ["first read", "write", "late read"]
+
+    def test_mixed_operations_keep_tree_consistent(self):
+        errors = []
+        stop = threading.Event()
+
+        def client(seed):
+            rng = random.Random(seed)
+            handler = tcp_server.CommandHandler(mock.Mock())
+            try:
+                for _ in range(300):
+                    begin = rng.randrange(0, 500)
+                    end = begin + rng.randrange(1, 50)
+                    name = rng.choice("abcd")
+                    command = rng.choice(
+                        [
+                            f"ADD {begin} {end} {name}",
+                            f"ADD {begin} {end} {name}",
+                            f"DEL {begin} {end} {name}",
+                            f"DEL {begin} {end}",
+                            f"FIND {begin}",
+                            f"FIND {begin} {end}",
+                            f"FIND {name} {begin} {end}",
+                        ]
+                    )
+                    handler.feed(str.encode(command + "\n"))
+            except Exception as e:
+                errors.append(e)
+
+        def verifier():
+            try:
+                while not stop.is_set():
+                    with tcp_server.TREE_LOCK.read_lock():
+                        tcp_server.TREE.verify()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=client, args=(seed,)) for seed in range(8)]
+        checker = threading.Thread(target=verifier)
+        checker.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stop.set()
+        checker.join()
+        assert errors == []
+        tcp_server.TREE.verify()
+
+
+class TestAsyncServer(unittest.TestCase):
+    """Tests for the asyncio server mode."""
+
+    def setUp(self):
+        tcp_server.TREE = tcp_server.CustomIntervalTree()
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(tcp_server.handle_stream, "127.0.0.1", 0)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        # Let connection handlers still waiting on a read run their cleanup
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        self.loop.close()
+        tcp_server.TREE = tcp_server.CustomIntervalTree()
+
+    def request(self, conn, command):
+        conn.sendall(str.encode(command))
+        return conn.recv(2048)
+
+    def test_add_and_find(self):
+        with socket.create_connection(("127.0.0.1", self.port)) as conn:
+            assert self.request(conn, "ADD 1 5 x\n") == b"OK\n"
+            assert self.request(conn, "ADD 3 9 y\n") == b"OK\n"
+            assert self.request(conn, "FIND 4\n") == b"x y\n"
+            assert self.request(conn, "DEL 1 5 x\n") == b"OK\n"
+            assert self.request(conn, "FIND 4\n") == b"y\n"
+
+    def test_shared_tree_across_connections(self):
+        with socket.create_connection(("127.0.0.1", self.port)) as first:
+            assert self.request(first, "ADD 1 5 x\n") == b"OK\n"
+        with socket.create_connection(("127.0.0.1", self.port)) as second:
+            assert self.request(second, "FIND 2\n") == b"x\n"
+            assert self.request(second, "BLAH\n") == b"ERROR invalid command\n"
+
+    def test_pipelined_commands(self):
+        with socket.create_connection(("127.0.0.1", self.port)) as conn:
+            commands = "".join(f"ADD {i} {i + 10} n{i}\n" for i in range(100))
+            conn.sendall(str.encode(commands + "FIND 5\n"))
+            expected = b"OK\n" * 100 + b"n0 n1 n2 n3 n4 n5\n"
+            received = b""
+            while len(received) < len(expected):
+                received += conn.recv(2048)
+            assert received == expected
+
+    def test_stream_connection_send(self):
+        writer = mock.Mock()
+        conn = tcp_server.StreamConnection(writer)
+        assert conn.send(b"OK\n") == 3
+        writer.write.assert_called_with(b"OK\n")
+
+
+class TestConnectionLifecycle(unittest.TestCase):
+    """Tests for connection limits, idle timeouts and socket errors."""
+
+    def setUp(self):
+        tcp_server.TREE = tcp_server.CustomIntervalTree()
+        self.slots = threading.BoundedSemaphore(1)
+        self.patches = [
+            mock.patch.object(tcp_server, "CONNECTION_SLOTS", self.slots),
+            mock.patch.object(tcp_server, "IDLE_TIMEOUT", 0.2),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        tcp_server.TREE = tcp_server.CustomIntervalTree()
+
+    def test_socket_error_closes_connection(self):
+        for error in (ConnectionResetError(), socket.timeout()):
+            assert self.slots.acquire(blocking=False)
+            conn = mock.Mock()
+            conn.recv.side_effect = [b"ADD 1 5 x\n", error]
+            tcp_server.ClientThread(conn, "localhost", 2004, slot=self.slots).run()
+            conn.settimeout.assert_called_once_with(0.2)
+            conn.sendall.assert_called_once_with(b"OK\n")
+            conn.close.assert_called_once_with()
+        # Both slots were handed back
+        assert self.slots.acquire(blocking=False)
+
+    def test_accept_errors_do_not_stop_the_server(self):
+        listener = mock.Mock()
+        listener.accept.side_effect = [
+            OSError(errno.EMFILE, "Too many open files"),
+            ConnectionAbortedError(errno.ECONNABORTED, "Software caused connection abort"),
+        ]
+        with mock.patch.object(tcp_server.time, "sleep") as sleep:
+            tcp_server.accept_connection(listener)
+            tcp_server.accept_connection(listener)
+        sleep.assert_called_once_with(tcp_server.ACCEPT_BACKOFF)
+        listener.accept.side_effect = OSError(errno.EBADF, "Bad file descriptor")
+        with self.assertRaises(OSError):
+            tcp_server.accept_connection(listener)
+
+    def test_threaded_idle_timeout_and_refusal(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        port = listener.getsockname()[1]
+        acceptor = threading.Thread(
+            target=lambda: [tcp_server.accept_connection(listener) for _ in range(3)], daemon=True
+        )
+        acceptor.start()
+        try:
+            with socket.create_connection(("127.0.0.1", port)) as first:
+                first.sendall(b"ADD 1 5 x\n")
+                assert first.recv(64) == b"OK\n"
+                with socket.create_connection(("127.0.0.1", port)) as second:
+                    assert second.recv(64) == b"ERROR server busy\n"
+                    assert second.recv(64) == b""
+                # The idle first connection is closed by the server
+                first.settimeout(5)
+                assert first.recv(64) == b""
+            time.sleep(0.1)
+            with socket.create_connection(("127.0.0.1", port)) as third:
+                third.sendall(b"FIND 2\n")
+                assert third.recv(64) == b"x\n"
+        finally:
+            listener.close()
+
+    def test_async_idle_timeout_and_refusal(self):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(
+            asyncio.start_server(tcp_server.handle_stream, "127.0.0.1", 0)
+        )
+        port = server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            with socket.create_connection(("127.0.0.1", port)) as first:
+                first.settimeout(5)
+                first.sendall(b"ADD 1 5 x\n")
+                assert first.recv(64) == b"OK\n"
+                with socket.create_connection(("127.0.0.1", port)) as second:
+                    second.settimeout(5)
+                    assert second.recv(64) == b"ERROR server busy\n"
+                assert first.recv(64) == b""
+            time.sleep(0.1)
+            with socket.create_connection(("127.0.0.1", port)) as third:
+                third.sendall(b"FIND 2\n")
+                assert third.recv(64) == b"x\n"
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+            loop.close()
+
+    def test_async_mode_defaults_to_no_limits(self):
+        env = {"PATH": os.environ.get("PATH", ""), "SERVER_MODE": "async"}
+        code = "from tcp_server import tcp_server as t; print(t.MAX_CONNECTIONS, t.IDLE_TIMEOUT)"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        def defaults():
+            return subprocess.run(
+                [sys.executable, "-c", code], env=env, cwd=root, capture_output=True, text=True
+            ).stdout.split()
+
+        assert defaults() == ["0", "0.0"]
+        env["SERVER_MODE"] = "thread"
+        assert defaults() == ["1024", "300.0"]
+
+
+class TestKeyspaces(unittest.TestCase):
+    """Tests for USE, @keyspace prefixes, FLUSH and DROP."""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(tcp_server, "TREE", tcp_server.CustomIntervalTree()),
+            mock.patch.object(tcp_server, "KEYSPACES", {}),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.handler = tcp_server.CommandHandler(mock.Mock())
+
+    def tearDown(self):
+        for name in list(tcp_server.KEYSPACES):
+            tcp_server.drop_keyspace(name)
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def test_keyspaces_are_independent(self):
+        response = self.handler.feed(
+            b"ADD 1 5 x\nUSE a\nADD 1 5 y\nFIND 2\nCOUNT 2\n@default FIND 2\n"
+            b"@b ADD 3 4 z\n@b FIND 3\nFIND 3\nUSE default\nFIND 3\n"
+        )
+        assert response == b"OK\nOK\nOK\ny\n1\nx\nOK\nz\ny\nOK\nx\n"
+        assert len(tcp_server.TREE) == 1
+        assert sorted(tcp_server.KEYSPACES) == ["a", "b"]
+        assert tcp_server.KEYSPACES["a"].tree.at(2) == {Interval(1, 5, "y")}
+        other = tcp_server.CommandHandler(mock.Mock())
+        assert other.feed(b"FIND 3\n") == b"x\n"
+
+    def test_flush_and_drop(self):
+        self.handler.feed(b"ADD 1 5 x\n@a ADD 1 5 y\n@b ADD 1 5 z\n")
+        assert self.handler.feed(b"@a FLUSH\n@a FIND 2\n@b FIND 2\n") == (
+            b"OK\nERROR no results\nz\n"
+        )
+        assert "a" in tcp_server.KEYSPACES
+        assert self.handler.feed(b"@b DROP\nFIND 2\n") == b"OK\nx\n"
+        assert "b" not in tcp_server.KEYSPACES
+        assert "keyspace.b.intervals" not in tcp_server.METRICS.read_gauges()
+        assert self.handler.feed(b"@b FIND 2\nFLUSH\nFIND 2\n") == (
+            b"ERROR no results\nOK\nERROR no results\n"
+        )
+
+    def test_only_adds_create_keyspaces(self):
+        response = self.handler.feed(
+            b"".join(b"@t%d FIND 5\n" % i for i in range(100))
+            + b"USE a\nFIND 1 10\nCOUNT 1\nDEL 1 5\nMDEL 1 5 x\nCOMPACT\nFLUSH\nDROP\n"
+            + b"ADD 5 1 x\nMADD 1 5\n@b BINARY\n"
+        )
+        assert response == (
+            b"ERROR no results\n" * 100
+            + b"OK\nERROR no results\n0\nOK\nOK\nOK\nOK\nOK\n"
+            + b"ERROR begin must be less than end\nERROR invalid MADD command\nOK\n"
+        )
+        find = binary.frame(bytes([binary.OP_FIND]) + binary.UINT32.pack(1))
+        assert self.handler.feed(find) == binary.encode_ids([])
+        assert tcp_server.KEYSPACES == {}
+        assert not any(name.startswith("keyspace.") for name in tcp_server.METRICS.read_gauges())
+        name_id = self.handler.names.intern("x")
+        self.handler.feed(binary.frame(bytes([binary.OP_ADD]) + binary.TRIPLE.pack(1, 5, name_id)))
+        assert len(tcp_server.KEYSPACES["a"].tree) == 1
+        other = tcp_server.CommandHandler(mock.Mock())
+        assert other.feed(b"@c MADD 1 5 x TTL 10\n@c FIND 2\n") == b"OK\nx\n"
+        assert sorted(tcp_server.KEYSPACES) == ["a", "c"]
+
+    def test_writes_racing_drop(self):
+        self.handler.feed(b"@a ADD 1 5 x\n")
+        keyspace = tcp_server.KEYSPACES["a"]
+        tcp_server.drop_keyspace("a")
+        keyspace.commit(["DEL", "1", "5"])
+        keyspace.commit(["COMPACT"])
+        assert tcp_server.KEYSPACES == {}
+        keyspace.commit(["ADD", "2", "6", "y"])
+        keyspace.commit(["DEL", "2", "3", "y"])
+        assert tcp_server.KEYSPACES["a"].tree.items() == {Interval(4, 6, "y")}
+
+    def test_errors(self):
+        for command, error in [
+            (b"USE\n", b"ERROR invalid USE command\n"),
+            (b"USE a b\n", b"ERROR invalid USE command\n"),
+            (b"@ FIND 1\n", b"ERROR invalid keyspace\n"),
+            (b"FLUSH now\n", b"ERROR invalid FLUSH command\n"),
+            (b"DROP\n", b"ERROR cannot drop the default keyspace\n"),
+            (b"@a DROP now\n", b"ERROR invalid DROP command\n"),
+        ]:
+            assert self.handler.feed(command) == error, command
+
+    def test_stats_per_keyspace(self):
+        self.handler.feed(b"@a ADD 1 5 x\n@a FIND 2\n@a FIND x\n")
+        gauges = tcp_server.METRICS.read_gauges()
+        assert gauges["keyspace.a.intervals"] == 1
+        assert gauges["keyspace.a.commands"] == 3
+        assert gauges["keyspace.a.errors"] == 1